@@ -0,0 +1,310 @@
+'''Accumulators for the merged output volume.
+
+Every input projection is added into the output projection with the same
+angle modulo one rotation (or half rotation), at a vertical offset that
+grows with the helical shift.  Doing that add directly on the HDF5 dataset
+means a read, an add and a write for every single projection.
+
+The accumulators here collect the sums in memory instead and write each
+output region to the file exactly once, in large contiguous slabs.  If the
+full output volume does not fit in the memory budget, the output angles
+are split into windows.  Input projection i only contributes to output
+angle i % ntheta_out, so each window only needs its own input projections
+and every input projection is still read exactly once.  A memory-mapped
+scratch file on local disk can hold windows larger than the memory budget.
+'''
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from merge_helical import log
+
+__all__ = ['DirectAccumulator', 'MemoryAccumulator', 'MemmapAccumulator', 'GrowableAccumulator',
+           'make_accumulator', 'window_size', 'reduce_partials', 'plan_windows', 'window_chunks']
+
+
+class MemoryAccumulator:
+    '''Sums projections for a window of output angles in a float32 buffer.'''
+    def __init__(self, window, ny, n):
+        self.buffer = np.zeros([window, ny, n], dtype='float32')
+        self.start = 0
+        self.stop = 0
+
+    def reset(self, start, stop):
+        '''Start accumulating output angles start:stop.'''
+        self.start = start
+        self.stop = stop
+        self.buffer[:stop-start] = 0
+
+    def add(self, out_angles, row_starts, data):
+        '''Add projections to the buffer.
+
+        Parameters
+        ----------
+        out_angles : ndarray
+            Output angle index of each projection.
+        row_starts : ndarray
+            First output row of each projection.  Rows that fall outside
+            the buffer, as at the edges of a vertical range, are dropped.
+        data : ndarray
+            Projections to add, (nproj, nrows, n).
+        '''
+        angles = (np.asarray(out_angles) - self.start)[:, None]
+        rows = np.asarray(row_starts)[:, None] + np.arange(data.shape[1])[None, :]
+        unique = np.unique(angles).size == angles.size
+        if rows.min() < 0 or rows.max() >= self.buffer.shape[1]:
+            inside = (rows >= 0) & (rows < self.buffer.shape[1])
+            angles, rows, data = np.broadcast_to(angles, rows.shape)[inside], rows[inside], data[inside]
+        if unique:
+            self.buffer[angles, rows] += data
+        else:
+            np.add.at(self.buffer, (angles, rows), data)
+
+    def flush(self, dset):
+        '''Write the accumulated window to *dset* in one slab.'''
+        dset[self.start:self.stop] = self.buffer[:self.stop-self.start]
+
+    def close(self):
+        pass
+
+
+class MemmapAccumulator(MemoryAccumulator):
+    '''Sums a window of output angles in a memory-mapped scratch file.
+
+    The window is not limited by the memory budget, so it can be the whole
+    output volume.  A finished window is streamed to the output dataset in
+    slabs of *slab* output angles.  The scratch file is deleted by *close*.
+    '''
+    def __init__(self, window, ny, n, scratch_dir, slab):
+        fd, self.path = tempfile.mkstemp(prefix='merge_helical_', suffix='.acc', dir=scratch_dir)
+        os.close(fd)
+        # A new file is all zeros, so nothing needs clearing on the first reset
+        self.buffer = np.memmap(self.path, dtype='float32', mode='w+', shape=(window, ny, n))
+        self.slab = slab
+        self.start = 0
+        self.stop = 0
+        self.fresh = True
+
+    def reset(self, start, stop):
+        if not self.fresh:
+            super().reset(start, stop)
+        self.start = start
+        self.stop = stop
+        self.fresh = False
+
+    def flush(self, dset):
+        '''Stream the accumulated window to *dset* in large sequential writes.'''
+        for st in range(self.start, self.stop, self.slab):
+            end = min(st + self.slab, self.stop)
+            dset[st:end] = self.buffer[st-self.start:end-self.start]
+
+    def close(self, remove=True):
+        '''Unmap the scratch file, and delete it unless *remove* is False.'''
+        if self.buffer is not None:
+            self.buffer.flush()
+            # Dropping the only reference unmaps the file
+            self.buffer = None
+            if remove:
+                os.remove(self.path)
+
+
+class GrowableAccumulator(MemoryAccumulator):
+    '''Sums all output angles of a scan that is still being acquired.
+
+    The height of the output is only known when the scan is done, so rows
+    are relative to the first projection and may be negative, and the
+    buffer grows as projections reach new rows.  Each growth at least
+    doubles the buffer height, so the copies cost little in total.
+
+    Only relative rows rows[0]:rows[1] are kept, if *rows* is given; None
+    for either end leaves it open.  The buffer may not grow beyond
+    *max_bytes*.
+    '''
+    def __init__(self, ntheta_out, n, rows=None, max_bytes=None):
+        self.buffer = np.zeros([ntheta_out, 0, n], dtype='float32')
+        self.row0 = 0
+        self.start = 0
+        self.stop = ntheta_out
+        self.rows = (None, None) if rows is None else rows
+        self.max_rows = None if max_bytes is None else int(max_bytes // (ntheta_out * n * 4))
+
+    def reset(self, start, stop):
+        pass
+
+    def _clip(self, lo, hi):
+        if self.rows[0] is not None:
+            lo = max(lo, self.rows[0])
+        if self.rows[1] is not None:
+            hi = min(hi, self.rows[1])
+        return lo, hi
+
+    def reserve(self, lo, hi):
+        '''Grow the buffer to cover relative rows lo:hi, within *rows*.'''
+        [ntheta_out, nrows, n] = self.buffer.shape
+        lo, hi = self._clip(lo, hi)
+        if hi <= lo or (nrows and lo >= self.row0 and hi <= self.row0 + nrows):
+            return
+        if nrows:
+            lo, hi = min(lo, self.row0), max(hi, self.row0 + nrows)
+        if self.max_rows is not None and hi - lo > self.max_rows:
+            raise RuntimeError('The merged volume needs {:.2f} GB, more than accumulator-max-memory; '
+                               'merge a vertical range or wait for the end of the scan'
+                               .format(ntheta_out * (hi - lo) * n * 4 / 2**30))
+        if nrows:
+            extra = max(nrows - (hi - lo - nrows), 0)
+            if self.max_rows is not None:
+                extra = min(extra, self.max_rows - (hi - lo))
+            # Grow on the side the rows are moving to
+            lo, hi = self._clip(*((lo - extra, hi) if lo < self.row0 else (lo, hi + extra)))
+        buffer = np.zeros([ntheta_out, hi - lo, n], dtype='float32')
+        buffer[:, self.row0 - lo:self.row0 - lo + nrows] = self.buffer
+        self.buffer = buffer
+        self.row0 = lo
+
+    def add(self, out_angles, row_starts, data):
+        '''As MemoryAccumulator.add, with *row_starts* relative to the first projection.'''
+        row_starts = np.asarray(row_starts)
+        self.reserve(int(row_starts.min()), int(row_starts.max()) + data.shape[1])
+        super().add(out_angles, row_starts - self.row0, data)
+
+    def flush(self, dset, offset=0, slab=32):
+        '''Write the sums to *dset*, where relative row r is row r + offset.
+
+        Rows outside *dset* are dropped.
+        '''
+        ny_out = dset.shape[1]
+        lo = max(self.row0 + offset, 0)
+        hi = min(self.row0 + offset + self.buffer.shape[1], ny_out)
+        if hi <= lo:
+            return
+        src = slice(lo - self.row0 - offset, hi - self.row0 - offset)
+        for st in range(0, self.buffer.shape[0], slab):
+            end = min(st + slab, self.buffer.shape[0])
+            dset[st:end, lo:hi] = self.buffer[st:end, src]
+
+
+class DirectAccumulator:
+    '''Adds every projection directly to the HDF5 dataset (read-modify-write).
+
+    Slow, but needs no memory beyond one chunk.
+    '''
+    def __init__(self, dset):
+        self.dset = dset
+        self.start = 0
+        self.stop = 0
+
+    def reset(self, start, stop):
+        self.start = start
+        self.stop = stop
+
+    def add(self, out_angles, row_starts, data):
+        ny = self.dset.shape[1]
+        for angle, row, proj in zip(out_angles, row_starts, data):
+            lo, hi = max(row, 0), min(row + proj.shape[0], ny)
+            if hi > lo:
+                self.dset[angle, lo:hi] += proj[lo-row:hi-row]
+
+    def flush(self, dset):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_accumulator(params, dset):
+    '''Build the accumulator chosen by *params* for output dataset *dset*.
+
+    Returns the accumulator and the number of output angles per window.
+    '''
+    [ntheta_out, ny_out, n] = dset.shape
+    if params.accumulator == 'hdf5':
+        log.warning('  *** accumulate directly in the HDF5 file')
+        return DirectAccumulator(dset), ntheta_out
+    bytes_per_angle = ny_out * n * 4
+    window = window_size(params, dset)
+    if params.accumulator == 'memmap':
+        scratch_dir = params.scratch_dir or tempfile.gettempdir()
+        # Only checkpoint-angles limits the window, so an interrupted merge
+        # can be resumed from its last committed window
+        scratch_window = window_size(params, dset, memory=False)
+        volume = scratch_window * bytes_per_angle
+        free = shutil.disk_usage(scratch_dir).free
+        if params.scratch_max_size > 0 and volume > params.scratch_max_size * 2**30:
+            log.warning('  *** scratch window {:.2f} GB exceeds scratch cap {:.2f} GB, accumulate in memory'
+                            .format(volume / 2**30, params.scratch_max_size))
+        elif volume > free:
+            log.warning('  *** only {:.2f} GB free in {:s} for a {:.2f} GB window, accumulate in memory'
+                            .format(free / 2**30, scratch_dir, volume / 2**30))
+        else:
+            acc = MemmapAccumulator(scratch_window, ny_out, n, scratch_dir, window)
+            log.info('  *** accumulate in scratch file {:s}, {:d} of {:d} output angles at a time ({:.2f} GB)'
+                        .format(acc.path, scratch_window, ntheta_out, volume / 2**30))
+            return acc, scratch_window
+    log.info('  *** accumulate in memory, {:d} of {:d} output angles at a time ({:.2f} GB)'
+                .format(window, ntheta_out, window * bytes_per_angle / 2**30))
+    return MemoryAccumulator(window, ny_out, n), window
+
+
+def window_size(params, dset, memory=True):
+    '''Number of output angles of *dset* that fit in the accumulator memory budget.
+
+    At most checkpoint-angles, so an interrupted merge loses little work.
+    With *memory* False the budget is ignored, for windows on scratch disk.
+    '''
+    [ntheta_out, ny_out, n] = dset.shape
+    window = int(params.accumulator_max_memory * 2**30 // (ny_out * n * 4)) if memory else ntheta_out
+    if params.checkpoint_angles > 0:
+        window = min(window, params.checkpoint_angles)
+    if dset.chunks and window > dset.chunks[0]:
+        # Align windows with the chunks so each chunk is written once
+        window -= window % dset.chunks[0]
+    return max(1, min(window, ntheta_out))
+
+
+def reduce_partials(partials, dset, slab):
+    '''Sum partial outputs into *dset*, *slab* output angles at a time.
+
+    Parameters
+    ----------
+    partials : list
+        (path, row_start, nrows) of each memory-mapped partial output,
+        which covers rows row_start:row_start+nrows of all output angles.
+        They are summed in list order, so the result is reproducible.
+    dset : h5py.Dataset
+        Output dataset.
+    slab : int
+        Number of output angles summed and written at a time.
+    '''
+    [ntheta_out, ny_out, n] = dset.shape
+    maps = [(np.memmap(path, dtype='float32', mode='r', shape=(ntheta_out, nrows, n)), row, nrows)
+                for path, row, nrows in partials]
+    buffer = np.empty([min(slab, ntheta_out), ny_out, n], dtype='float32')
+    for st in range(0, ntheta_out, slab):
+        end = min(st + slab, ntheta_out)
+        buffer[:end-st] = 0
+        for partial, row, nrows in maps:
+            buffer[:end-st, row:row+nrows] += partial[st:end]
+        dset[st:end] = buffer[:end-st]
+
+
+def plan_windows(ntheta_out, window):
+    '''Split the output angles into (start, stop) windows of at most *window* angles.'''
+    return [(a, min(a + window, ntheta_out)) for a in range(0, ntheta_out, window)]
+
+
+def window_chunks(ntheta, ntheta_out, start, stop, ptheta):
+    '''Input projection chunks (st, end) that contribute to output angles start:stop.
+
+    Chunks are at most *ptheta* projections and never straddle a rotation,
+    so every projection in a chunk maps into the window.
+    '''
+    if start == 0 and stop == ntheta_out:
+        return [(st, min(st + ptheta, ntheta)) for st in range(0, ntheta, ptheta)]
+    chunks = []
+    for offset in range(0, ntheta, ntheta_out):
+        hi = min(stop + offset, ntheta)
+        for st in range(start + offset, hi, ptheta):
+            chunks.append((st, min(st + ptheta, hi)))
+    return chunks
@@ -0,0 +1,117 @@
+'''Array backends for the helical merge.
+
+The subpixel shift of the projections is the only numerically heavy step
+of the merge that is written against an array library.  This module hides
+whether those arrays live in host memory (NumPy, with multithreaded FFTs
+from scipy.fft) or on a GPU (CuPy), so the merge code can be written once
+against ``backend.xp`` and the FFT wrappers below.
+
+All backends work in float32/complex64.
+'''
+import os
+
+import numpy as np
+
+from merge_helical import log
+
+__all__ = ['get_backend', 'NumpyBackend', 'CupyBackend']
+
+
+class NumpyBackend:
+    '''CPU backend: NumPy arrays, scipy.fft with worker threads.'''
+    name = 'numpy'
+
+    def __init__(self, workers=0):
+        import scipy.fft
+        import scipy.ndimage
+        self.xp = np
+        self.fft = scipy.fft
+        self.ndimage = scipy.ndimage
+        self.workers = workers if workers > 0 else os.cpu_count()
+
+    def __repr__(self):
+        return 'NumpyBackend(workers={:d})'.format(self.workers)
+
+    def asarray(self, data, dtype='float32'):
+        return np.asarray(data, dtype=dtype)
+
+    def asnumpy(self, data):
+        return np.asarray(data)
+
+    def rfft(self, data, axis=-1):
+        return self.fft.rfft(data, axis=axis, workers=self.workers)
+
+    def irfft(self, data, n, axis=-1):
+        return self.fft.irfft(data, n=n, axis=axis, workers=self.workers)
+
+    def rfft2(self, data):
+        return self.fft.rfft2(data, workers=self.workers)
+
+    def irfft2(self, data, s):
+        return self.fft.irfft2(data, s=s, workers=self.workers)
+
+
+class CupyBackend:
+    '''GPU backend: CuPy arrays and cuFFT.'''
+    name = 'cupy'
+
+    def __init__(self):
+        import cupy
+        import cupyx.scipy.fft
+        import cupyx.scipy.ndimage
+        self.xp = cupy
+        self.fft = cupyx.scipy.fft
+        self.ndimage = cupyx.scipy.ndimage
+
+    def __repr__(self):
+        return 'CupyBackend(device={:d})'.format(self.xp.cuda.runtime.getDevice())
+
+    def asarray(self, data, dtype='float32'):
+        return self.xp.asarray(data, dtype=dtype)
+
+    def asnumpy(self, data):
+        return self.xp.asnumpy(data)
+
+    def rfft(self, data, axis=-1):
+        return self.fft.rfft(data, axis=axis)
+
+    def irfft(self, data, n, axis=-1):
+        return self.fft.irfft(data, n=n, axis=axis)
+
+    def rfft2(self, data):
+        return self.fft.rfft2(data)
+
+    def irfft2(self, data, s):
+        return self.fft.irfft2(data, s=s)
+
+
+def _cupy_available():
+    '''Is CuPy importable and is there at least one GPU?'''
+    try:
+        import cupy
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except Exception:
+        return False
+
+
+def get_backend(name='auto', workers=0):
+    '''Return the array backend requested by *name*.
+
+    Parameters
+    ----------
+    name : str
+        'numpy', 'cupy' or 'auto'.  'auto' uses CuPy if a GPU is
+        available and falls back to NumPy otherwise.
+    workers : int
+        Number of FFT worker threads for the NumPy backend.  0 uses all cores.
+    '''
+    if name == 'auto':
+        name = 'cupy' if _cupy_available() else 'numpy'
+    if name == 'numpy':
+        backend = NumpyBackend(workers)
+    elif name == 'cupy':
+        backend = CupyBackend()
+    else:
+        raise ValueError('Unknown array backend: {:s}'.format(name))
+    log.info('  *** array backend: {}'.format(backend))
+    return backend
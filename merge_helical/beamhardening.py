@@ -48,9 +48,21 @@ Usage:
 * Run either fcorrect_as_pathlength or fcorrect_as_transmission, as desired,
     to correct an image.
 
+The calibration only depends on the filters, the sample and scintillator
+materials and the data files, so it is stored in an on-disk cache (see
+beam-hardening-cache-dir) and later runs with the same beamline setup skip
+it.  Use get_softener to get the BeamSoftener of a run: it is built once
+per process and shared by all projection chunks.  Materials are only
+loaded when a run needs them, and the parsed text tables are kept in the
+same cache directory as .npz files.
+
 '''
-from copy import deepcopy
+from collections.abc import Mapping as MappingABC
 import os
+import hashlib
+import json
+import threading
+import time
 from pathlib import Path, PurePath
 import logging
 from typing import Mapping
@@ -66,32 +78,109 @@ from scipy.signal.windows import gaussian
 from tomopy.util import mproc
 from tomopy_cli import config
 
+from merge_helical import handle_hdf
+from merge_helical import util
+
 
 log = logging.getLogger(__name__)
 
 
 data_path = Path(__file__).parent / 'beam_hardening_data'
 
+# Bump when the calibration algorithm changes, to invalidate old cache files
+CALIBRATION_CACHE_VERSION = 2
+
+# Largest error of the lookup table allowed, relative to the largest pathlength
+LUT_TOLERANCE = 1e-5
+
+_softeners = {}
+_softeners_lock = threading.Lock()
+_simpson_weights = {}
+_materials = {}
+_materials_lock = threading.Lock()
+
+
+def fload_table(source_path, cache_dir=None, comments='#'):
+    '''Numeric table from a text data file, through a binary cache.
+
+    The parsed table is kept as an .npz file in *cache_dir*/tables, along
+    with the size and modification time of the text file.  If the text
+    file changes, it is parsed again and the cache is rewritten.  No cache
+    is used if *cache_dir* is None.
+    '''
+    source_path = Path(source_path)
+    if cache_dir is None:
+        return np.genfromtxt(source_path, comments=comments)
+    stat = source_path.stat()
+    cache_path = Path(cache_dir) / 'tables' / (source_path.name + '.npz')
+    try:
+        with np.load(cache_path) as cache:
+            if int(cache['size']) == stat.st_size and int(cache['mtime_ns']) == stat.st_mtime_ns:
+                return cache['table']
+    except (OSError, KeyError, ValueError):
+        pass
+    table = np.genfromtxt(source_path, comments=comments)
+    _save_cache(cache_path, table=table, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    return table
+
+
+def get_material(name, density, cache_dir=None):
+    '''The Material *name* with *density*, loaded on first use and then shared.'''
+    key = (name, float(density))
+    with _materials_lock:
+        material = _materials.get(key)
+        if material is None:
+            material = Material(name, density, cache_dir)
+            _materials[key] = material
+    return material
+
+
+def simpson_weights(x):
+    '''Quadrature weights w such that w @ y equals scipy.integrate.simpson(y, x=x).
+
+    Simpson's rule is linear in y, so the weights are the integrals of the
+    unit vectors.  They are computed once per grid.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    key = hashlib.sha1(x.tobytes()).hexdigest()
+    weights = _simpson_weights.get(key)
+    if weights is None:
+        weights = scipy.integrate.simpson(np.eye(x.size), x=x, axis=1)
+        _simpson_weights[key] = weights
+    return weights
+
 
 class Spectrum:
-    '''Class to hold the spectrum: energies and spectral power.'''
+    '''Class to hold the spectrum: energies and spectral power.
+
+    A small value type around two float64 arrays.  The energies are shared
+    between copies and never modified; the spectral power is owned by each
+    Spectrum and the Material methods can update it in place.
+    '''
+    __slots__ = ('energies', 'spectral_power')
+
     def __init__(self, energies, spectral_power):
-        if len(energies) != len(spectral_power):
-            raise ValueError
+        energies = np.asarray(energies, dtype=np.float64)
+        spectral_power = np.array(spectral_power, dtype=np.float64)
+        if energies.shape != spectral_power.shape:
+            raise ValueError('energies and spectral_power must have the same shape')
         self.energies = energies
         self.spectral_power = spectral_power
 
+    def copy(self):
+        return Spectrum(self.energies, self.spectral_power)
+
     def fintegrated_power(self):
-        return scipy.integrate.simps(self.spectral_power, self.energies)
+        return simpson_weights(self.energies) @ self.spectral_power
 
     def fmean_energy(self):
         power = self.spectral_power
         total_power = self.fintegrated_power()
         energies = self.energies
-        return scipy.integrate.simps(power * energies, energies) / total_power
+        return simpson_weights(energies) @ (power * energies) / total_power
     
     def __len__(self):
-        return len(energies)
+        return len(self.energies)
 
 
 # Copy part of the Material class from Scintillator_Optimization code
@@ -101,18 +190,19 @@ class Material:
     Data based off of the xCrossSec database in XOP 2.4.
     
     '''
-    def __init__(self,name,density):
+    def __init__(self,name,density,cache_dir=None):
         self.name = name
         self.density = density  #in g/cc
-        self.fread_absorption_data()
+        self.fread_absorption_data(cache_dir)
+        self.coefficients = {}
         self.absorption_interpolation_function = self.interp_function(self.energy_array,self.absorption_array)
         self.attenuation_interpolation_function = self.interp_function(self.energy_array,self.attenuation_array)
     
     def __repr__(self):
         return "Material({0:s}, {1:f}g/mL)".format(self.name, self.density)
     
-    def fread_absorption_data(self):
-        raw_data = np.genfromtxt(os.path.join(data_path, self.name + '_properties_xCrossSec.dat'))
+    def fread_absorption_data(self, cache_dir=None):
+        raw_data = fload_table(data_path / (self.name + '_properties_xCrossSec.dat'), cache_dir)
         self.energy_array = raw_data[:,0] / 1000.0      #in keV
         self.absorption_array = raw_data[:,3]   #in cm^2/g, from XCOM in XOP
         self.attenuation_array = raw_data[:,7]  #in cm^2/g, from XCOM in XOP, ignoring coherent scattering
@@ -122,15 +212,31 @@ class Material:
         '''
         return scipy.interpolate.interp1d(np.log(energies), np.log(absorptions), bounds_error=False)
     
+    def fcoefficients(self, kind, input_energies):
+        '''Absorption or attenuation coefficients on an energy grid, memoized per grid.
+
+        The arrays returned are read only, because they are shared.
+        '''
+        input_energies = np.asarray(input_energies, dtype=np.float64)
+        key = (kind, input_energies.shape, hashlib.sha1(input_energies.tobytes()).digest())
+        coefficients = self.coefficients.get(key)
+        if coefficients is None:
+            function = (self.absorption_interpolation_function if kind == 'absorption'
+                        else self.attenuation_interpolation_function)
+            coefficients = np.exp(function(np.log(input_energies)))
+            coefficients.flags.writeable = False
+            self.coefficients[key] = coefficients
+        return coefficients
+
     def finterpolate_absorption(self, input_energies):
         '''Interpolates absorption on log-log scale and scales back
         '''
-        return np.exp(self.absorption_interpolation_function(np.log(input_energies)))
+        return self.fcoefficients('absorption', input_energies)
     
     def finterpolate_attenuation(self,input_energies):
         '''Interpolates attenuation on log-log scale and scales back
         '''
-        return np.exp(self.attenuation_interpolation_function(np.log(input_energies)))
+        return self.fcoefficients('attenuation', input_energies)
     
     def fcompute_proj_density(self, thickness):
         '''Computes projected density from thickness and material density.
@@ -139,15 +245,17 @@ class Material:
         '''
         return thickness /1e4 * self.density
     
-    def fcompute_transmitted_spectrum(self, thickness, input_spectrum):
+    def fcompute_transmitted_spectrum(self, thickness, input_spectrum, out=None):
         '''Computes the transmitted spectral power through a filter.
         Inputs:
         thickness: the thickness of the filter in um
         input_spectrum: Spectrum object for incident spectrum
+        out: Spectrum object for the result, may be input_spectrum.
+            A new Spectrum if not given.
         Output:
         Spectrum object for transmitted intensity
         '''
-        output_spectrum = deepcopy(input_spectrum)
+        output_spectrum = _output_spectrum(input_spectrum, out)
         #Compute filter projected density
         filter_proj_density = self.fcompute_proj_density(thickness)
         #Find the spectral transmission using Beer-Lambert law
@@ -155,22 +263,34 @@ class Material:
                     np.exp(-self.finterpolate_attenuation(output_spectrum.energies) * filter_proj_density))
         return output_spectrum
     
-    def fcompute_absorbed_spectrum(self, thickness, input_spectrum):
+    def fcompute_absorbed_spectrum(self, thickness, input_spectrum, out=None):
         '''Computes the absorbed power of a filter.
         Inputs:
         thickness: the thickness of the filter in um
         input_spectrum: Spectrum object for incident beam
+        out: Spectrum object for the result, may be input_spectrum.
+            A new Spectrum if not given.
         Output:
         Spectrum objection for absorbed spectrum
         '''
-        output_spectrum = deepcopy(input_spectrum)
-        #Compute filter projected density
-        filter_proj_density = self.fcompute_proj_density(thickness)
-        #Find the spectral transmission using Beer-Lambert law
-        ext_lengths = self.finterpolate_absorption(input_spectrum.energies) * filter_proj_density 
-        output_spectrum.spectral_power *= (1.0 - np.exp(-ext_lengths))
+        output_spectrum = _output_spectrum(input_spectrum, out)
+        output_spectrum.spectral_power *= self.fcompute_absorbed_fraction(thickness, input_spectrum.energies)
         return output_spectrum
     
+    def fcompute_transmission_matrix(self, thicknesses, energies):
+        '''Beer-Lambert transmission for every thickness (um) and energy (keV).
+
+        Returns an array of shape (thicknesses.size, energies.size).
+        '''
+        proj_density = self.fcompute_proj_density(np.asarray(thicknesses, dtype=np.float64))
+        return np.exp(-np.multiply.outer(proj_density, self.finterpolate_attenuation(energies)))
+
+    def fcompute_absorbed_fraction(self, thickness, energies):
+        '''Fraction of the incident power absorbed at each energy (keV) by *thickness* um.'''
+        #Find the spectral transmission using Beer-Lambert law
+        ext_lengths = self.finterpolate_absorption(energies) * self.fcompute_proj_density(thickness)
+        return 1.0 - np.exp(-ext_lengths)
+
     def fcompute_absorbed_power(self, thickness, input_spectrum):
         '''Computes the absorbed power of a filter.
         Inputs:
@@ -200,12 +320,187 @@ def fapply_filters(filters: Mapping, input_spectrum):
       spectral power transmitted through the filter set.
     
     """
-    temp_spectrum = deepcopy(input_spectrum)
+    temp_spectrum = input_spectrum.copy()
     for filt, thickness in filters.items():
-        temp_spectrum = filt.fcompute_transmitted_spectrum(thickness, temp_spectrum)
+        filt.fcompute_transmitted_spectrum(thickness, temp_spectrum, out=temp_spectrum)
     return temp_spectrum
 
 
+def _output_spectrum(input_spectrum, out):
+    '''Spectrum to write a result to: *out* holding the input power, or a copy of the input.'''
+    if out is None:
+        return input_spectrum.copy()
+    if out is not input_spectrum:
+        out.energies = input_spectrum.energies
+        out.spectral_power = input_spectrum.spectral_power.copy()
+    return out
+
+
+# Sample thicknesses in um used for the calibration
+SAMPLE_THICKNESSES = np.sort(np.concatenate((-np.logspace(1,0,21), [0], np.logspace(-1,4.5,441))))
+
+
+class PathlengthLUT:
+    '''Dense float32 lookup table of a transmission to pathlength spline.
+
+    The spline is sampled once on a grid that is log-spaced from the lowest
+    calibrated transmission up to *log_start* and uniform from there to the
+    highest.  Pathlength is close to linear in log(transmission) at low
+    transmission, so the log-spaced part keeps the linear interpolation
+    accurate where the curve is steep.  Both parts have uniform spacing in
+    their own coordinate, so a lookup is arithmetic and needs no search.
+
+    Transmissions outside the table are clamped to its ends, like the
+    spline with ext='const'.
+    '''
+    def __init__(self, spline, trans_min, trans_max, size=65536, log_start=0.05):
+        log_start = min(max(log_start, trans_min), trans_max)
+        # Share the points between the two parts in proportion to their lengths
+        log_len = np.log(log_start / trans_min)
+        lin_len = (trans_max - log_start) / log_start
+        n_log = int(round((size - 1) * log_len / (log_len + lin_len))) + 1
+        n_log = min(max(n_log, 2), size - 1)
+        n_lin = size - n_log + 1
+        self.trans_min = np.float32(trans_min)
+        self.trans_max = np.float32(trans_max)
+        self.log_start = np.float32(log_start)
+        self.log_min = np.float32(np.log(trans_min))
+        self.inv_dlog = np.float32((n_log - 1) / log_len) if log_len > 0 else np.float32(0)
+        self.inv_dlin = np.float32((n_lin - 1) / (trans_max - log_start))
+        self.n_log = n_log
+        self.grid = np.concatenate((np.geomspace(trans_min, log_start, n_log)[:-1],
+                                    np.linspace(log_start, trans_max, n_lin)))
+        table = spline(self.grid)
+        self.table = table.astype(np.float32)
+        self.slope = np.append(np.diff(table), 0).astype(np.float32)
+
+    def __len__(self):
+        return self.table.size
+
+    def _lookup(self, trans, out):
+        '''Table lookup of the flat arrays *trans* into *out*.'''
+        pos = np.clip(trans, self.trans_min, self.trans_max, dtype=np.float32)
+        low = np.flatnonzero(pos < self.log_start)
+        pos -= self.log_start
+        pos *= self.inv_dlin
+        pos += np.float32(self.n_log - 1)
+        if low.size:
+            pos[low] = (np.log(np.maximum(trans[low], self.trans_min), dtype=np.float32)
+                        - self.log_min) * self.inv_dlog
+        nans = np.flatnonzero(np.isnan(pos))
+        pos[nans] = 0
+        index = pos.astype(np.int32)
+        np.minimum(index, self.table.size - 2, out=index)
+        pos -= index
+        np.multiply(self.slope[index], pos, out=out)
+        out += self.table[index]
+        out[nans] = np.nan
+
+    def __call__(self, trans, out=None, block=1 << 16):
+        '''Pathlength for *trans*, written to *out* if given (may be *trans*).
+
+        Works through the data *block* values at a time, so the temporaries
+        stay in the CPU cache.
+        '''
+        trans = np.asarray(trans)
+        if out is None:
+            out = np.empty(trans.shape, dtype=np.float32)
+        elif not out.flags.c_contiguous:
+            out[...] = self(trans, block=block)
+            return out
+        flat_trans = trans.reshape(-1)
+        flat_out = out.reshape(-1)
+        for st in range(0, flat_trans.size, block):
+            self._lookup(flat_trans[st:st+block], flat_out[st:st+block])
+        return out
+
+    def fvalidate(self, spline):
+        '''Largest difference from *spline*, relative to the largest pathlength.
+
+        Checked halfway between the table points, where linear
+        interpolation is worst.
+        '''
+        mid = 0.5 * (self.grid[1:] + self.grid[:-1])
+        exact = spline(mid)
+        scale = float(np.max(np.abs(self.table))) or 1.0
+        return float(np.max(np.abs(self(mid) - exact))) / scale
+
+
+def fread_setup(config_filename=None):
+    '''Read setup.cfg, or *config_filename*.
+
+    Returns the density of every material symbol, the reference
+    transmission of the angular correction and the transmission threshold
+    of the spline fits.
+    '''
+    if config_filename:
+        config_path = Path(config_filename)
+        if not config_path.exists():
+            raise IOError('Config file does not exist: ' + str(config_path))
+    else:
+        config_path = data_path / 'setup.cfg'
+    densities = {}
+    ref_trans = threshold_trans = None
+    with open(config_path, 'r') as config_file:
+        for line in config_file:
+            if line.startswith('#'):
+                continue
+            elif line.startswith('symbol'):
+                symbol = line.split(',')[0].split('=')[1].strip()
+                densities[symbol] = float(line.split(',')[1].split('=')[1])
+            elif line.startswith('ref_trans'):
+                ref_trans = float(line.split(':')[1].strip())
+            elif line.startswith('threshold_trans'):
+                threshold_trans = float(line.split(':')[1].strip())
+    return densities, ref_trans, threshold_trans
+
+
+def fread_spectra(cache_dir=None):
+    '''Spectra of the Psi_##urad.dat files, keyed by the angle in urad.'''
+    spectra = {}
+    for f_path in sorted(data_path.iterdir()):
+        f_name = f_path.name
+        if f_path.is_file() and f_name.startswith('Psi') and f_name.endswith(('.dat', '.DAT')):
+            log.info('  *** *** source file {:s} located'.format(f_name))
+            f_angle = float(f_name.split('_')[1][:2])
+            spectral_data = fload_table(f_path, cache_dir, comments='!')
+            spectra[f_angle] = Spectrum(spectral_data[:,0] / 1000., spectral_data[:,1])
+    return spectra
+
+
+def fusable_calibration_points(sample_effective_trans, threshold_trans):
+    '''Calibration points above *threshold_trans*, sorted by transmission.
+
+    Returns the effective transmissions and the sample thicknesses.
+    '''
+    # Threshold the transmission we accept to keep the spline from getting unstable
+    usable = sample_effective_trans > threshold_trans
+    usable_trans = sample_effective_trans[usable]
+    usable_thicknesses = SAMPLE_THICKNESSES[usable]
+    # Make sure things are sorted in ascending order for the spline
+    inds = np.argsort(usable_trans)
+    return usable_trans[inds], usable_thicknesses[inds]
+
+
+class LazyMaterials(MappingABC):
+    '''Materials from setup.cfg, by symbol.  Each is only loaded when looked up.'''
+    def __init__(self, cache_dir=None):
+        self.densities = {}
+        self.cache_dir = cache_dir
+
+    def __getitem__(self, symbol):
+        return get_material(symbol, self.densities[symbol], self.cache_dir)
+
+    def __contains__(self, symbol):
+        return symbol in self.densities
+
+    def __iter__(self):
+        return iter(self.densities)
+
+    def __len__(self):
+        return len(self.densities)
+
+
 class BeamSoftener():
     # Variables we need for computing LUT
     spectra_dict = None # Initialized in __init__
@@ -227,12 +522,22 @@ class BeamSoftener():
     def __init__(self, params):
         """Initializes the beam hardening correction code."""
         log.info('  *** beam hardening')
-        self.possible_materials = {}
+        self.cache_dir = None
+        if params.beam_hardening_cache_dir.lower() != 'none':
+            self.cache_dir = Path(params.beam_hardening_cache_dir)
+        self.possible_materials = LazyMaterials(self.cache_dir)
         self.filters = {}        
+        self.row_factors = {}
+        self.lut = None
         if params.beam_hardening_method == 'standard':
             self.fread_config_file()
-            self.fread_source_data()
             self.parse_params(params)
+            if not self.fload_calibration():
+                self.fread_source_data()
+                self.ffind_calibration()
+                self.fsave_calibration()
+            if params.beam_hardening_engine == 'lut':
+                self.fbuild_lut(params.beam_hardening_lut_size, params.beam_hardening_lut_log_start)
             self.center_row = self.find_center_row(params)
             log.info("  *** *** Center row for beam hardening = {0:f}".format(self.center_row))
             if int(params.binning) > 0:
@@ -248,27 +553,8 @@ class BeamSoftener():
         Default file is in same directory as this source code.
         Users can input an alternative config file as needed.
         '''
-        if config_filename:
-            config_path = Path(config_filename)
-            if not config_path.exists():
-                raise IOError('Config file does not exist: ' + str(config_path))
-        else:
-            config_path = Path.joinpath(Path(__file__).parent, 'beam_hardening_data', 'setup.cfg')
-        with open(config_path, 'r') as config_file:
-            while True:
-                line = config_file.readline()
-                if line == '':
-                    break
-                if line.startswith('#'):
-                    continue
-                elif line.startswith('symbol'):
-                    symbol = line.split(',')[0].split('=')[1].strip()
-                    density = float(line.split(',')[1].split('=')[1])
-                    self.possible_materials[symbol] = Material(symbol, density)
-                elif line.startswith('ref_trans'):
-                    self.ref_trans = float(line.split(':')[1].strip())
-                elif line.startswith('threshold_trans'):
-                    self.threshold_trans = float(line.split(':')[1].strip())
+        densities, self.ref_trans, self.threshold_trans = fread_setup(config_filename)
+        self.possible_materials.densities.update(densities)
     
     def fread_source_data(self):
         """Reads the spectral power data from files.  Data file comes from the
@@ -277,18 +563,7 @@ class BeamSoftener():
         plane.
         
         """
-        self.spectra_dict = {}
-        file_list = list(filter(lambda x: x.endswith(('.dat', '.DAT')), os.listdir(data_path)))
-        for f_name in file_list:
-            f_path = os.path.join(data_path, f_name)
-            #print(f_path)
-            if os.path.isfile(f_path) and f_name.startswith('Psi'):
-                log.info('  *** *** source file {:s} located'.format(f_name))
-                f_angle = float(f_name.split('_')[1][:2])
-                spectral_data = np.genfromtxt(f_path, comments='!')
-                spectral_energies = spectral_data[:,0] / 1000.
-                spectral_power = spectral_data[:,1]
-                self.spectra_dict[f_angle] = Spectrum(spectral_energies, spectral_power)
+        self.spectra_dict = fread_spectra(self.cache_dir)
     
     def parse_params(self, params):
         """Parse the input parameters to fill in filters, sample material,
@@ -324,11 +599,9 @@ class BeamSoftener():
           Material symbol is unknown.
         
         """
-        for mat in self.possible_materials.values():
-            if mat.name  == material:
-                return mat
-        else:
+        if material not in self.possible_materials:
             raise ValueError('No such material in possible_materials: {0:s}'.format(material))
+        return self.possible_materials[material]
     
     def add_filter(self, symbol, thickness):
         """Add a filter of a given symbol and thickness."""
@@ -339,70 +612,200 @@ class BeamSoftener():
         '''Finds the brightest row of the input image.
         Filters to make sure we ignore spurious noise.
         '''
-        with h5py.File(params.file_name,'r') as hdf_file:
-            bright = hdf_file['/exchange/data_white'][...]
-        if len(bright.shape) > 2:
-            bright = bright[-1,...]
+        with handle_hdf.raw_file(params) as hdf_file:
+            bright = hdf_file['/exchange/data_white']
+            # Only the last bright image is used
+            bright = bright[-1] if bright.ndim > 2 else bright[...]
         vertical_slice = np.sum(bright, axis=1, dtype=np.float64)
-        gaussian_filter = scipy.signal.windows.gaussian(200,20)
-        filtered_slice = scipy.signal.convolve(vertical_slice, gaussian_filter,
-                                                mode='same')
-        center_row = float(np.argmax(filtered_slice))
-        self.ffind_calibration()
-        return center_row
+        gaussian_filter = gaussian(200,20)
+        filtered_slice = convolve(vertical_slice, gaussian_filter, mode='same')
+        return float(np.argmax(filtered_slice))
+
+    def fcalibration_signature(self):
+        '''Everything the calibration depends on, as a JSON string.
+
+        Includes the size and modification time of the data files, so
+        editing setup.cfg or a spectrum invalidates cached calibrations.
+        '''
+        data_files = sorted((f.name, f.stat().st_size, f.stat().st_mtime_ns)
+                            for f in data_path.iterdir() if f.is_file())
+        return json.dumps({
+            'version': CALIBRATION_CACHE_VERSION,
+            'filters': sorted([f.name, t] for f, t in self.filters.items()),
+            'sample_material': self.sample_material.name,
+            'scintillator_material': self.scintillator_material.name,
+            'scintillator_thickness': float(self.scintillator_thickness),
+            'ref_trans': self.ref_trans,
+            'threshold_trans': self.threshold_trans,
+            'data_files': data_files,
+            }, sort_keys=True)
+
+    def fcache_path(self, *extra):
+        '''Cache file for this calibration, optionally specialized by *extra*.'''
+        key = hashlib.sha1(self.fcalibration_signature().encode())
+        name = 'bh_' + key.hexdigest()[:20]
+        if extra:
+            name += '_' + hashlib.sha1(json.dumps(extra).encode()).hexdigest()[:12]
+        return self.cache_dir / (name + '.npz')
+
+    def fload_calibration(self):
+        '''Load the calibration from the cache.  Returns False if it is not there.'''
+        if self.cache_dir is None:
+            return False
+        path = self.fcache_path()
+        try:
+            with np.load(path) as cache:
+                if str(cache['signature']) != self.fcalibration_signature():
+                    return False
+                self.fbuild_splines(cache['centerline_trans'], cache['centerline_thickness'],
+                                    cache['angles_urad'], cache['cal_curve'])
+        except (OSError, KeyError, ValueError):
+            return False
+        log.info('  *** *** beam hardening calibration loaded from {:s}'.format(str(path)))
+        return True
+
+    def fsave_calibration(self):
+        '''Store the calibration points in the cache.'''
+        if self.cache_dir is None:
+            return
+        path = self.fcache_path()
+        _save_cache(path, signature=self.fcalibration_signature(),
+                    centerline_trans=self.centerline_points[0],
+                    centerline_thickness=self.centerline_points[1],
+                    angles_urad=self.angular_points[0], cal_curve=self.angular_points[1])
+        log.info('  *** *** beam hardening calibration saved to {:s}'.format(str(path)))
+
+    def fbuild_splines(self, centerline_trans, centerline_thickness, angles_urad, cal_curve):
+        '''Make the centerline and angular splines from their calibration points.'''
+        self.centerline_points = (np.asarray(centerline_trans), np.asarray(centerline_thickness))
+        self.angular_points = (np.asarray(angles_urad), np.asarray(cal_curve))
+        self.centerline_spline = InterpolatedUnivariateSpline(*self.centerline_points, ext='const')
+        self.angular_spline = InterpolatedUnivariateSpline(*self.angular_points)
+
+    def fbuild_lut(self, size, log_start):
+        '''Sample the centerline spline into a PathlengthLUT.
+
+        The table is only used if it matches the spline to LUT_TOLERANCE.
+        '''
+        trans = self.centerline_points[0]
+        lut = PathlengthLUT(self.centerline_spline, trans[0], trans[-1], size, log_start)
+        error = lut.fvalidate(self.centerline_spline)
+        if error > LUT_TOLERANCE:
+            log.warning('  *** *** beam hardening LUT error {:.2e} above {:.0e}, use the spline'
+                        .format(error, LUT_TOLERANCE))
+            return
+        log.info('  *** *** beam hardening LUT with {:d} points, error {:.2e}'.format(size, error))
+        self.lut = lut
+
+    def fcorrection_factors(self, rows):
+        '''Angular correction factors for detector rows rows[0]:rows[1].
+
+        Kept in memory and in the cache, keyed by the center row and the
+        geometry as well as the calibration.  The table covers rows from 0
+        on, so chunks of fewer rows, as in a vertical range, share it.
+        '''
+        geometry = (float(self.center_row), float(self.pixel_size), float(self.d_source))
+        factors = self.row_factors.get(geometry)
+        if factors is not None and factors.size >= rows[1]:
+            return factors[rows[0]:rows[1]]
+        key = geometry + (0, int(rows[1]))
+        path = self.fcache_path(*key) if self.cache_dir is not None else None
+        factors = None
+        if path is not None and path.exists():
+            try:
+                with np.load(path) as cache:
+                    factors = cache['factors']
+            except (OSError, KeyError, ValueError):
+                pass
+        if factors is None:
+            angles = np.abs(np.arange(0, rows[1]) - self.center_row)
+            angles *= self.pixel_size / self.d_source
+            log.info("  *** *** angles from {0:f} to {1:f} urad".format(angles[rows[0]], angles[-1]))
+            factors = self.angular_spline(angles).astype(np.float32)
+            if path is not None:
+                _save_cache(path, factors=factors)
+        self.row_factors[geometry] = factors
+        return factors[rows[0]:rows[1]]
     
     def ffind_calibration(self):
         """Do the correlation at the reference transmission.  Treat the
         angular dependence as a correction on the thickness vs.
         transmission at angle = 0.
         
+        The effective transmission of every sample thickness at every
+        angle is computed at once, see fcompute_effective_transmission.
         """
-        angles_urad = []
+        angles_urad = np.array(sorted(self.spectra_dict.keys()), dtype=np.float64)
+        #Filter the beam
+        spectra = [fapply_filters(self.filters, self.spectra_dict[angle]) for angle in angles_urad]
+        energies = spectra[0].energies
+        if all(np.array_equal(spectrum.energies, energies) for spectrum in spectra):
+            trans = self.fcompute_effective_transmission(
+                            energies, np.stack([spectrum.spectral_power for spectrum in spectra]))
+        else:
+            trans = np.concatenate([self.fcompute_effective_transmission(
+                            spectrum.energies, spectrum.spectral_power[None]) for spectrum in spectra])
         cal_curve = []
-        for angle in sorted(self.spectra_dict.keys()):
-            angles_urad.append(float(angle))
-            spectrum = self.spectra_dict[angle]
-            #Filter the beam
-            filtered_spectrum = fapply_filters(self.filters, spectrum)
+        for angle, angle_trans in zip(angles_urad, trans):
             #Create an interpolation function based on this
-            angle_spline = self.ffind_calibration_one_angle(filtered_spectrum)
+            usable_trans, usable_thicknesses = self.fusable_calibration_points(angle_trans)
+            angle_spline = InterpolatedUnivariateSpline(usable_trans, usable_thicknesses, ext='const')
             if angle  == 0:
-                self.centerline_spline = angle_spline
+                centerline_points = (usable_trans, usable_thicknesses)
             cal_curve.append(angle_spline(self.ref_trans))
-        cal_curve /= cal_curve[0]
-        self.angular_spline = InterpolatedUnivariateSpline(angles_urad, cal_curve) 
+        cal_curve = np.array(cal_curve) / cal_curve[0]
+        self.fbuild_splines(*centerline_points, angles_urad, cal_curve)
+
+    def fcompute_effective_transmission(self, energies, spectral_powers):
+        """Effective transmission of the sample thicknesses as seen by the scintillator.
+
+        Parameters
+        ==========
+        energies : np.ndarray
+          energy grid in keV, shared by all spectra
+        spectral_powers : np.ndarray
+          incident spectra, (nspectra, energies.size)
+
+        Returns
+        =======
+        np.ndarray
+          ratio of the power absorbed in the scintillator with and without
+          the sample, (nspectra, SAMPLE_THICKNESSES.size)
+
+        """
+        weights = simpson_weights(energies)
+        # Integrand of the absorbed power in the scintillator, times the quadrature weights
+        detected = (spectral_powers * self.scintillator_material.fcompute_absorbed_fraction(
+                            self.scintillator_thickness, energies))
+        absorbed_power = detected @ weights
+        sample_trans = self.sample_material.fcompute_transmission_matrix(SAMPLE_THICKNESSES, energies)
+        detected_power = (detected * weights) @ sample_trans.T
+        return detected_power / absorbed_power[:, None]
+
+    def fusable_calibration_points(self, sample_effective_trans):
+        """Calibration points above the transmission threshold, sorted by transmission."""
+        return fusable_calibration_points(sample_effective_trans, self.threshold_trans)
     
     def ffind_calibration_one_angle(self, input_spectrum):
-        '''Makes a scipy interpolation function to be used to correct images.
-        
+        '''Computes the points of the transmission to thickness calibration.
+
+        Returns the effective transmissions, in ascending order, and the
+        corresponding sample thicknesses.
         '''
-        # Make an array of sample thicknesses
-        sample_thicknesses = np.sort(np.concatenate((-np.logspace(1,0,21), [0], np.logspace(-1,4.5,441))))
-        # For each thickness, compute the absorbed power in the scintillator
-        detected_power = np.zeros_like(sample_thicknesses)
-        for i in range(sample_thicknesses.size):
-            sample_filtered_power = self.sample_material.fcompute_transmitted_spectrum(sample_thicknesses[i],
-                                                                                  input_spectrum)
-            detected_power[i] = self.scintillator_material.fcompute_absorbed_power(self.scintillator_thickness,
-                                                                                   sample_filtered_power)
-        # Compute an effective transmission vs. thickness
-        absorbed_power = self.scintillator_material.fcompute_absorbed_power(self.scintillator_thickness,
-                                                                            input_spectrum)
-        sample_effective_trans = detected_power / absorbed_power
-        # Threshold the transmission we accept to keep the spline from getting unstable
-        usable_trans = sample_effective_trans[sample_effective_trans > self.threshold_trans]
-        usable_thicknesses = sample_thicknesses[sample_effective_trans > self.threshold_trans]
-        # Return a spline, but make sure things are sorted in ascending order
-        inds = np.argsort(usable_trans)
-        return InterpolatedUnivariateSpline(usable_trans[inds], usable_thicknesses[inds], ext='const')
-
-    def fcorrect_as_pathlength_centerline(self, input_trans):
+        trans = self.fcompute_effective_transmission(input_spectrum.energies,
+                                                     input_spectrum.spectral_power[None])
+        return self.fusable_calibration_points(trans[0])
+
+    def fcorrect_as_pathlength_centerline(self, input_trans, out=None):
         """Corrects for the beam hardening, assuming we are in the ring plane.
 
         Parameters
         ==========
         input_trans : np.ndarray
           transmission
+        out : np.ndarray, optional
+          float32 array for the result when the lookup table is used.  May
+          be *input_trans* itself to convert in place.
 
         Returns
         =======
@@ -410,10 +813,51 @@ class BeamSoftener():
           sample pathlength in microns.
 
         """
-        data_dtype = input_trans.dtype
+        if self.lut is not None:
+            return self.lut(input_trans, out=out)
         pathlength = mproc.distribute_jobs(input_trans, self.centerline_spline, args=(), axis=1)
         return pathlength
 
+    def fcorrect_chunk(self, data, rows, threads=0, block=1 << 16):
+        """Converts a chunk of transmission images to corrected pathlength in place.
+
+        Fuses the centerline conversion and the angular correction factor
+        of each row into one pass, run on blocks of image rows by
+        util.run_blocks.
+
+        Parameters
+        ==========
+        data : np.ndarray
+          C-contiguous float32 transmission, (nproj, nrows, ncols) or
+          (nrows, ncols).  Overwritten with the pathlength in microns.
+        rows : tuple
+          detector rows (start, end) of the chunk
+        threads : int
+          number of threads, 0 for one per core
+
+        Returns
+        =======
+        data : np.ndarray
+
+        """
+        start_time = time.perf_counter()
+        factors = self.fcorrection_factors(rows)[:, None]
+        chunk = data.reshape((-1,) + data.shape[-2:])
+
+        def correct_block(p, r0, r1):
+            trans = chunk[p, r0:r1]
+            if self.lut is not None:
+                self.lut(trans, out=trans)
+            else:
+                trans[...] = self.centerline_spline(trans)
+            trans *= factors[r0:r1]
+
+        util.run_blocks(chunk.shape, correct_block, threads, block)
+        elapsed = time.perf_counter() - start_time
+        log.info('  *** *** beam hardening correction {:.1f} MB/s'
+                    .format(data.nbytes / 2**20 / max(elapsed, 1e-9)))
+        return data
+
     def fcorrect_as_pathlength(self, input_trans):
         '''Corrects for the angular dependence of the BM spectrum.
         First, use fconvert_data to get in terms of pathlength assuming we are
@@ -424,3 +868,160 @@ class BeamSoftener():
         correction_factor = self.angular_spline(angles)
         return self.centerline_spline(input_trans) * correction_factor[:,None]
     
+
+
+def _save_cache(path, **arrays):
+    '''Write *arrays* to the .npz file *path* atomically.
+
+    Several processes may build the same calibration at once, so the file
+    is written under a temporary name and renamed into place.
+    '''
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name('{:s}.{:d}.tmp'.format(path.stem, os.getpid()))
+        with open(tmp_path, 'wb') as tmp_file:
+            np.savez(tmp_file, **arrays)
+        os.replace(tmp_path, path)
+    except OSError as err:
+        log.warning('  *** *** could not write beam hardening cache {:s}: {}'.format(str(path), err))
+
+
+def get_softener(params):
+    '''The BeamSoftener for *params*, built on first use and then reused.
+
+    One softener is kept per file and beam hardening setup, so a merge
+    builds it once instead of once per projection chunk.
+    '''
+    key = (str(params.file_name), int(params.binning), params.beam_hardening_cache_dir,
+            params.scintillator_material, params.scintillator_thickness, params.sample_material,
+            params.filter_1_material, params.filter_1_thickness, params.filter_2_material,
+            params.filter_2_thickness, params.filter_3_material, params.filter_3_thickness,
+            params.source_distance, params.pixel_size, params.beam_hardening_engine,
+            params.beam_hardening_lut_size, params.beam_hardening_lut_log_start)
+    with _softeners_lock:
+        softener = _softeners.get(key)
+        if softener is None:
+            softener = BeamSoftener(params)
+            _softeners[key] = softener
+        else:
+            params.center_row = softener.center_row
+    return softener
+
+
+def fcalibrate_batch(filter_sets, scintillators, sample_materials, cache_dir=None, config_filename=None):
+    '''Calibrate every combination of filters, scintillator and sample material at once.
+
+    Parameters
+    ==========
+    filter_sets : list of dict
+      each maps filter symbols to thicknesses in um
+    scintillators : list of tuple
+      (symbol, thickness in um) of each scintillator
+    sample_materials : list of str
+      sample material symbols
+    cache_dir : path, optional
+      cache of the parsed material tables
+    config_filename : path, optional
+      alternative to setup.cfg
+
+    Returns
+    =======
+    dict
+      'angles_urad' and 'sample_thicknesses' (the grids),
+      'effective_transmission' (filters, scintillators, samples, angles,
+      thicknesses), 'ref_pathlength', the pathlength at the reference
+      transmission, and 'angular_correction', that pathlength relative to
+      the ring plane (filters, scintillators, samples, angles).
+
+    All spectra must share one energy grid.  The scintillator signal of
+    every configuration and angle is one row of a matrix, and a single
+    matrix product with each sample's thickness x energy transmission
+    gives all the calibration curves.
+    '''
+    densities, ref_trans, threshold_trans = fread_setup(config_filename)
+    materials = LazyMaterials(cache_dir)
+    materials.densities.update(densities)
+    spectra = fread_spectra(cache_dir)
+    angles_urad = np.array(sorted(spectra), dtype=np.float64)
+    energies = spectra[angles_urad[0]].energies
+    if not all(np.array_equal(spectrum.energies, energies) for spectrum in spectra.values()):
+        raise ValueError('Batch calibration needs all spectra on the same energy grid')
+    power = np.stack([spectra[angle].spectral_power for angle in angles_urad])
+    weights = simpson_weights(energies)
+
+    filter_trans = np.ones((len(filter_sets), energies.size))
+    for i, filter_set in enumerate(filter_sets):
+        for symbol, thickness in filter_set.items():
+            if symbol != 'none' and thickness != 0:
+                filter_trans[i] *= materials[symbol].fcompute_transmission_matrix([thickness], energies)[0]
+    scint_absorbed = np.stack([materials[symbol].fcompute_absorbed_fraction(thickness, energies)
+                               for symbol, thickness in scintillators])
+    # Weighted scintillator signal without sample, (filters, scintillators, angles, energies)
+    detected = (filter_trans[:, None, None, :] * scint_absorbed[None, :, None, :]
+                * power[None, None] * weights)
+    absorbed_power = detected.sum(axis=-1)
+    sample_trans = np.stack([materials[symbol].fcompute_transmission_matrix(SAMPLE_THICKNESSES, energies)
+                             for symbol in sample_materials])
+    detected_power = np.matmul(detected.reshape(1, -1, energies.size), sample_trans.transpose(0, 2, 1))
+    shape = detected.shape[:3]
+    detected_power = detected_power.reshape((len(sample_materials),) + shape + (SAMPLE_THICKNESSES.size,))
+    trans = np.moveaxis(detected_power, 0, 2) / absorbed_power[:, :, None, :, None]
+
+    ref_pathlength = np.empty(trans.shape[:-1])
+    for index in np.ndindex(*ref_pathlength.shape):
+        points = fusable_calibration_points(trans[index], threshold_trans)
+        ref_pathlength[index] = InterpolatedUnivariateSpline(*points, ext='const')(ref_trans)
+    return {
+        'angles_urad': angles_urad,
+        'sample_thicknesses': SAMPLE_THICKNESSES,
+        'effective_transmission': trans,
+        'ref_pathlength': ref_pathlength,
+        'angular_correction': ref_pathlength / ref_pathlength[..., :1],
+        }
+
+
+def fparse_sweep(text):
+    '''Parse "symbol:t1,t2 symbol2:t3" into [(symbol, [t1, t2]), (symbol2, [t3])].'''
+    sweep = []
+    for item in text.replace(';', ' ').split():
+        symbol, _, thicknesses = item.partition(':')
+        if not thicknesses:
+            raise ValueError('No thicknesses given for {:s} in "{:s}"'.format(symbol, text))
+        sweep.append((symbol, [float(t) for t in thicknesses.split(',')]))
+    return sweep
+
+
+def calibrate(params):
+    '''Run a batch calibration from the calibrate options and write it to HDF5.
+
+    Every combination of the filter thicknesses in --calibrate-filters is
+    one filter set.  All filter sets are combined with all scintillators
+    and sample materials.
+    '''
+    filter_sweep = fparse_sweep(params.calibrate_filters)
+    filter_symbols = [symbol for symbol, thicknesses in filter_sweep]
+    filter_grid = np.array(np.meshgrid(*[thicknesses for symbol, thicknesses in filter_sweep],
+                                       indexing='ij')).reshape(len(filter_sweep), -1).T
+    filter_sets = [dict(zip(filter_symbols, row)) for row in filter_grid]
+    scintillators = [(symbol, thickness) for symbol, thicknesses in fparse_sweep(params.calibrate_scintillators)
+                        for thickness in thicknesses]
+    sample_materials = params.calibrate_samples.replace(',', ' ').split()
+    cache_dir = None
+    if params.beam_hardening_cache_dir.lower() != 'none':
+        cache_dir = Path(params.beam_hardening_cache_dir)
+    log.info('  *** calibrate {:d} filter sets x {:d} scintillators x {:d} samples'
+                .format(len(filter_sets), len(scintillators), len(sample_materials)))
+    start_time = time.perf_counter()
+    result = fcalibrate_batch(filter_sets, scintillators, sample_materials, cache_dir)
+    log.info('  *** *** {:d} configurations in {:.2f} s'.format(
+                len(filter_sets) * len(scintillators) * len(sample_materials),
+                time.perf_counter() - start_time))
+    with h5py.File(params.calibrate_output, 'w') as hdf_file:
+        for name, value in result.items():
+            hdf_file[name] = value
+        hdf_file['filter_thicknesses'] = filter_grid
+        hdf_file['filter_thicknesses'].attrs['materials'] = filter_symbols
+        hdf_file['scintillator_materials'] = [symbol for symbol, thickness in scintillators]
+        hdf_file['scintillator_thicknesses'] = [thickness for symbol, thickness in scintillators]
+        hdf_file['sample_materials'] = sample_materials
+    log.info('  *** *** calibrations saved to {:s}'.format(str(params.calibrate_output)))
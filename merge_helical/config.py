@@ -12,6 +12,7 @@ from collections import OrderedDict
 from merge_helical import log, util
 
 LOGS_HOME = os.path.join(str(Path.home()), 'logs')
+BH_CACHE_HOME = os.path.join(str(Path.home()), '.merge_helical', 'beam_hardening')
 CONFIG_FILE_NAME = os.path.join(str(Path.home()), 'merge_helical.conf')
 bh_data_path = Path(__file__).parent.joinpath('beam_hardening_data')
 
@@ -57,6 +58,120 @@ SECTIONS['helical'] = {
         'default': 1,
         'type': int,
         'help': 'Number of rows to pad when doing subpixel shifts.'},
+    'backend': {
+        'default': 'auto',
+        'type': str,
+        'help': 'Array backend for the subpixel shifts. auto uses cupy if a GPU is available.',
+        'choices': ['auto', 'numpy', 'cupy']},
+    'fft-workers': {
+        'default': 0,
+        'type': int,
+        'help': 'Number of FFT worker threads for the numpy backend (0: all cores).'},
+    'shift-method': {
+        'default': 'fft2',
+        'type': str,
+        'help': 'Kernel for the subpixel shifts. fft2 is the full 2D FFT shift. fft (1D FFT along the rows), '
+                'cubic and linear are faster approximations; fft is not equivalent to fft2 for high-frequency '
+                'content, with the largest differences in the Nyquist row.',
+        'choices': ['fft2', 'fft', 'cubic', 'linear', 'integer']},
+    'shift-tolerance': {
+        'default': 0.0,
+        'type': float,
+        'help': 'Projections with a fractional shift below this many rows are not interpolated (0: interpolate all).'},
+    'shift-cache-size': {
+        'default': 4096,
+        'type': int,
+        'help': 'Number of FFT phase ramps kept in the shift cache.'},
+    'pipeline-depth': {
+        'default': 2,
+        'type': int,
+        'help': 'Number of projection chunks queued between reading, computing and writing (0: run serially).'},
+    'pipeline-workers': {
+        'default': 1,
+        'type': int,
+        'help': 'Number of threads preprocessing and shifting projection chunks.'},
+    'nprocs': {
+        'default': 1,
+        'type': int,
+        'help': 'Number of worker processes. Each merges part of the projections into a partial output in the scratch directory.'},
+    'accumulator': {
+        'default': 'memory',
+        'type': str,
+        'help': 'Where to sum the shifted projections. memmap uses a scratch file, hdf5 adds each projection directly to the output file.',
+        'choices': ['memory', 'memmap', 'hdf5']},
+    'accumulator-max-memory': {
+        'default': 8.0,
+        'type': float,
+        'help': 'Memory budget in GB for the output accumulator. Larger outputs are merged in windows of angles.'},
+    'scratch-dir': {
+        'default': '',
+        'type': str,
+        'help': 'Directory for the memmap accumulator scratch file, ideally on local SSD (default: system temp dir).',
+        'metavar': 'PATH'},
+    'scratch-max-size': {
+        'default': 0.0,
+        'type': float,
+        'help': 'Largest scratch file in GB the memmap accumulator may create (0: no limit).'},
+    'checkpoint-angles': {
+        'default': 256,
+        'type': int,
+        'help': 'Largest window of output angles written and committed to the journal at a time (0: no limit).'},
+    'resume': {
+        'default': False,
+        'help': 'Resume an interrupted merge from its journal, skipping the windows it already wrote.',
+        'action': 'store_true'},
+    'z-start': {
+        'default': 0.0,
+        'type': float,
+        'help': 'Start of the vertical range of the merged volume to compute, in z-units from its first row.'},
+    'z-end': {
+        'default': -1.0,
+        'type': float,
+        'help': 'End of the vertical range of the merged volume to compute, exclusive (negative: to the last row).'},
+    'z-units': {
+        'default': 'rows',
+        'type': str,
+        'help': 'Units of z-start and z-end: output rows, or mm of stage travel.',
+        'choices': ['rows', 'mm']},
+    'x-start': {
+        'default': 0,
+        'type': int,
+        'help': 'First detector column to merge. With --shift-method fft2 the merged columns are not identical '
+                'to the same columns of a full width merge.'},
+    'x-end': {
+        'default': -1,
+        'type': int,
+        'help': 'End of the detector columns to merge, exclusive (negative: to the last column).'},
+    'x-auto': {
+        'default': False,
+        'help': 'Find the columns the sample occupies from a flat corrected preview, instead of x-start and x-end.',
+        'action': 'store_true'},
+    'x-auto-threshold': {
+        'default': 0.05,
+        'type': float,
+        'help': 'Attenuation (minus log of the transmission) above which a column belongs to the sample for x-auto.'},
+    'x-auto-margin': {
+        'default': 16,
+        'type': int,
+        'help': 'Columns kept on each side of the sample for x-auto.'},
+    'follow': {
+        'default': False,
+        'help': 'Merge a scan while it is acquired: read the raw file in SWMR mode and merge projections as they are appended. '
+                'The merged volume is kept in memory, up to accumulator-max-memory.',
+        'action': 'store_true'},
+    'follow-marker': {
+        'default': '/process/acquisition/end_date',
+        'type': str,
+        'help': 'Dataset that marks the end of the scan for --follow once it holds a non-empty value. '
+                'SWMR writers cannot create objects, so it must exist when the scan starts.'},
+    'follow-interval': {
+        'default': 5.0,
+        'type': float,
+        'help': 'Seconds between checks for new projections with --follow.'},
+    'follow-timeout': {
+        'default': 600.0,
+        'type': float,
+        'help': 'Seconds without new projections after which --follow merges what it has (0: wait forever).'},
         }
 
 
@@ -145,6 +260,20 @@ SECTIONS['flat-correction'] = {
         'default': float('inf'),
         'help': "Limit the maximum value allowed in the singogram.",
         'type': float},
+    'reference-block-size': {
+        'default': 256.0,
+        'type': float,
+        'help': "Memory in MB used at a time to median filter the flat and dark images"},
+    'preprocessing-engine': {
+        'default': 'fused',
+        'type': str,
+        'help': "Run flat correction, minus log and clean up as separate passes (staged) "
+                "or in one multithreaded pass (fused).  The air flat correction is always staged",
+        'choices': ['fused', 'staged']},
+    'preprocessing-threads': {
+        'default': 0,
+        'type': int,
+        'help': 'Number of threads for the fused preprocessing (0: one per core)'},
 }
 
 SECTIONS['retrieve-phase'] = {
@@ -185,6 +314,28 @@ SECTIONS['beam-hardening']= {
         'type': str,
         'help': "Beam hardening method.",
         'choices':['none','standard']},
+    'beam-hardening-cache-dir': {
+        'default': BH_CACHE_HOME,
+        'type': str,
+        'help': 'Directory for cached beam hardening calibrations, or "none" to disable the cache',
+        'metavar': 'PATH'},
+    'beam-hardening-engine': {
+        'default': 'spline',
+        'type': str,
+        'help': 'Conversion of transmission to pathlength: evaluate the spline, or a dense lookup table sampled from it',
+        'choices': ['spline', 'lut']},
+    'beam-hardening-lut-size': {
+        'default': 65536,
+        'type': int,
+        'help': 'Number of points in the beam hardening lookup table'},
+    'beam-hardening-lut-log-start': {
+        'default': 0.05,
+        'type': float,
+        'help': 'Transmission below which the lookup table points are log-spaced'},
+    'beam-hardening-threads': {
+        'default': 0,
+        'type': int,
+        'help': 'Number of threads for the beam hardening correction (0: one per core)'},
     'source-distance': {
         'default': 36.0,
         'type': float,
@@ -245,11 +396,75 @@ SECTIONS['beam-hardening']= {
         'help': 'Filter 3 thickness for beam hardening'},
     }
 
+SECTIONS['output'] = {
+    'output-chunks': {
+        'default': 'auto',
+        'type': str,
+        'help': 'Chunk shape of the merged data as "angles,rows,columns", "auto", or "none" for contiguous.'},
+    'output-compression': {
+        'default': 'none',
+        'type': str,
+        'help': 'Compression filter for the merged data.',
+        'choices': ['none', 'gzip', 'lzf']},
+    'output-compression-level': {
+        'default': 4,
+        'type': int,
+        'help': 'gzip compression level for the merged data.'},
+    'output-shuffle': {
+        'default': False,
+        'help': 'When set, apply the shuffle filter before compression.',
+        'action': 'store_true'},
+    'output-chunk-cache': {
+        'default': 0.0,
+        'type': float,
+        'help': 'HDF5 chunk cache for the merged file in MB (0: sized to the chunk layout).'},
+    'metadata-compression': {
+        'default': 'none',
+        'type': str,
+        'help': 'Compression of large meta data datasets copied to the merged file. Smaller ones are copied as they are.',
+        'choices': ['none', 'gzip', 'lzf']},
+    'metadata-stream-size': {
+        'default': 64.0,
+        'type': float,
+        'help': 'Meta data datasets above this size in MB are streamed, and compressed if metadata-compression is set.'},
+    'sinogram-output': {
+        'default': 'none',
+        'type': str,
+        'help': 'Also write the merged data in sinogram order, (rows, angles, columns), for reconstruction '
+                'by slices: as /exchange/data_sinogram in the merged file (dataset), or in a separate '
+                '_sino.h5 file that /exchange/data_sinogram links to (file).',
+        'choices': ['none', 'dataset', 'file']},
+    'sinogram-block-size': {
+        'default': 256.0,
+        'type': float,
+        'help': "Memory in MB used at a time to transpose the merged data to sinograms"},
+}
+
+SECTIONS['calibrate'] = {
+    'calibrate-filters': {
+        'default': 'Cu:0,100,250,500',
+        'type': str,
+        'help': 'Filter thicknesses to sweep in um, as "symbol:t1,t2,... symbol:...". Every combination is one filter set.'},
+    'calibrate-scintillators': {
+        'default': 'LuAG_Ce:100',
+        'type': str,
+        'help': 'Scintillator thicknesses to sweep in um, as "symbol:t1,t2,... symbol:..."'},
+    'calibrate-samples': {
+        'default': 'Fe',
+        'type': str,
+        'help': 'Comma separated sample materials to calibrate'},
+    'calibrate-output': {
+        'default': 'beam_hardening_calibration.h5',
+        'type': str,
+        'help': 'HDF5 file for the calibration results',
+        'metavar': 'FILE'},
+    }
+
 ALL_PARAMS = ('helical', 'file-reading', 'zinger-removal', 
-                'flat-correction', 'retrieve-phase', 'beam-hardening')
+                'flat-correction', 'retrieve-phase', 'beam-hardening', 'output')
 
 NICE_NAMES = ('General', 'Helical', 'File Reading', 'Zinger Removal', 
-                'Flat Correction', 'Phase Retrieval', 'Beam Hardening', )
+                'Flat Correction', 'Phase Retrieval', 'Beam Hardening', 'Output', 'Calibrate')
 
 def get_config_name():
     """Get the command line --config option."""
@@ -319,12 +534,15 @@ def param_from_dxchange(hdf_file, data_path, attr=None, scalar=True, char_array=
     """
     Reads a parameter from the HDF file.
     Inputs
-    hdf_file: string path or pathlib.Path object for the HDF file.
+    hdf_file: string path or pathlib.Path object for the HDF file, or a
+        file_io.MetadataSnapshot of it.
     data_path: path to the requested data in the HDF file.
     attr: name of the attribute if this is stored as an attribute (default: None)
     scalar: True if the value is a single valued dataset (dafault: True)
     char_array: if True, interpret as a character array.  Useful for EPICS strings (default: False)
     """
+    if hasattr(hdf_file, 'param'):
+        return hdf_file.param(data_path, attr, scalar, char_array)
     if not os.path.isfile(hdf_file):
         return None
     with h5py.File(hdf_file,'r') as f:
@@ -1,13 +1,14 @@
 import os
 import logging
+import hashlib
 from pathlib import Path
 import collections
 import re
+import threading
 from typing import List
 
 import h5py
 import tomopy
-import dxchange
 import dxchange.reader as dxreader
 import dxfile.dxtomo as dx
 import numpy as np
@@ -15,6 +16,7 @@ import yaml
 
 from merge_helical import config
 from merge_helical import beamhardening
+from merge_helical import handle_hdf
 
 __author__ = "Francesco De Carlo, Viktor Nikitin, Alan Kastengren, Mark Wolfman"
 __credits__ = "Pavel Shevchenko"
@@ -22,7 +24,8 @@ __copyright__ = "Copyright (c) 2020, UChicago Argonne, LLC."
 __docformat__ = 'restructuredtext en'
 __all__ = ['read_tomo', 'blocked_view', 'binning', 'flip_and_stitch', 'patch_projection', 
            'get_dx_dims', 'file_base_name', 'path_base_name', 'auto_read_dxchange', 'read_rot_center', 
-           'read_filter_materials', 'read_filter_materials_tomoscan', 'read_pixel_size', 
+           'read_references', 'clear_reference_cache', 'MetadataSnapshot', 'metadata', 'ProjectionReader',
+           'read_preview', 'read_filter_materials', 'read_filter_materials_tomoscan', 'read_pixel_size', 
            'read_scintillator', 'read_bright_ratio', 'check_item_exists_hdf', 'convert', 
            'write_hdf5', 'yaml_file_list']
 
@@ -77,21 +80,290 @@ def _read_theta_size(params):
 def _read_tomo(params, sino, proj):
 
     if (str(params.file_format) in {'dx', 'aps2bm', 'aps7bm', 'aps32id'}):
-        proj, flat, dark, theta = dxchange.read_aps_32id(params.file_name, sino=sino, proj=proj)
+        with h5py.File(params.file_name, 'r') as hdf_file:
+            data = hdf_file['/exchange/data'][proj[0]:proj[1], sino[0]:sino[1]]
+            theta = _read_theta(hdf_file)
         log.info("  *** %s is a valid dx file format" % params.file_name)
-        # Check if the flat and dark fields are single images or sets
-        if len(flat.shape) == len(proj.shape):
-            log.info('  *** median filter flat images')
-            # Do a median filter on the first dimension
-            flat = np.median(flat, axis=0, keepdims=True).astype(flat.dtype) 
-        if len(dark.shape) == len(proj.shape):
-            log.info('  *** median filter dark images')
-            # Do a median filter on the first dimension
-            dark = np.median(dark, axis=0, keepdims=True).astype(dark.dtype) 
+        flat, dark = read_references(params, sino)
     else:
         log.error("  *** %s is not a supported file format" % params.file_format)
         exit()
-    return proj, flat, dark, theta
+    return data, flat, dark, theta
+
+
+def _read_theta(hdf_file):
+    '''Projection angles in radians, as returned by dxchange.read_aps_32id.'''
+    if '/exchange/theta' in hdf_file:
+        return np.deg2rad(hdf_file['/exchange/theta'][...])
+    ntheta = hdf_file['/exchange/data'].shape[0]
+    log.warning('  *** no theta in file, assume 0 to 180 degrees')
+    return np.linspace(0, np.pi, ntheta)
+
+
+# Median filtered flat and dark images, keyed by _reference_key
+_reference_cache = {}
+
+
+def clear_reference_cache():
+    _reference_cache.clear()
+
+
+def _reference_key(dset):
+    '''Identify a reference image stack by its shape, dtype and first and last frames.
+
+    Files of one scan series that share the same flat or dark acquisition
+    get the same key, so the median is only computed once for all of them.
+    '''
+    digest = hashlib.sha1()
+    digest.update(repr((dset.shape, dset.dtype.str)).encode())
+    if dset.ndim == 3 and dset.shape[0] > 0:
+        digest.update(np.ascontiguousarray(dset[0]).data)
+        digest.update(np.ascontiguousarray(dset[-1]).data)
+    else:
+        digest.update(np.ascontiguousarray(dset[...]).data)
+    return digest.hexdigest()
+
+
+def _median_reference(dset, block_bytes):
+    '''Median over the first axis of a reference stack, one block of rows at a time.
+
+    Only about *block_bytes* of the stack are in memory at once.  Returns
+    a (1, nrows, ncols) array of the stack dtype.
+    '''
+    if dset.ndim == 2:
+        return dset[...][None]
+    [nimages, nrows, ncols] = dset.shape
+    rows = int(max(1, min(nrows, block_bytes // max(1, nimages * ncols * dset.dtype.itemsize))))
+    median = np.empty((1, nrows, ncols), dtype=dset.dtype)
+    for st in range(0, nrows, rows):
+        end = min(st + rows, nrows)
+        median[0, st:end] = np.median(dset[:, st:end], axis=0)
+    return median
+
+
+def read_references(params, sino, cols=None):
+    '''Median filtered flat and dark images for rows sino[0]:sino[1].
+
+    Only columns cols[0]:cols[1] if *cols* is given.
+
+    The full images are computed on first use and kept for the rest of the
+    run, so every projection chunk and every file that shares the same
+    references reuses them.  Returns copies, so callers may modify them.
+    '''
+    block_bytes = int(params.reference_block_size * 2**20)
+    references = []
+    with handle_hdf.raw_file(params) as hdf_file:
+        for name in ('data_white', 'data_dark'):
+            dset = hdf_file['/exchange/' + name]
+            if hdf_file.swmr_mode:
+                # Other handles to the file in this process share its cached meta data
+                dset.refresh()
+            key = _reference_key(dset)
+            if key not in _reference_cache:
+                log.info('  *** median filter {:s} images'.format(name))
+                _reference_cache[key] = _median_reference(dset, block_bytes)
+            cols = (0, dset.shape[-1]) if cols is None else cols
+            references.append(_reference_cache[key][:, sino[0]:sino[1], cols[0]:cols[1]].copy())
+    return references
+
+
+def read_preview(params, nproj):
+    '''*nproj* projections spread evenly over the scan, with the flat and dark images.'''
+    with handle_hdf.raw_file(params) as hdf_file:
+        dset = hdf_file['/exchange/data']
+        ntheta, ny = dset.shape[:2]
+        index = np.unique(np.linspace(0, ntheta - 1, min(nproj, ntheta)).astype(int))
+        proj = dset[index]
+    flat, dark = read_references(params, (0, ny))
+    return proj, flat, dark
+
+
+class ProjectionReader:
+    '''Reads chunks of projections into a pool of preallocated buffers.
+
+    Keeps the file open for the whole run and reads each chunk with
+    read_direct straight into a buffer of the dtype of the file (uint16
+    for raw detector data), so nothing is allocated or converted until
+    the normalization makes float32 out of it.  Theta and the flat and
+    dark images are read once.
+
+    A buffer is only handed out again after *release* gives it back, so
+    a chunk is never overwritten while it is still being preprocessed.
+    *nbuffers* should be the number of chunks that can be in flight at
+    once; if more are read, extra buffers are allocated.
+
+    Chunks are detector rows *sino* by default.  Reads of fewer rows
+    within *sino*, at most *nrows*, can be asked for chunk by chunk.  Only
+    columns cols[0]:cols[1] are read, if *cols* is given.
+
+    With --follow the dataset is refreshed before every read, so chunks
+    appended by the acquisition since the file was opened can be read.
+    '''
+    def __init__(self, params, sino, chunk_size, nbuffers=1, nrows=None, cols=None):
+        if str(params.file_format) not in {'dx', 'aps2bm', 'aps7bm', 'aps32id'}:
+            raise ValueError('{:s} is not a supported file format'.format(str(params.file_format)))
+        self.sino = sino
+        self.swmr = getattr(params, 'follow', False)
+        self.hdf_file = handle_hdf.raw_file(params)
+        self.dset = self.hdf_file['/exchange/data']
+        self.theta = _read_theta(self.hdf_file)
+        self.cols = (0, self.dset.shape[2]) if cols is None else cols
+        self.flat, self.dark = read_references(params, sino, self.cols)
+        nrows = sino[1] - sino[0] if nrows is None else nrows
+        shape = (chunk_size, nrows, self.cols[1] - self.cols[0])
+        self.shape = shape
+        self.free = [np.empty(shape, dtype=self.dset.dtype) for i in range(max(1, nbuffers))]
+        # Buffers handed out by read, keyed by id
+        self.in_use = {}
+        self.lock = threading.Lock()
+        log.info('  *** read projections into {:d} {} buffers of {:.1f} MB'
+                    .format(len(self.free), self.dset.dtype, self.free[0].nbytes / 2**20))
+
+    def read(self, proj, rows=None):
+        '''Projections proj[0]:proj[1], flat, dark and theta, like read_tomo.
+
+        Reads detector rows rows[0]:rows[1], or all of *sino* if None.
+        The projections are a view of a free buffer of the pool, which is
+        the caller's until it passes them to *release*.  The flat and dark
+        images are copies, which the caller may modify.
+        '''
+        rows = self.sino if rows is None else rows
+        if self.swmr:
+            self.dset.refresh()
+        with self.lock:
+            if self.free:
+                buffer = self.free.pop()
+            else:
+                log.warning('  *** all {:d} read buffers in use, allocate another'.format(len(self.in_use)))
+                buffer = np.empty(self.shape, dtype=self.dset.dtype)
+            self.in_use[id(buffer)] = buffer
+        shape = (proj[1] - proj[0], rows[1] - rows[0], buffer.shape[2])
+        # A contiguous view of the start of the buffer, as read_direct needs
+        data = buffer.reshape(-1)[:int(np.prod(shape))].reshape(shape)
+        self.dset.read_direct(data, np.s_[proj[0]:proj[1], rows[0]:rows[1], self.cols[0]:self.cols[1]])
+        refs = np.s_[:, rows[0] - self.sino[0]:rows[1] - self.sino[0]]
+        return data, self.flat[refs].copy(), self.dark[refs].copy(), self.theta
+
+    def release(self, proj):
+        '''Give back the buffer of projections *proj* returned by read.'''
+        with self.lock:
+            buffer = self.in_use.pop(id(proj.base), None)
+            if buffer is not None:
+                self.free.append(buffer)
+
+    def close(self):
+        self.hdf_file.close()
+
+
+class MetadataSnapshot:
+    '''In-memory copy of the meta data of an HDF file.
+
+    Opening a file costs tens of milliseconds on a networked file system,
+    and the auto reading of parameters makes dozens of lookups.  The
+    snapshot opens the file once and reads everything under the *groups*
+    in bulk: every dataset with at most *max_size* elements and the
+    attributes of every object.  The shapes of all datasets in the file
+    are recorded too.  Lookups of larger datasets fall back to opening
+    the file.
+
+    Objects whose attributes or values h5py cannot read are left out, and
+    paths the walk does not visit, such as soft links, are looked up in
+    the file.
+
+    Can be passed instead of the file name to check_item_exists_hdf and
+    config.param_from_dxchange.
+    '''
+    GROUPS = ('/measurement', '/measurements', '/process', '/exchange/theta')
+
+    def __init__(self, file_name, groups=GROUPS, max_size=65536, swmr=False):
+        self.file_name = str(file_name)
+        self.open_args = {'libver': 'latest', 'swmr': True} if swmr else {}
+        self.paths = set()
+        self.missing = set()
+        self.shapes = {}
+        self.values = {}
+        self.attrs = {}
+        with h5py.File(self.file_name, 'r', **self.open_args) as hdf_file:
+            def visit(name, obj):
+                path = '/' + name
+                self.paths.add(path)
+                try:
+                    self.attrs[path] = dict(obj.attrs)
+                    if isinstance(obj, h5py.Dataset):
+                        self.shapes[path] = obj.shape
+                        if any(path == g or path.startswith(g + '/') for g in groups) and obj.size <= max_size:
+                            self.values[path] = obj[()]
+                except Exception as err:
+                    log.warning('  *** cannot read {:s} for the meta data snapshot: {}'.format(path, err))
+                    for cache in (self.attrs, self.shapes, self.values):
+                        cache.pop(path, None)
+            hdf_file.visititems(visit)
+
+    def __repr__(self):
+        return 'MetadataSnapshot({:s}, {:d} items)'.format(self.file_name, len(self.paths))
+
+    def _open(self):
+        return h5py.File(self.file_name, 'r', **self.open_args)
+
+    def __contains__(self, path):
+        path = '/' + path.strip('/')
+        if path not in self.paths and path not in self.missing:
+            # Soft links and further hard links to an object are not visited
+            with self._open() as hdf_file:
+                (self.paths if path in hdf_file else self.missing).add(path)
+        return path in self.paths
+
+    def __getitem__(self, path):
+        '''Value of the dataset *path*, read from the file if it is not in the snapshot.'''
+        path = '/' + path.strip('/')
+        if path not in self.values:
+            if path not in self:
+                raise KeyError(path)
+            with self._open() as hdf_file:
+                return hdf_file[path][()]
+        return self.values[path]
+
+    def shape(self, path):
+        path = '/' + path.strip('/')
+        if path not in self.shapes:
+            if path not in self:
+                raise KeyError(path)
+            with self._open() as hdf_file:
+                self.shapes[path] = hdf_file[path].shape
+        return self.shapes[path]
+
+    def attributes(self, path):
+        '''Attributes of *path*, read from the file if it is not in the snapshot.'''
+        path = '/' + path.strip('/')
+        if path not in self.attrs:
+            if path not in self:
+                raise KeyError(path)
+            with self._open() as hdf_file:
+                self.attrs[path] = dict(hdf_file[path].attrs)
+        return self.attrs[path]
+
+    def param(self, data_path, attr=None, scalar=True, char_array=False):
+        '''Same as config.param_from_dxchange, answered from the snapshot.'''
+        try:
+            if attr:
+                return self.attributes(data_path)[attr].decode('ASCII')
+            elif char_array:
+                return ''.join([chr(i) for i in self[data_path][0]]).strip(chr(0))
+            elif scalar:
+                return self[data_path][0]
+            else:
+                return None
+        except KeyError:
+            return None
+
+
+def metadata(params):
+    '''The MetadataSnapshot of params.file_name, made on first use and kept in params.'''
+    snapshot = getattr(params, 'metadata', None)
+    if snapshot is None or snapshot.file_name != str(params.file_name):
+        snapshot = MetadataSnapshot(params.file_name, swmr=getattr(params, 'follow', False))
+        params.metadata = snapshot
+    return snapshot
 
 
 def blocked_view(proj, theta, params):
@@ -295,6 +567,7 @@ def path_base_name(path):
 
 def auto_read_dxchange(params):
     log.info('  *** Auto parameter reading from the HDF file.')
+    metadata(params)
     params = read_pixel_size(params)
     params = read_filter_materials(params)
     params = read_scintillator(params)
@@ -308,7 +581,7 @@ def read_filter_materials(params):
     This discriminates between files created with tomoScan and
     the previous meta data format.
     '''
-    if check_item_exists_hdf(params.file_name, '/measurement/instrument/attenuator_1'):
+    if check_item_exists_hdf(params.metadata, '/measurement/instrument/attenuator_1'):
         return read_filter_materials_tomoscan(params)
     else:
         return read_filter_materials_old(params)
@@ -341,7 +614,7 @@ def read_filter_materials_tomoscan(params):
     filter_path = '/measurement/instrument/attenuator_{idx}'
     param_path = 'filter_{idx}_{attr}'
     for idx_filter in range(1,4,1):
-        if not check_item_exists_hdf(params.file_name, filter_path.format(idx = idx_filter)):
+        if not check_item_exists_hdf(params.metadata, filter_path.format(idx = idx_filter)):
             log.warning('  *** *** Filter {idx} not found in HDF file.  Set this filter to none'
                                     .format(idx = idx_filter))
             setattr(params, param_path.format(idx=idx_filter, attr='material'), 'Al')
@@ -353,18 +626,18 @@ def read_filter_materials_tomoscan(params):
             continue
         log.warning('  *** *** auto reading parameters for filter {0}'.format(idx_filter))
         # See if there are description and thickness fields
-        if check_item_exists_hdf(params.file_name, filter_path.format(idx = idx_filter) + '/description'):
-            filt_material = config.param_from_dxchange(params.file_name,
+        if check_item_exists_hdf(params.metadata, filter_path.format(idx = idx_filter) + '/description'):
+            filt_material = config.param_from_dxchange(params.metadata,
                                         filter_path.format(idx=idx_filter) + '/description',
                                         char_array = True, scalar = False)
-            filt_thickness = int(config.param_from_dxchange(params.file_name,
+            filt_thickness = int(config.param_from_dxchange(params.metadata,
                                         filter_path.format(idx=idx_filter) + '/thickness',
                                         char_array = False, scalar = True))
         else:
             #The filter info is just the raw string from the filter unit.
             log.warning('  *** *** filter {idx} info must be read from the raw string'
                             .format(idx = idx_filter))
-            filter_str = config.param_from_dxchange(params.file_name,
+            filter_str = config.param_from_dxchange(params.metadata,
                                         filter_path.format(idx=idx_filter) + '/setup/filter_unit_text',
                                         char_array = True, scalar = False)
             if filter_str is None:
@@ -412,7 +685,7 @@ def read_filter_materials_old(params):
         filter_param = getattr(params, param_path.format(idx=idx_filter, attr='material'))
         if filter_param == 'auto':
             # Read recorded filter condition from the HDF5 file
-            filter_str = config.param_from_dxchange(params.file_name,
+            filter_str = config.param_from_dxchange(params.metadata,
                                                     filter_path.format(idx=idx_filter),
                                                     char_array=True, scalar=False)
             if filter_str is None:
@@ -469,16 +742,16 @@ def read_pixel_size(params):
         log.info('  *** *** OFF')
         return params
     
-    if check_item_exists_hdf(params.file_name,
+    if check_item_exists_hdf(params.metadata,
                                 '/measurement/instrument/detection_system/objective/resolution'):
-        params.pixel_size = config.param_from_dxchange(params.file_name,
+        params.pixel_size = config.param_from_dxchange(params.metadata,
                                             '/measurement/instrument/detection_system/objective/resolution')
         log.info('  *** *** effective pixel size = {:6.4e} microns'.format(params.pixel_size))
         return(params)
     log.warning('  *** tomoScan resolution parameter not found.  Try old format')
-    pixel_size = config.param_from_dxchange(params.file_name,
+    pixel_size = config.param_from_dxchange(params.metadata,
                                             '/measurement/instrument/detector/pixel_size_x')
-    mag = config.param_from_dxchange(params.file_name,
+    mag = config.param_from_dxchange(params.metadata,
                                     '/measurement/instrument/detection_system/objective/magnification')
     #Handle case where something wasn't read right
     if not (pixel_size and mag):
@@ -503,8 +776,8 @@ def read_scintillator(params):
         possible_names = ['/measurement/instrument/detection_system/scintillator/scintillating_thickness',
                         '/measurements/instrument/detection_system/scintillator/active_thickness']
         for pn in possible_names:
-            if check_item_exists_hdf(params.file_name, pn):
-                val = config.param_from_dxchange(params.file_name,
+            if check_item_exists_hdf(params.metadata, pn):
+                val = config.param_from_dxchange(params.metadata,
                                          pn, attr=None,
                                          scalar=True,
                                          char_array=False)
@@ -516,8 +789,8 @@ def read_scintillator(params):
                         '/measurement/instrument/detection_system/scintillator/description']
         scint_material_string = ''
         for pn in possible_names:
-            if check_item_exists_hdf(params.file_name, pn):
-                scint_material_string = config.param_from_dxchange(params.file_name,
+            if check_item_exists_hdf(params.metadata, pn):
+                scint_material_string = config.param_from_dxchange(params.metadata,
                                             pn, scalar = False, char_array = True)
                 break
         else:
@@ -548,8 +821,8 @@ def read_bright_ratio(params):
         possible_names = ['/measurement/instrument/detector/different_flat_exposure',
                         '/process/acquisition/flat_fields/different_flat_exposure']
         for pn in possible_names:
-            if check_item_exists_hdf(params.file_name, pn):
-                diff_bright_exp = config.param_from_dxchange(params.file_name, pn,
+            if check_item_exists_hdf(params.metadata, pn):
+                diff_bright_exp = config.param_from_dxchange(params.metadata, pn,
                                     attr = None, scalar = False, char_array = True)
                 break
         if diff_bright_exp.lower() == 'same':
@@ -560,12 +833,12 @@ def read_bright_ratio(params):
                         '/process/acquisition/flat_fields/flat_exposure_time',
                         '/measurement/instrument/detector/brightfield_exposure_time']
         for pn in possible_names:
-            if check_item_exists_hdf(params.file_name, pn):
-                bright_exp = config.param_from_dxchange(params.file_name, pn,
+            if check_item_exists_hdf(params.metadata, pn):
+                bright_exp = config.param_from_dxchange(params.metadata, pn,
                                     attr = None, scalar = True, char_array = False)
                 break    
         log.info('  *** *** %f' % bright_exp)
-        norm_exp = config.param_from_dxchange(params.file_name,
+        norm_exp = config.param_from_dxchange(params.metadata,
                                     '/measurement/instrument/detector/exposure_time',
                                     attr = None, scalar = True, char_array = False)
         log.info('  *** *** %f' % norm_exp)
@@ -580,10 +853,13 @@ def read_bright_ratio(params):
 def check_item_exists_hdf(hdf_filename, item_name):
     '''Checks if an item exists in an HDF file.
     Inputs
-    hdf_filename: str filename or pathlib.Path object for HDF file to check
+    hdf_filename: str filename or pathlib.Path object for HDF file to check,
+        or a MetadataSnapshot of it
     item_name: name of item whose existence needs to be checked
     path: str path to check.  Default to None
     '''
+    if isinstance(hdf_filename, MetadataSnapshot):
+        return item_name in hdf_filename
     with h5py.File(hdf_filename, 'r') as hdf_file:
         return item_name in hdf_file
 
@@ -5,7 +5,24 @@ Original version written by Viktor Nikitin at 2-BM.
 import numpy as np
 import sys
 import h5py
-import cupy as  cp # subpixel shifts on gpu
+
+# Target size of one chunk of the merged data
+CHUNK_BYTES = 4 * 2**20
+# Largest chunk cache sized automatically
+MAX_AUTO_CACHE = 2**30
+# Slab size for streaming copies of large meta data datasets
+STREAM_BYTES = 64 * 2**20
+
+
+def raw_file(params):
+    '''Open the raw data file for reading.
+
+    With --follow the acquisition may still be writing the file, so it is
+    opened for SWMR reading.
+    '''
+    if getattr(params, 'follow', False):
+        return h5py.File(params.file_name, 'r', libver='latest', swmr=True)
+    return h5py.File(params.file_name, 'r')
 
 
 def copy_attributes(in_object, out_object):
@@ -26,31 +43,188 @@ def h5py_compatible_attributes(in_object):
     except:
         return False
 
-def copy_h5(in_object, out_object, filter_data=[None], log=False):    
-    '''Recursively copy&compress the tree.
+def _split_group(group, filter_data, stream_bytes=None):
+    '''Must *group* be copied object by object rather than whole?
+
+    True if any object below it is named in *filter_data*, or, if
+    *stream_bytes* is given, if any dataset below it is larger.
+    '''
+    def check(name, obj):
+        if name.rsplit('/', 1)[-1] in filter_data:
+            return True
+        if (stream_bytes is not None and isinstance(obj, h5py.Dataset)
+                and obj.size * obj.dtype.itemsize > stream_bytes):
+            return True
+        return None
+    return group.visititems(check) is not None
+
+
+def _tree_bytes(obj):
+    '''Size in bytes of the data of a dataset, or of all datasets in a group.'''
+    if isinstance(obj, h5py.Dataset):
+        return obj.size * obj.dtype.itemsize
+    sizes = []
+    obj.visititems(lambda name, item: sizes.append(_tree_bytes(item)) if isinstance(item, h5py.Dataset) else None)
+    return sum(sizes)
+
+
+def _stream_dataset(in_obj, out_object, key, compression, compression_opts=None):
+    '''Copy a large dataset into a compressed, chunked dataset, one slab at a time.'''
+    out_obj = out_object.create_dataset(key, in_obj.shape, dtype=in_obj.dtype, chunks=True,
+                                        compression=compression, compression_opts=compression_opts)
+    row_bytes = max(1, in_obj.dtype.itemsize * int(np.prod(in_obj.shape[1:])))
+    rows = max(1, STREAM_BYTES // row_bytes)
+    for st in range(0, in_obj.shape[0], rows):
+        out_obj[st:st+rows] = in_obj[st:st+rows]
+    return out_obj
+
+
+def copy_h5(in_object, out_object, filter_data=[None], log=False, compression=None, compression_opts=None,
+            stream_bytes=STREAM_BYTES, report=None):
+    '''Recursively copy the tree, leaving out the keys in *filter_data*.
     
-    If attributes cannot be transferred, a copy is created.
-    Otherwise, dataset are compressed.
+    Objects are copied inside the HDF5 library (H5Ocopy through
+    Group.copy), with their layout, filters and attributes, without going
+    through Python memory.  Groups are copied whole unless something below
+    them is filtered out.  If *compression* is given, datasets larger than
+    *stream_bytes* are instead streamed slab by slab into a compressed,
+    chunked copy, as long as their attributes can be read with h5py.
+    Groups whose attributes cannot be read with h5py are copied whole.
+
+    Returns a report dict: number of objects, bytes copied and bytes streamed.
     '''
+    if report is None:
+        report = {'objects': 0, 'bytes': 0, 'streamed_bytes': 0}
     for key, in_obj in in_object.items():
         if (key in filter_data):
             continue
-        if not isinstance(in_obj, h5py.Datatype) and h5py_compatible_attributes(in_obj):
-            if isinstance(in_obj, h5py.Group):
-                out_obj = out_object.create_group(key)
-                copy_h5(in_obj, out_obj, filter_data, log)
-                if log:
-                    _report("Copied", key, in_obj)
-            elif isinstance(in_obj, h5py.Dataset):
-                out_obj = out_object.create_dataset(key, data=in_obj)
-                if log:
-                    _report("Copied", key, in_obj)
-            else:
-                raise "Invalid object type %s" % type(in_obj)
+        # Groups with attributes h5py cannot read are copied whole, as are datatypes
+        if (isinstance(in_obj, h5py.Group) and h5py_compatible_attributes(in_obj)
+                and _split_group(in_obj, filter_data, stream_bytes if compression else None)):
+            out_obj = out_object.create_group(key)
+            copy_h5(in_obj, out_obj, filter_data, log, compression, compression_opts, stream_bytes, report)
             copy_attributes(in_obj, out_obj)
+            continue
+        nbytes = _tree_bytes(in_obj) if not isinstance(in_obj, h5py.Datatype) else 0
+        if (compression and isinstance(in_obj, h5py.Dataset) and nbytes > stream_bytes
+                and in_obj.ndim > 0 and in_obj.dtype.kind in 'biuf' and h5py_compatible_attributes(in_obj)):
+            out_obj = _stream_dataset(in_obj, out_object, key, compression, compression_opts)
+            copy_attributes(in_obj, out_obj)
+            report['streamed_bytes'] += nbytes
+            if log:
+                _report("Streamed", key, in_obj)
         else:
-            # We copy datatypes and objects with non-understandable attributes
-            # identically.
+            in_object.copy(key, out_object)
             if log:
                 _report("Copied", key, in_obj)
-            in_object.copy(key, out_object)        
+        report['objects'] += 1
+        report['bytes'] += nbytes
+    return report
+
+
+def output_chunks(params, shape):
+    '''Chunk shape for the merged data.
+
+    The automatic layout takes up to 32 angles and as many full-width rows
+    as fit in CHUNK_BYTES.  Merges write many whole angles at a time and
+    tomopy-cli reads blocks of sinograms over all angles, so both touch
+    whole chunks.
+    '''
+    if params.output_chunks == 'none':
+        return None
+    if params.output_chunks != 'auto':
+        chunks = tuple(int(c) for c in params.output_chunks.split(','))
+        if len(chunks) != 3:
+            raise ValueError('output-chunks must be auto, none, or three integers: {:s}'
+                             .format(params.output_chunks))
+        return tuple(min(c, s) for c, s in zip(chunks, shape))
+    [ntheta, ny, n] = shape
+    theta_chunk = min(ntheta, 32)
+    rows = CHUNK_BYTES // (theta_chunk * n * 4)
+    return (theta_chunk, int(min(max(rows, 1), ny)), n)
+
+
+def sinogram_chunks(params, shape):
+    '''Chunk shape for the sinogram-major copy of the merged data.
+
+    *shape* is (rows, angles, columns).  The automatic layout takes as many
+    whole sinograms as fit in CHUNK_BYTES, so a block of slices is read as
+    whole chunks.  Explicit output-chunks are given in projection order
+    and are swapped.
+    '''
+    if params.output_chunks == 'none':
+        return None
+    if params.output_chunks != 'auto':
+        [theta_chunk, rows, n] = output_chunks(params, (shape[1], shape[0], shape[2]))
+        return (rows, theta_chunk, n)
+    [ny, ntheta, n] = shape
+    rows = CHUNK_BYTES // (ntheta * n * 4)
+    if rows > 0:
+        return (int(min(rows, ny)), ntheta, n)
+    return (1, int(max(CHUNK_BYTES // (n * 4), 1)), n)
+
+
+def output_layout(params, shape, sinogram=False):
+    '''Keyword arguments for create_dataset of the merged data.
+
+    With *sinogram* set, *shape* is that of the sinogram-major copy.
+    '''
+    layout = {'chunks': sinogram_chunks(params, shape) if sinogram else output_chunks(params, shape)}
+    if params.output_compression != 'none':
+        if layout['chunks'] is None:
+            raise ValueError('compressed output needs a chunked layout')
+        layout['compression'] = params.output_compression
+        if params.output_compression == 'gzip':
+            layout['compression_opts'] = params.output_compression_level
+        layout['shuffle'] = params.output_shuffle
+    return layout
+
+
+def chunk_cache(params, shape, chunks):
+    '''Chunk cache settings for h5py.File for writing the merged data.
+
+    By default the cache holds one strip of chunks across the full height,
+    so projections written one at a time do not evict each other's chunks.
+    '''
+    if chunks is None:
+        return {}
+    chunk_bytes = int(np.prod(chunks)) * 4
+    strip = -(-shape[1] // chunks[1]) * -(-shape[2] // chunks[2])
+    if params.output_chunk_cache > 0:
+        nbytes = int(params.output_chunk_cache * 2**20)
+    else:
+        nbytes = min(strip * chunk_bytes, MAX_AUTO_CACHE)
+    nbytes = max(nbytes, chunk_bytes)
+    nchunks = nbytes // chunk_bytes
+    # Write-once pattern: evict fully written chunks first
+    return {'rdcc_nbytes': nbytes, 'rdcc_nslots': max(521, 100 * nchunks), 'rdcc_w0': 1.0}
+
+
+def transpose_to_sinograms(dset, out_dset, block_bytes):
+    '''Copy projections, (ntheta, ny, n), of *dset* to sinograms, (ny, ntheta, n), of *out_dset*.
+
+    Out-of-core blocked transpose: each block of rows is read over as many
+    angles as fit in *block_bytes* (all of them, unless a single sinogram
+    is larger), transposed in memory and written as whole sinograms.
+    '''
+    [ntheta, ny, n] = dset.shape
+    itemsize = dset.dtype.itemsize
+    sino_bytes = ntheta * n * itemsize
+    rows = int(max(1, min(block_bytes // sino_bytes, ny)))
+    if dset.chunks and rows > dset.chunks[1]:
+        # Read whole chunks of the projection-major data
+        rows -= rows % dset.chunks[1]
+    angles = ntheta if sino_bytes <= block_bytes else int(max(1, block_bytes // (n * itemsize)))
+    # Flat buffers, so the partial blocks at the edges are contiguous too
+    buffer = np.empty(angles * rows * n, dtype=dset.dtype)
+    transposed = np.empty_like(buffer)
+    for r0 in range(0, ny, rows):
+        r1 = min(r0 + rows, ny)
+        for a0 in range(0, ntheta, angles):
+            a1 = min(a0 + angles, ntheta)
+            size = (a1 - a0) * (r1 - r0) * n
+            block = buffer[:size].reshape(a1 - a0, r1 - r0, n)
+            dset.read_direct(block, np.s_[a0:a1, r0:r1])
+            out = transposed[:size].reshape(r1 - r0, a1 - a0, n)
+            np.copyto(out, block.transpose(1, 0, 2))
+            out_dset.write_direct(out, dest_sel=np.s_[r0:r1, a0:a1])
@@ -0,0 +1,106 @@
+'''Sidecar journal of a merge, for resuming an interrupted run.
+
+The merged volume is written one window of output angles at a time, and
+each window is assigned to the output file, never added to it.  Writing a
+window again therefore gives the same result, so a window is the unit of
+commit: after a window is written and the file is flushed, its index is
+recorded in the journal.  A resumed merge skips the committed windows and
+redoes the others from scratch, so no projection chunk is ever added
+twice.  The partial outputs of a multi-process merge are committed the
+same way, by the path of their finished scratch file.
+
+The journal is a small JSON file next to the merged file.  It is
+replaced atomically on every commit, and removed when the merge is done.
+It records a signature of the input file and of every parameter that
+changes the output, so it is only used to resume the exact same merge.
+'''
+import os
+import json
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+from merge_helical import log
+
+__all__ = ['MergeJournal', 'merge_signature']
+
+# Parameters that change how a merge runs but not its result
+RUNTIME_PARAMS = {'config', 'config_update', 'logs_home', 'verbose', 'resume', 'pipeline_depth',
+                  'pipeline_workers', 'fft_workers', 'backend', 'scratch_dir', 'scratch_max_size',
+                  'preprocessing_threads', 'beam_hardening_threads', 'output_chunk_cache', 'metadata'}
+
+
+def merge_signature(params, *extra):
+    '''Hash of the input file, the output-changing parameters and *extra*.'''
+    key = hashlib.sha1()
+    stat = os.stat(params.file_name)
+    key.update(json.dumps([str(params.file_name), stat.st_size, stat.st_mtime_ns]).encode())
+    for name, value in sorted(vars(params).items()):
+        if name in RUNTIME_PARAMS or name.startswith('_') or callable(value):
+            continue
+        key.update(name.encode())
+        if isinstance(value, np.ndarray):
+            key.update(np.ascontiguousarray(value).tobytes())
+        else:
+            key.update(repr(value).encode())
+    for value in extra:
+        key.update(repr(value).encode())
+    return key.hexdigest()
+
+
+class MergeJournal:
+    '''Commits of one merge, kept in *path*.
+
+    Commits are grouped by kind ('windows', 'partials', ...) and map a
+    key to a JSON value.
+    '''
+    def __init__(self, path, signature):
+        self.path = Path(path)
+        self.signature = signature
+        self.commits = {}
+
+    def load(self):
+        '''Read the commits of an earlier run of the same merge.
+
+        Returns False, and keeps no commits, if there is no journal or it
+        belongs to a different merge.
+        '''
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if state.get('signature') != self.signature:
+            log.warning('  *** journal {:s} is from a different merge, ignore it'.format(str(self.path)))
+            return False
+        self.commits = state['commits']
+        return True
+
+    def stale(self):
+        '''Commits of whatever merge wrote the journal, without checking the signature.'''
+        try:
+            with open(self.path) as f:
+                return json.load(f).get('commits', {})
+        except (OSError, ValueError):
+            return {}
+
+    def committed(self, kind):
+        '''Dictionary of the commits of *kind*, keyed by str(key).'''
+        return self.commits.get(kind, {})
+
+    def commit(self, kind, key, value=True):
+        '''Record that *key* of *kind* is done and durable.'''
+        self.commits.setdefault(kind, {})[str(key)] = value
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'signature': self.signature, 'commits': self.commits}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        '''Delete the journal of a finished merge.'''
+        self.commits = {}
+        if self.path.exists():
+            os.remove(self.path)
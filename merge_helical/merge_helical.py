@@ -3,27 +3,25 @@ Original version written by Viktor Nikitin at 2-BM.
 
 '''
 from pathlib import Path
+import os
+import shutil
+import tempfile
+import time
+import multiprocessing
+import concurrent.futures
 import numpy as np
 import sys
 import h5py
-import numpy as np
-import cupy as  cp # subpixel shifts on gpu
-#import numpy as  cp # subpixel shifts on cpu
-from merge_helical import handle_hdf, log, file_io, prep
-
-
-def apply_shift_subpixel(data, shifts, pad=1):
-    """Apply shifts for projections on GPU."""
+from merge_helical import handle_hdf, log, file_io, prep, shift, accumulate, pipeline
+from merge_helical.backend import get_backend
+from merge_helical.journal import MergeJournal, merge_signature
 
-    [ntheta, nz, n] = data.shape
-    # padding
-    tmp = cp.zeros([ntheta, nz+2*pad, n], dtype='float32')
-    tmp[:, pad:-pad] = data
-    # shift in the frequency domain
-    y = cp.fft.fftfreq(nz+2*pad).astype('float32').reshape([nz+2*pad,1])        
-    s = cp.exp(-2*np.pi*1j * (y*cp.array(shifts[:,  None, None])))   
-    data = cp.fft.irfft2(s*np.fft.rfft2(tmp))
-    return data
+# Extra detector rows read around a vertical range, so the interpolating
+# shift kernels see the same neighbourhood as in a full merge.  The cubic
+# prefilter decays as 0.268**rows, below float32 precision after 12 rows.
+ROI_MARGIN = 12
+# Number of projections read to find the sample columns
+PREVIEW_PROJECTIONS = 16
 
 
 def compute_helical_params(params):
@@ -31,105 +29,674 @@ def compute_helical_params(params):
 
     Takes data from the meta data of the HDF5 file.
     '''
-    with h5py.File(params.file_name, 'r') as hdf_file:
-        scan_type = hdf_file['/process/acquisition/scan_type'][0].decode('UTF-8')
-        log.info(f'scan type = {scan_type}')
-        if scan_type.lower() != "helical":
-            log.info("  not a helical scan, so nothing to do")
-            return None
-        pixels_per_360deg = hdf_file['/process/acquisition/pixels_y_per_360_deg'][0]
-        theta = hdf_file['/exchange/theta'][...]
-        flip_stitch = hdf_file['/process/acquisition/flip_stitch'][0].decode('UTF-8')
-        if flip_stitch.lower() == 'yes':
-            theta_max = theta[theta - theta[0] <= 360][-1]
-            log.info(f'  flip and stitch scan, theta range {theta[0]} to {theta_max}')
-        else:
-            theta_max = theta[theta - theta[0] <= 180][-1]
-            log.info(f'   0 - 180 degree data, theta range {theta[0]} to {theta_max}')
-        data_size = hdf_file['/exchange/data'].shape
+    hdf_file = file_io.metadata(params)
+    scan_type = hdf_file['/process/acquisition/scan_type'][0].decode('UTF-8')
+    log.info(f'scan type = {scan_type}')
+    if scan_type.lower() != "helical":
+        log.info("  not a helical scan, so nothing to do")
+        return None
+    pixels_per_360deg = hdf_file['/process/acquisition/pixels_y_per_360_deg'][0]
+    theta = hdf_file['/exchange/theta']
+    flip_stitch = hdf_file['/process/acquisition/flip_stitch'][0].decode('UTF-8')
+    if flip_stitch.lower() == 'yes':
+        theta_max = theta[theta - theta[0] <= 360][-1]
+        log.info(f'  flip and stitch scan, theta range {theta[0]} to {theta_max}')
+    else:
+        theta_max = theta[theta - theta[0] <= 180][-1]
+        log.info(f'   0 - 180 degree data, theta range {theta[0]} to {theta_max}')
+    data_size = hdf_file.shape('/exchange/data')
     params = file_io.auto_read_dxchange(params)
     if theta_max == theta[-1]:
         params.final_theta = theta
     else:
         params.final_theta = theta[0:np.argmin(np.abs(theta - theta_max)) + 1]
     params.final_shifts = (theta - theta[0]) / 360. * pixels_per_360deg 
-    params.final_y_size = data_size[1] + 2 * params.subpixel_pad + np.abs(int(np.ceil(params.final_shifts[-1])))
+    params.final_y_size = data_size[1] + 2 * params.subpixel_pad + int(np.ceil(np.abs(params.final_shifts[-1])))
+    params.z_range = vertical_range(params)
+    params.x_range = horizontal_range(params, data_size[2])
     return params
 
 
+def requested_rows(params):
+    '''Rows z0, z1 of the merged volume asked for by z-start and z-end, z1 None for all the rest.'''
+    scale = 1e3 / params.pixel_size if params.z_units == 'mm' else 1.0
+    z0 = max(int(np.floor(params.z_start * scale)), 0)
+    z1 = None if params.z_end < 0 else int(np.ceil(params.z_end * scale))
+    return z0, z1
+
+
+def vertical_range(params):
+    '''Output rows z0:z1 of the merged volume selected by z-start and z-end.'''
+    ny_out = params.final_y_size
+    z0, z1 = requested_rows(params)
+    z1 = ny_out if z1 is None else min(z1, ny_out)
+    if z1 <= z0:
+        raise ValueError('Empty vertical range: rows {:d} to {:d} of {:d}'.format(z0, z1, ny_out))
+    if (z0, z1) != (0, ny_out):
+        log.info('  *** merge output rows {:d} to {:d} of {:d}'.format(z0, z1, ny_out))
+    return z0, z1
+
+
+def horizontal_range(params, nx):
+    '''Detector columns x0:x1 to merge, from x-start and x-end or found with x-auto.'''
+    if params.x_auto:
+        proj, flat, dark = file_io.read_preview(params, PREVIEW_PROJECTIONS)
+        columns = prep.sample_columns(proj, flat, dark, params.x_auto_threshold)
+        if columns is None:
+            log.warning('  *** no sample found in the preview, merge all columns')
+            return 0, nx
+        x0, x1 = max(columns[0] - params.x_auto_margin, 0), min(columns[1] + params.x_auto_margin, nx)
+        log.info('  *** sample in columns {:d} to {:d}'.format(*columns))
+    else:
+        x0 = max(params.x_start, 0)
+        x1 = nx if params.x_end < 0 else min(params.x_end, nx)
+    if x1 <= x0:
+        raise ValueError('Empty column range: {:d} to {:d} of {:d}'.format(x0, x1, nx))
+    if (x0, x1) != (0, nx):
+        log.info('  *** merge columns {:d} to {:d} of {:d}'.format(x0, x1, nx))
+    return x0, x1
+
+
+def projection_rows(params, ny, pad):
+    '''Splits the helical shifts into output rows and subpixel shifts.
+
+    Returns the first output row of each padded projection and the
+    fractional shift that is left for the subpixel shift kernel.
+    '''
+    shifts = params.final_shifts
+    # integer + float shifts
+    ishifts = np.int32(shifts)
+    fshifts = np.float32(shifts - ishifts)
+    if shifts[1] > shifts[0]:
+        #stage is moving up
+        stz = ishifts
+    else:
+        #stage is moving down
+        stz = params.final_y_size - 1 + ishifts - ny - 2 * pad
+    return stz, fshifts
+
+
+def row_windows(tasks, stz, ny, pad, z_range, margin):
+    '''Restrict *tasks* to the projections and detector rows that reach output rows z_range.
+
+    Padded projection i covers output rows stz[i]:stz[i]+ny+2*pad before
+    the fractional shift, which moves it by less than a row and spreads
+    each row over at most two rows to either side (cubic).  Returns the tasks
+    that still have projections, the first detector row to read for each
+    task, keyed by its first projection, and the number of rows to read.
+    For the full height that is every projection and all rows.  *margin*
+    more rows are read at each edge, if the detector has them.
+    '''
+    z0, z1 = z_range
+    lo = z0 - stz - pad - 2
+    hi = z1 - stz - pad + 2
+    contributes = np.minimum(hi, ny) > np.maximum(lo, 0)
+    lo = np.clip(lo - margin, 0, ny)
+    hi = np.clip(hi + margin, 0, ny)
+    chunks = []
+    for w, st, end in tasks:
+        # stz is monotonic, so the projections that contribute are contiguous
+        idx = st + np.flatnonzero(contributes[st:end])
+        if idx.size:
+            chunks.append((w, int(idx[0]), int(idx[-1]) + 1))
+    height = max((int(hi[st:end].max() - lo[st:end].min()) for w, st, end in chunks), default=ny)
+    starts = {st: int(min(lo[st:end].min(), ny - height)) for w, st, end in chunks}
+    return chunks, starts, height
+
+
 def make_skeleton_hdf(fname, fname_out, params):
     '''Set up new HDF file.
+
+    Returns the shape and chunk shape of the merged /exchange/data.
     '''
-    with h5py.File(fname,'r') as fid, h5py.File(fname_out,'w') as fid_out:        
+    with handle_hdf.raw_file(params) as fid, h5py.File(fname_out,'w') as fid_out:        
         # copy h5 file
         filter_data = ['data','data_white','data_dark','theta'] # will not be copied
-        handle_hdf.copy_h5(fid,fid_out,filter_data,log=True)        
+        compression = None if params.metadata_compression == 'none' else params.metadata_compression
+        compression_opts = params.output_compression_level if compression == 'gzip' else None
+        report = handle_hdf.copy_h5(fid, fid_out, filter_data, log=True, compression=compression,
+                                    compression_opts=compression_opts,
+                                    stream_bytes=int(params.metadata_stream_size * 2**20))
+        log.info('  *** copied {:d} meta data objects, {:.1f} MB ({:.1f} MB streamed{:s})'.format(
+                    report['objects'], report['bytes'] / 2**20, report['streamed_bytes'] / 2**20,
+                    ' with ' + compression if compression else ''))
                 
-        [ntheta,nz,n] = fid['/exchange/data'].shape
-        data_out = fid_out.create_dataset('/exchange/data',
-                                        [params.final_theta.size,params.final_y_size,n],
-                                        dtype='float32',fillvalue=0)        
+        ny_out = params.z_range[1] - params.z_range[0]
+        n = params.x_range[1] - params.x_range[0]
+        shape_out = [params.final_theta.size,ny_out,n]
+        layout = handle_hdf.output_layout(params, shape_out)
+        log.info('  *** output chunks {}, compression {:s}'.format(layout['chunks'],
+                                                                params.output_compression))
+        data_out = fid_out.create_dataset('/exchange/data', shape_out,
+                                        dtype='float32',fillvalue=0, **layout)
 
         # create resulting angles
         fid_out.create_dataset('/exchange/theta',data=params.final_theta)
         
         # create resulting flat and dark fields
-        fid_out.create_dataset('/exchange/data_dark',data=np.zeros([1,params.final_y_size,n]),dtype='float32')
-        fid_out.create_dataset('/exchange/data_white',data=np.ones([1,params.final_y_size,n]),dtype='float32')
+        fid_out.create_dataset('/exchange/data_dark',data=np.zeros([1,ny_out,n]),dtype='float32')
+        fid_out.create_dataset('/exchange/data_white',data=np.ones([1,ny_out,n]),dtype='float32')
+        return data_out.shape, data_out.chunks
+
+
+class ChunkProcessor:
+    '''Reads, preprocesses and shifts chunks of projections.
+
+    Provides the read and compute stages of the merge pipeline.  Tasks are
+    (window, start, end) tuples of input projection indices.  Chunks are
+    detector rows *sino*, or *nrows* rows from row_starts[start] if given.
+    '''
+    def __init__(self, params, backend, sino, nx, fshifts, nworkers=1, row_starts=None, nrows=None):
+        self.params = params
+        self.backend = backend
+        self.sino = sino
+        self.fshifts = fshifts
+        self.row_starts = row_starts
+        self.nrows = sino[1] - sino[0] if nrows is None else nrows
+        self.check_accuracy = params.shift_method != 'fft2'
+        shape = (params.proj_chunk_size, self.nrows, nx)
+        self.workspaces = [shift.ShiftWorkspace(shape, params.subpixel_pad, params.shift_method, backend,
+                                        params.shift_tolerance, params.shift_cache_size)
+                            for i in range(max(1, nworkers))]
+        # Every chunk in flight holds its read buffer until compute is done with it
+        nbuffers = pipeline.in_flight(params.pipeline_depth, nworkers)
+        self.reader = file_io.ProjectionReader(params, sino, params.proj_chunk_size, nbuffers, self.nrows,
+                                                params.x_range)
+        # float32 output of the preprocessing of each worker, allocated on first use
+        self.prep_buffers = [None] * max(1, nworkers)
+
+    def rows(self, st):
+        '''Detector rows of the chunk that starts at projection *st*.'''
+        if self.row_starts is None:
+            return self.sino
+        return (self.row_starts[st], self.row_starts[st] + self.nrows)
+
+    def read(self, task):
+        w, st, end = task
+        print(f'Processing angle chunk {st}, {end}')
+        return self.reader.read((st, end), self.rows(st))
+
+    def close(self):
+        self.reader.close()
+
+    def compute(self, task, chunk, worker=0):
+        w, st, end = task
+        params = self.params
+        proj, flat, dark, theta = chunk
+        buffer = self.prep_buffers[worker]
+        if buffer is None or buffer.shape[1:] != proj.shape[1:] or buffer.shape[0] < proj.shape[0]:
+            buffer = self.prep_buffers[worker] = np.empty(proj.shape, dtype='float32')
+        try:
+            # Apply all preprocessing functions.  The shift copies the result
+            # into its workspace, so the buffer is free again for the next chunk.
+            data = prep.all(proj, flat, dark, params, self.rows(st), buffer[:proj.shape[0]])
+            del(flat, dark, chunk)
+            data_chunk = self.backend.asarray(data)
+            if self.check_accuracy:
+                self.check_accuracy = False
+                max_err, rms_err = shift.shift_accuracy(data_chunk, self.fshifts[st:end], params.subpixel_pad,
+                                        params.shift_method, self.backend, params.shift_tolerance)
+                log.info('  *** shift method {:s}: max error {:.3e}, rms error {:.3e} relative to fft2'
+                            .format(params.shift_method, max_err, rms_err))
+            data_chunk = self.workspaces[worker].apply(data_chunk, self.fshifts[st:end])
+            # Copy out of the workspace, which the worker reuses for its next chunk
+            return self.backend.asnumpy(data_chunk).copy()
+        finally:
+            # Only now may the reader fill the read buffer with another chunk
+            self.reader.release(proj)
+
+    def log_cache_stats(self):
+        hits = sum(ws.ramp_hits for ws in self.workspaces)
+        misses = sum(ws.ramp_misses for ws in self.workspaces)
+        log.info('  *** phase ramp cache: {:d} hits, {:d} misses'.format(hits, misses))
+
+
+def _roi_margin(params, ny):
+    '''Rows read around a vertical range: all of them for the FFT kernels, which are not local.'''
+    return ny if params.shift_method in ('fft', 'fft2') else ROI_MARGIN
+
+
+def _merge_partial(params, tasks, ntheta_out, ny, nx, row_lo, nrows, scratch_dir, row_starts, height):
+    '''Merge *tasks* into a private partial output in a scratch file.
+
+    Runs in a worker process.  The partial covers output rows
+    row_lo:row_lo+nrows of all output angles.  Returns the scratch file path.
+    '''
+    backend = get_backend(params.backend, params.fft_workers)
+    stz, fshifts = projection_rows(params, ny, params.subpixel_pad)
+    processor = ChunkProcessor(params, backend, (0, ny), nx, fshifts, params.pipeline_workers,
+                                row_starts, height)
+    processor.check_accuracy = False
+    partial = accumulate.MemmapAccumulator(ntheta_out, nrows, nx, scratch_dir, ntheta_out)
+    partial.reset(0, ntheta_out)
+
+    def write(task, data_chunk):
+        w, st, end = task
+        partial.add(np.arange(st, end) % ntheta_out,
+                    stz[st:end] + row_starts[st] - params.z_range[0] - row_lo, data_chunk)
+
+    try:
+        pipeline.run_pipeline(tasks, processor.read, processor.compute, write,
+                              params.pipeline_depth, params.pipeline_workers)
+        partial.close(remove=False)
+    except BaseException:
+        partial.close()
+        raise
+    finally:
+        processor.close()
+    return partial.path
+
+
+def _merge_parallel(params, data_out, ntheta, ny, nx, stz, journal):
+    '''Split the projections over *params.nprocs* worker processes.
+
+    Each worker accumulates its share of the projections into a partial
+    output in the scratch directory.  The partials are then summed in
+    worker order, so the result does not depend on scheduling.  Finished
+    partials are committed to *journal* and kept until the sum is written,
+    so a resumed merge only reruns the workers that did not finish.
+    '''
+    [ntheta_out, ny_out, n] = data_out.shape
+    if journal.committed('reduce'):
+        return
+    pad = params.subpixel_pad
+    nprocs = params.nprocs
+    if params.fft_workers == 0:
+        params.fft_workers = max(1, os.cpu_count() // nprocs)
+    scratch_dir = params.scratch_dir or tempfile.gettempdir()
+    tasks = [(0, st, end) for st, end in accumulate.window_chunks(ntheta, ntheta_out, 0, ntheta_out,
+                                                                    params.proj_chunk_size)]
+    tasks, row_starts, height = row_windows(tasks, stz, ny, pad, params.z_range, _roi_margin(params, ny))
+    # First output row of the padded chunk read for each task
+    offsets = {st: stz[st:end] + row_starts[st] - params.z_range[0] for w, st, end in tasks}
+    jobs = []
+    for group in np.array_split(np.arange(len(tasks)), min(nprocs, len(tasks))):
+        group_tasks = [tasks[i] for i in group]
+        row_lo = max(0, min(int(offsets[st].min()) for w, st, end in group_tasks))
+        row_hi = min(ny_out, max(int(offsets[st].max()) for w, st, end in group_tasks) + height + 2 * pad)
+        jobs.append((group_tasks, row_lo, row_hi - row_lo))
+    done = {int(j): tuple(partial) for j, partial in journal.committed('partials').items()
+                if os.path.exists(partial[0])}
+    pending = [j for j in range(len(jobs)) if j not in done]
+    need = sum(ntheta_out * jobs[j][2] * nx * 4 for j in pending)
+    if need > shutil.disk_usage(scratch_dir).free:
+        raise RuntimeError('Not enough space in {:s} for {:.2f} GB of partial outputs'
+                            .format(scratch_dir, need / 2**30))
+    log.info('  *** merge with {:d} processes, {:.2f} GB of partial outputs in {:s}'
+                .format(len(pending), need / 2**30, scratch_dir))
+    if done:
+        log.info('  *** resume: {:d} of {:d} partial outputs already done'.format(len(done), len(jobs)))
+    errors = []
+    if pending:
+        with concurrent.futures.ProcessPoolExecutor(len(pending),
+                                mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(_merge_partial, params, jobs[j][0], ntheta_out, ny, nx,
+                                        jobs[j][1], jobs[j][2], scratch_dir, row_starts, height): j
+                        for j in pending}
+            for future in concurrent.futures.as_completed(futures):
+                j = futures[future]
+                try:
+                    done[j] = (future.result(), jobs[j][1], jobs[j][2])
+                except Exception as err:
+                    errors.append(err)
+                    continue
+                journal.commit('partials', j, done[j])
+    if errors:
+        log.error('  *** partial outputs of finished processes are kept for --resume')
+        raise errors[0]
+    partials = [done[j] for j in range(len(jobs))]
+    slab = accumulate.window_size(params, data_out)
+    accumulate.reduce_partials(partials, data_out, slab)
+    data_out.file.flush()
+    journal.commit('reduce', 'done')
+    for path, row_lo, nrows in partials:
+        os.remove(path)
+
+
+def _remove_partials(commits):
+    '''Delete the partial outputs recorded in the *commits* of a journal.'''
+    for path, row_lo, nrows in commits.get('partials', {}).values():
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _merge_serial(params, backend, data_out, ntheta, ny, nx, stz, fshifts, journal):
+    '''Merge in this process, with the threaded pipeline.
+
+    Every window of output angles is committed to *journal* once it is
+    written, and the windows already committed are skipped.
+    '''
+    ntheta_out = data_out.shape[0]
+    z0 = params.z_range[0]
+    accumulator, window = accumulate.make_accumulator(params, data_out)
+    windows = accumulate.plan_windows(ntheta_out, window)
+    tasks = [(w, st, end) for w, (win_st, win_end) in enumerate(windows)
+                for st, end in accumulate.window_chunks(ntheta, ntheta_out, win_st, win_end,
+                                                        params.proj_chunk_size)]
+    # Only the projections and rows that reach the vertical range
+    tasks, row_starts, height = row_windows(tasks, stz, ny, params.subpixel_pad, params.z_range,
+                                            _roi_margin(params, ny))
+    done = journal.committed('windows')
+    if done:
+        log.info('  *** resume: {:d} of {:d} windows already done'.format(len(done), len(windows)))
+        tasks = [task for task in tasks if str(task[0]) not in done]
+    processor = ChunkProcessor(params, backend, (0, ny), nx, fshifts, params.pipeline_workers,
+                                row_starts, height)
+
+    # Each window is written and committed as soon as its last chunk is in
+    last_task = {task[0]: task for task in tasks}
+    current = [None]
+    def write(task, data_chunk):
+        w, st, end = task
+        if current[0] != w:
+            accumulator.reset(*windows[w])
+            current[0] = w
+        accumulator.add(np.arange(st, end) % ntheta_out, stz[st:end] + row_starts[st] - z0, data_chunk)
+        if task == last_task[w]:
+            accumulator.flush(data_out)
+            data_out.file.flush()
+            journal.commit('windows', w)
+
+    try:
+        pipeline.run_pipeline(tasks, processor.read, processor.compute, write,
+                              params.pipeline_depth, params.pipeline_workers)
+    finally:
+        accumulator.close()
+        processor.close()
+    processor.log_cache_stats()
+
+
+def _remove_link(group, path):
+    if group.get(path, getlink=True) is not None:
+        del group[path]
+
+
+def write_sinograms(params, fid_out, fname_out):
+    '''Write a sinogram-major copy of the merged data.
+
+    The copy is /exchange/data_sinogram in the merged file, or for
+    sinogram-output 'file' /exchange/data in a separate _sino.h5 file that
+    /exchange/data_sinogram of the merged file links to.
+    '''
+    data_out = fid_out['/exchange/data']
+    [ntheta_out, ny_out, n] = data_out.shape
+    shape = (ny_out, ntheta_out, n)
+    layout = handle_hdf.output_layout(params, shape, sinogram=True)
+    block_bytes = int(params.sinogram_block_size * 2**20)
+    if params.sinogram_output == 'file':
+        fname_sino = fname_out.parent.joinpath(fname_out.stem + '_sino.h5')
+        log.info('  *** write sinograms to {:s}, chunks {}'.format(str(fname_sino), layout['chunks']))
+        with h5py.File(fname_sino, 'w', **handle_hdf.chunk_cache(params, shape, layout['chunks'])) as fid_sino:
+            sino_out = fid_sino.create_dataset('/exchange/data', shape, dtype='float32', **layout)
+            fid_sino.create_dataset('/exchange/theta', data=fid_out['/exchange/theta'][...])
+            handle_hdf.transpose_to_sinograms(data_out, sino_out, block_bytes)
+        # Relative link, so the two files can be moved together
+        _remove_link(fid_out, '/exchange/data_sinogram')
+        fid_out['/exchange/data_sinogram'] = h5py.ExternalLink(fname_sino.name, '/exchange/data')
+    else:
+        log.info('  *** write sinograms to /exchange/data_sinogram, chunks {}'.format(layout['chunks']))
+        # Left over from an interrupted run
+        _remove_link(fid_out, '/exchange/data_sinogram')
+        sino_out = fid_out.create_dataset('/exchange/data_sinogram', shape, dtype='float32', **layout)
+        handle_hdf.transpose_to_sinograms(data_out, sino_out, block_bytes)
 
 
 def merge_helical(params): 
     
+    if params.follow:
+        return _merge_follow(params)
     fname = params.file_name
-    ptheta = params.proj_chunk_size
     pad = params.subpixel_pad 
     params = compute_helical_params(params)
     if not params:
         return
-    ny_out = params.final_y_size
-    ntheta_out = params.final_theta.size
+    backend = get_backend(params.backend, params.fft_workers)
     fname_out = fname.parent.joinpath(fname.stem +'_merged.h5')
-    make_skeleton_hdf(fname, fname_out, params)
+    journal = MergeJournal(fname_out.with_suffix('.journal'), merge_signature(params))
+    if params.resume and _resumable(params) and fname_out.exists() and journal.load():
+        log.info('  *** resume the merge into {:s}'.format(str(fname_out)))
+        with h5py.File(fname_out, 'r') as fid_out:
+            shape_out, chunks_out = fid_out['/exchange/data'].shape, fid_out['/exchange/data'].chunks
+    else:
+        # Partial outputs of an interrupted merge that is not resumed
+        _remove_partials(journal.stale())
+        journal.remove()
+        shape_out, chunks_out = make_skeleton_hdf(fname, fname_out, params)
     print(params)
     print(params.final_shifts[:10])
     print(params.final_shifts[-10:])
     #import pdb; pdb.set_trace()
-    with h5py.File(fname,'r') as fid, h5py.File(fname_out,'r+') as fid_out:        
+    [ntheta, ny, nx] = params.metadata.shape('/exchange/data')
+    nx = params.x_range[1] - params.x_range[0]
+    # calculate shifts
+    stz, fshifts = projection_rows(params, ny, pad)
+    cache = handle_hdf.chunk_cache(params, shape_out, chunks_out)
+    with h5py.File(fname_out,'r+', **cache) as fid_out:        
         data_out = fid_out['/exchange/data']
+        if params.nprocs > 1:
+            _merge_parallel(params, data_out, ntheta, ny, nx, stz, journal)
+        else:
+            _merge_serial(params, backend, data_out, ntheta, ny, nx, stz, fshifts, journal)
+        if params.sinogram_output != 'none':
+            write_sinograms(params, fid_out, fname_out)
+    journal.remove()
+
+
+def _resumable(params):
+    '''Can an interrupted merge with these parameters be resumed?'''
+    if params.accumulator == 'hdf5' and params.nprocs <= 1:
+        # Projections are added to the file one by one, so a window is never safe to redo
+        log.warning('  *** the hdf5 accumulator cannot resume, start the merge over')
+        return False
+    return True
+
+
+def _output_angles(theta, bound, complete):
+    '''Number of output angles, as in compute_helical_params, once *theta* is past *bound* degrees.
 
-        # calculate shifts
-        shifts = params.final_shifts
-        [ntheta, ny, nx] = fid['/exchange/data'].shape
-
-        sino = (0, ny)
-        # shift data by chunks 
-        for k in range(int(np.ceil(ntheta/ptheta))): 
-            st = k * ptheta 
-            end = min(ntheta,(k+1)*ptheta)
-            print(f'Processing angle chunk {st}, {end}')
-            proj, flat, dark, theta = file_io.read_tomo(sino, (st, end), params) 
-
-            # Apply all preprocessing functions
-            data = prep.all(proj, flat, dark, params, sino)
-            del(proj, flat, dark)
-            #import pdb; pdb.set_trace() 
-            data_chunk = cp.array(data)
-
-            # integer + float shifts
-            ishifts = np.int32(shifts[st:end])
-            fshifts = np.float32(shifts[st:end]-ishifts)
-            
-            if shifts[1]>shifts[0]:
-                #stage is moving up
-                stz = ishifts
-                endz = ishifts + ny + 2 * pad
-            else:                 
-                #stage is moving down
-                endz = ny_out - 1 + ishifts
-                stz = ny_out - 1 + ishifts - ny - 2 * pad                
-            data_chunk = apply_shift_subpixel(data_chunk, fshifts, pad)
-            if not isinstance(data_chunk, np.ndarray):
-                data_chunk = data_chunk.get()
-            for kk in range(end-st):
-                data_out[(kk+st)%ntheta_out, stz[kk]:endz[kk]] += data_chunk[kk]    
-            
+    Returns None while the scan has not reached *bound* and is not *complete*.
+    '''
+    inside = theta - theta[0] <= bound
+    if inside.all():
+        return theta.size if complete else None
+    theta_max = theta[inside][-1]
+    return int(np.argmin(np.abs(theta - theta_max))) + 1
+
+
+def _scan_complete(fid, marker):
+    '''Does the completion *marker* dataset of the raw file hold a value yet?'''
+    if marker not in fid:
+        return False
+    dset = fid[marker]
+    dset.refresh()
+    value = dset[()]
+    if isinstance(value, bytes):
+        return bool(value.strip(b'\0 '))
+    value = np.asarray(value)
+    if value.dtype.kind in 'SO':
+        return any(bool(v.strip(b'\0 ') if isinstance(v, bytes) else v) for v in value.ravel())
+    return value.size > 0 and bool(np.any(value))
+
+
+def _references_written(params):
+    '''Wait until the raw file has flat and dark images.
+
+    The acquisition may take them at the end of the scan, so this can
+    take as long as the scan.  Raises RuntimeError if the scan ends, or no
+    new projections arrive for follow-timeout seconds, without them.
+    '''
+    last_change = time.monotonic()
+    nproj = None
+    waiting = False
+    while True:
+        with handle_hdf.raw_file(params) as fid:
+            complete = _scan_complete(fid, params.follow_marker)
+            counts = []
+            for name in ('data', 'data_white', 'data_dark'):
+                dset = fid['/exchange/' + name]
+                dset.refresh()
+                counts.append(dset.shape[0])
+        if min(counts[1:]) > 0:
+            return
+        if complete:
+            raise RuntimeError('The scan in {:s} ended without flat or dark images'.format(str(params.file_name)))
+        if counts[0] != nproj:
+            nproj = counts[0]
+            last_change = time.monotonic()
+        elif params.follow_timeout > 0 and time.monotonic() - last_change > params.follow_timeout:
+            raise RuntimeError('No flat or dark images in {:s} after {:.0f} s without new projections'
+                                .format(str(params.file_name), params.follow_timeout))
+        if not waiting:
+            log.info('  *** wait for the flat and dark images')
+            waiting = True
+        time.sleep(params.follow_interval)
+
+
+def _merge_follow(params):
+    '''Merge a scan while it is acquired.
+
+    The raw file is opened for SWMR reading and polled every
+    follow-interval seconds.  Once the flat and dark images are in the
+    file and the scan is past the last output angle, whole chunks of newly
+    appended projections are merged into a growable in-memory volume of
+    at most accumulator-max-memory.  The helical shift of a projection
+    only depends on its own angle, so projections can be merged before the
+    height of the output is known.  If the stage moves up, the vertical
+    range is known too, and only the rows in it are read and kept.  When
+    the completion marker has a value (or nothing new arrives for
+    follow-timeout seconds), the rest is merged, the final angles and
+    output size are computed from the finished file as in a normal merge,
+    and the volume is written.  If flat or dark images were added after
+    the merge started, all projections are merged again with the final ones.
+    '''
+    fname = params.file_name
+    pad = params.subpixel_pad
+    if params.x_auto:
+        raise ValueError('--x-auto needs the whole scan, it cannot be used with --follow')
+    if params.accumulator != 'memory':
+        raise ValueError('--follow accumulates in memory, it cannot be used with --accumulator {:s}'
+                            .format(params.accumulator))
+    if params.resume:
+        log.warning('  *** --resume is ignored with --follow')
+    if params.nprocs > 1:
+        log.warning('  *** --follow merges in one process, --nprocs is ignored')
+    hdf_file = file_io.metadata(params)
+    scan_type = hdf_file['/process/acquisition/scan_type'][0].decode('UTF-8')
+    log.info(f'scan type = {scan_type}')
+    if scan_type.lower() != "helical":
+        log.info("  not a helical scan, so nothing to do")
+        return
+    pixels_per_360deg = hdf_file['/process/acquisition/pixels_y_per_360_deg'][0]
+    bound = 360 if hdf_file['/process/acquisition/flip_stitch'][0].decode('UTF-8').lower() == 'yes' else 180
+    [ntheta, ny, nx] = hdf_file.shape('/exchange/data')
+    params = file_io.auto_read_dxchange(params)
+    params.x_range = horizontal_range(params, nx)
+    nx = params.x_range[1] - params.x_range[0]
+    z_rows = requested_rows(params)
+    fname_out = fname.parent.joinpath(fname.stem +'_merged.h5')
+    # Left over from an interrupted merge into the same file
+    journal = MergeJournal(fname_out.with_suffix('.journal'), None)
+    _remove_partials(journal.stale())
+    journal.remove()
+
+    backend = get_backend(params.backend, params.fft_workers)
+    chunk = params.proj_chunk_size
+    max_bytes = params.accumulator_max_memory * 2**30
+    ntheta_out = None
+    accumulator = None
+    rows = None
+    processed = 0
+    log.info('  *** follow {:s}, end of scan marked by {:s}'.format(str(fname), params.follow_marker))
+    # The median of a partial stack of references is fine, of an empty one it is not
+    _references_written(params)
+    last_change = time.monotonic()
+    processor = ChunkProcessor(params, backend, (0, ny), nx, None, params.pipeline_workers)
+    # Poll through the reader's own file and dataset: HDF5 gets confused by
+    # two handles to a growing dataset that are refreshed separately
+    fid = processor.reader.hdf_file
+    data = processor.reader.dset
+    theta_dset = fid['/exchange/theta']
+
+    def merge(start, stop):
+        shifts = (theta[:stop] - theta[0]) / 360. * pixels_per_360deg
+        ishifts = np.int32(shifts)
+        processor.fshifts = np.float32(shifts - ishifts)
+        tasks = [(0, st, min(st + chunk, stop)) for st in range(start, stop, chunk)]
+        if rows is not None:
+            # The stage moves up, so relative rows are rows of the merged volume
+            z1 = int(ishifts.max()) + ny + 2 * pad if rows[1] is None else rows[1]
+            tasks, processor.row_starts, processor.nrows = row_windows(tasks, ishifts, ny, pad, (rows[0], z1),
+                                                                       _roi_margin(params, ny))
+
+        def write(task, data_chunk):
+            w, st, end = task
+            row_start = 0 if processor.row_starts is None else processor.row_starts[st]
+            accumulator.add(np.arange(st, end) % ntheta_out, ishifts[st:end] + row_start, data_chunk)
+
+        pipeline.run_pipeline(tasks, processor.read, processor.compute, write,
+                              params.pipeline_depth, params.pipeline_workers)
+
+    try:
+        while True:
+            # Check the marker first, so everything written before it is seen
+            complete = _scan_complete(fid, params.follow_marker)
+            data.refresh()
+            theta_dset.refresh()
+            theta = theta_dset[...]
+            available = min(data.shape[0], theta.size)
+            if available > ntheta:
+                ntheta = available
+                last_change = time.monotonic()
+            elif not complete and params.follow_timeout > 0 \
+                    and time.monotonic() - last_change > params.follow_timeout:
+                log.warning('  *** no new projections for {:.0f} s, merge the {:d} available'
+                                .format(params.follow_timeout, available))
+                complete = True
+            if ntheta_out is None and available:
+                ntheta_out = _output_angles(theta[:available] if complete else theta, bound, complete)
+                if ntheta_out is not None:
+                    stage_up = available > 1 and (theta[1] - theta[0]) * pixels_per_360deg > 0
+                    if stage_up:
+                        rows = z_rows
+                    elif z_rows != (0, None):
+                        log.info('  *** the stage moves down, the vertical range is cut out at the end of the scan')
+                    accumulator = accumulate.GrowableAccumulator(ntheta_out, nx, rows, max_bytes)
+                    log.info('  *** {:d} output angles'.format(ntheta_out))
+            if ntheta_out is not None:
+                stop = available if complete else processed + (available - processed) // chunk * chunk
+                if stop > processed:
+                    merge(processed, stop)
+                    processed = stop
+                    log.info('  *** merged {:d} projections, {:.2f} GB in memory'
+                                .format(processed, accumulator.buffer.nbytes / 2**30))
+            if complete:
+                break
+            time.sleep(params.follow_interval)
+        flat, dark = file_io.read_references(params, (0, ny), params.x_range)
+        if processed and not (np.array_equal(flat, processor.reader.flat)
+                              and np.array_equal(dark, processor.reader.dark)):
+            log.warning('  *** flat or dark images were added during the scan, merge again with all of them')
+            processor.reader.flat, processor.reader.dark = flat, dark
+            accumulator = accumulate.GrowableAccumulator(ntheta_out, nx, rows, max_bytes)
+            merge(0, processed)
+    finally:
+        processor.close()
+    if not processed:
+        raise RuntimeError('No projections in {:s}'.format(str(fname)))
+    processor.log_cache_stats()
+
+    # The scan is done: final angles, shifts and output size as for a normal merge
+    params.metadata = None
+    params = compute_helical_params(params)
+    if params.final_theta.size != ntheta_out:
+        raise RuntimeError('The finished scan has {:d} output angles, not {:d}'
+                            .format(params.final_theta.size, ntheta_out))
+    shape_out, chunks_out = make_skeleton_hdf(fname, fname_out, params)
+    stz, fshifts = projection_rows(params, ny, pad)
+    # Row of the merged volume that relative row 0 of the accumulator lands on
+    offset = int(stz[0]) - int(np.int32(params.final_shifts[0])) - params.z_range[0]
+    cache = handle_hdf.chunk_cache(params, shape_out, chunks_out)
+    with h5py.File(fname_out,'r+', **cache) as fid_out:
+        accumulator.flush(fid_out['/exchange/data'], offset, accumulate.window_size(params, fid_out['/exchange/data']))
+        if params.sinogram_output != 'none':
+            write_sinograms(params, fid_out, fname_out)
@@ -0,0 +1,151 @@
+'''Threaded read/compute/write pipeline for the projection-chunk loop.
+
+A reader thread reads chunks ahead into a bounded queue, compute workers
+preprocess and shift them, and a writer thread adds the results to the
+output in the original chunk order.  The bounded queues give backpressure:
+the reader never gets more than *depth* chunks ahead of the workers, and
+the workers never more than *depth* chunks ahead of the writer.  Results
+that finish out of order wait for the writer outside the queues, so the
+reader also never starts a chunk more than in_flight(depth, workers)
+chunks ahead of the last one written.  That bounds the memory held by a
+stalled worker, and lets the read stage reuse a fixed pool of that many
+buffers.
+
+NumPy, h5py and the FFT libraries release the GIL for the heavy work, so
+threads are enough to overlap file I/O with computation.
+'''
+import queue
+import threading
+
+__all__ = ['run_pipeline', 'in_flight']
+
+_DONE = object()
+
+
+class _Stopped(Exception):
+    '''Raised inside a stage when another stage has failed.'''
+
+
+def in_flight(depth, workers):
+    '''Most chunks between the start of their read and the end of their write.'''
+    if depth <= 0:
+        return 1
+    return depth + max(1, workers)
+
+
+def run_pipeline(tasks, read, compute, write, depth=2, workers=1):
+    '''Run read -> compute -> write over *tasks*.
+
+    Parameters
+    ----------
+    tasks : list
+        Work items, passed unchanged to the three stages.
+    read : callable
+        read(task) -> item.  Runs in the reader thread, in task order.
+    compute : callable
+        compute(task, item, worker) -> result.  Runs in one of *workers*
+        threads; *worker* is the index of the thread, so each thread can
+        keep its own scratch buffers.
+    write : callable
+        write(task, result).  Runs in the writer thread, in task order.
+    depth : int
+        Size of the read and write queues.  0 runs everything serially in
+        the calling thread.
+    workers : int
+        Number of compute threads.
+
+    At most in_flight(depth, workers) chunks are read and not yet
+    written at any time.  The first exception raised by any stage stops
+    the pipeline and is re-raised in the calling thread.
+    '''
+    if depth <= 0:
+        for task in tasks:
+            write(task, compute(task, read(task), 0))
+        return
+
+    workers = max(1, workers)
+    limit = in_flight(depth, workers)
+    stop = threading.Event()
+    errors = []
+    # Sequence number of the next result to write, guarded by *written*
+    written = threading.Condition()
+    next_seq = [0]
+    read_q = queue.Queue(depth)
+    write_q = queue.Queue(depth)
+
+    def put(q, item):
+        while True:
+            if stop.is_set():
+                raise _Stopped
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(q):
+        while True:
+            if stop.is_set():
+                raise _Stopped
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def reader():
+        for seq, task in enumerate(tasks):
+            with written:
+                while seq >= next_seq[0] + limit:
+                    if stop.is_set():
+                        raise _Stopped
+                    written.wait(0.1)
+            put(read_q, (seq, task, read(task)))
+        for i in range(workers):
+            put(read_q, _DONE)
+
+    def worker(index):
+        while True:
+            item = get(read_q)
+            if item is _DONE:
+                put(write_q, _DONE)
+                return
+            seq, task, data = item
+            put(write_q, (seq, task, compute(task, data, index)))
+
+    def writer():
+        # Results can arrive out of order with several workers; the reader
+        # limit keeps *pending* below in_flight(depth, workers) results
+        pending = {}
+        finished = 0
+        while finished < workers:
+            item = get(write_q)
+            if item is _DONE:
+                finished += 1
+                continue
+            pending[item[0]] = item
+            while next_seq[0] in pending:
+                seq, task, result = pending.pop(next_seq[0])
+                write(task, result)
+                with written:
+                    next_seq[0] += 1
+                    written.notify()
+
+    def guarded(stage, *args):
+        try:
+            stage(*args)
+        except _Stopped:
+            pass
+        except BaseException as err:
+            errors.append(err)
+            stop.set()
+
+    threads = [threading.Thread(target=guarded, args=(reader,), name='merge-reader')]
+    threads += [threading.Thread(target=guarded, args=(worker, i), name='merge-worker-{:d}'.format(i))
+                for i in range(workers)]
+    threads.append(threading.Thread(target=guarded, args=(writer,), name='merge-writer'))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
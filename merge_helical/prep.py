@@ -1,4 +1,5 @@
 import os
+import time
 import logging
 
 import tomopy
@@ -8,27 +9,36 @@ import numpy as np
 from merge_helical import file_io
 from merge_helical import beamhardening
 from merge_helical import config
+from merge_helical import util
 
-__all__ = ['all', 'remove_nan_neg_inf', 'cap_sinogram_values', 'zinger_removal', 'flat_correction', 
+__all__ = ['all', 'fused_preprocess', 'fused_cleanup', 'sample_columns', 'remove_nan_neg_inf', 'cap_sinogram_values', 'zinger_removal', 'flat_correction', 
            'remove_stripe', 'phase_retrieval', 'minus_log', 'beamhardening_correct']
 
 
 log = logging.getLogger(__name__)
 
 
-def all(proj, flat, dark, params, sino):
+def all(proj, flat, dark, params, sino, out=None):
     # zinger_removal
     proj, flat = zinger_removal(proj, flat, params)
     if (params.dark_zero):
         dark *= 0
         log.warning('  *** *** dark fields are ignored')
 
+    if params.preprocessing_engine == 'fused' and params.flat_correction_method != 'air':
+        # One pass over the chunk instead of one per step
+        if params.beam_hardening_method == 'standard':
+            data = fused_preprocess(proj, flat, dark, params, out, log_transform=False, cleanup=False)
+            data = beamhardening_correct(data, params, sino)
+            return fused_cleanup(data, params)
+        return fused_preprocess(proj, flat, dark, params, out)
+
     # normalize
     data = flat_correction(proj, flat, dark, params)
     del(proj, flat, dark)
     # Perform beam hardening.  This leaves the data in pathlength.
     if params.beam_hardening_method == 'standard':
-        data[:,...] = beamhardening_correct(data, params, sino)
+        data = beamhardening_correct(data, params, sino)
     else:
         # minus log
         data = minus_log(data, params)
@@ -38,6 +48,127 @@ def all(proj, flat, dark, params, sino):
     return data
 
 
+def _cleanup_block(data, fix_value, max_value):
+    '''Same as remove_nan_neg_inf and cap_sinogram_values, in place on one block.'''
+    if fix_value is not None:
+        np.copyto(data, fix_value, where=np.isnan(data))
+        np.copyto(data, np.float32(0), where=data < 0)
+        np.copyto(data, fix_value, where=np.isinf(data))
+    if max_value is not None:
+        np.copyto(data, max_value, where=data > max_value)
+
+
+def _cleanup_values(params):
+    fix_value = np.float32(params.fix_nan_and_inf_value) if params.fix_nan_and_inf else None
+    max_value = None if np.isposinf(params.sinogram_max_value) else np.float32(params.sinogram_max_value)
+    return fix_value, max_value
+
+
+def fused_preprocess(proj, flat, dark, params, out=None, log_transform=True, cleanup=True, block=1 << 16):
+    """Flat correction, minus log and clean up of a chunk in one pass.
+
+    Gives the same float32 result as flat_correction, minus_log,
+    remove_nan_neg_inf and cap_sinogram_values run one after the other,
+    but reads the raw projections once and writes the output once,
+    block by block, instead of sweeping the whole chunk for every step.
+
+    Parameters
+    ==========
+    proj, flat, dark : np.ndarray
+      raw projections, flat and dark images, of any dtype
+    params : processing parameters.  The 'air' flat correction is not
+      supported here.
+    out : np.ndarray
+      float32 output of the shape of proj.  May be proj itself if that is
+      float32.  Allocated if None.
+    log_transform : bool
+      apply the minus log (if params.minus_log is set)
+    cleanup : bool
+      fix nan, inf and negative values and cap the values
+
+    Returns
+    =======
+    data : np.ndarray
+    """
+    start_time = time.perf_counter()
+    if out is None:
+        out = np.empty(proj.shape, dtype=np.float32)
+    if params.flat_correction_method == 'standard':
+        log.info('  *** *** fused normalization, %f cut-off' % params.normalization_cutoff)
+        # Same types as flat_correction: tomopy.normalize rounds the cut-off,
+        # computed in double precision, to float32, and the ratio is applied
+        # with the type it has in params
+        ratio = getattr(params, 'bright_exp_ratio', 1)
+        cutoff = np.float32(params.normalization_cutoff / ratio)
+        # As tomopy.normalize
+        dark = np.mean(dark, axis=0, dtype=np.float32)
+        denom = np.mean(flat, axis=0, dtype=np.float32) - dark
+        denom[denom < np.float32(1e-6)] = np.float32(1e-6)
+    elif params.flat_correction_method == 'none':
+        log.warning('  *** *** normalization is turned off')
+    else:
+        raise ValueError("Fused preprocessing does not support *flat_correction_method*: {}"
+                         .format(params.flat_correction_method))
+    take_log = log_transform and params.minus_log
+    fix_value, max_value = _cleanup_values(params) if cleanup else (None, None)
+
+    def kernel(p, r0, r1):
+        data = out[p, r0:r1]
+        if params.flat_correction_method == 'standard':
+            np.subtract(proj[p, r0:r1], dark[r0:r1], out=data, dtype=np.float32)
+            np.divide(data, denom[r0:r1], out=data)
+            np.copyto(data, cutoff, where=data > cutoff)
+            data *= ratio
+        elif out is not proj:
+            data[...] = proj[p, r0:r1]
+        if take_log:
+            # The error state is per thread
+            with np.errstate(divide='ignore', invalid='ignore'):
+                np.log(data, out=data)
+            np.negative(data, out=data)
+        _cleanup_block(data, fix_value, max_value)
+
+    util.run_blocks(proj.shape, kernel, params.preprocessing_threads, block)
+    elapsed = time.perf_counter() - start_time
+    log.info('  *** *** fused preprocessing {:.1f} MB/s'.format(out.nbytes / 2**20 / max(elapsed, 1e-9)))
+    return out
+
+
+def fused_cleanup(data, params, block=1 << 16):
+    """remove_nan_neg_inf and cap_sinogram_values in place, in one pass."""
+    fix_value, max_value = _cleanup_values(params)
+    if fix_value is None and max_value is None:
+        return data
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    util.run_blocks(data.shape, lambda p, r0, r1: _cleanup_block(data[p, r0:r1], fix_value, max_value),
+                params.preprocessing_threads, block)
+    return data
+
+
+def sample_columns(proj, flat, dark, threshold, row_block=8):
+    """Columns that the sample shadows in a preview of flat corrected projections.
+
+    The attenuation is averaged over blocks of *row_block* rows to beat
+    the noise.  A column belongs to the sample if its attenuation exceeds
+    *threshold* in any block of any projection.
+
+    Returns
+    =======
+    (start, end) of the sample columns, or None if no column is attenuated.
+    """
+    flat = flat.astype(np.float32)
+    dark = dark.astype(np.float32)
+    trans = (proj.astype(np.float32) - dark) / np.maximum(flat - dark, np.float32(1e-6))
+    attenuation = -np.log(np.clip(trans, np.float32(1e-6), None))
+    [nproj, nrows, ncols] = attenuation.shape
+    nblocks = max(1, nrows // row_block)
+    blocks = attenuation[:, :nblocks * (nrows // nblocks)].reshape(nproj, nblocks, -1, ncols).mean(axis=2)
+    columns = np.flatnonzero((blocks > threshold).any(axis=(0, 1)))
+    if columns.size == 0:
+        return None
+    return int(columns[0]), int(columns[-1]) + 1
+
+
 def remove_nan_neg_inf(data, params):
 
     log.info('  *** remove nan, neg and inf')
@@ -119,19 +250,8 @@ def beamhardening_correct(data, params, sino):
     sino: row numbers for these data
     """
     log.info("  *** correct beam hardening")
-    data_dtype = data.dtype
-    # Correct for centerline of fan
-    softener = beamhardening.BeamSoftener(params)
-    data = softener.fcorrect_as_pathlength_centerline(data)
-    # Make an array of correction factors
-    softener.center_row = params.center_row
+    softener = beamhardening.get_softener(params)
     log.info("  *** *** Beam hardening center row = {:f}".format(softener.center_row))
-    angles = np.abs(np.arange(sino[0], sino[1])- softener.center_row).astype(data_dtype)
-    angles *= softener.pixel_size / softener.d_source
-    log.info("  *** *** angles from {0:f} to {1:f} urad".format(angles[0], angles[-1]))
-    correction_factor = softener.angular_spline(angles).astype(data_dtype)
-    if len(data.shape) == 2:
-        return data* correction_factor[:,None]
-    else:
-        return data * correction_factor[None, :, None]
-
+    # Corrected in place, one pass over the data
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    return softener.fcorrect_chunk(data, sino, params.beam_hardening_threads)
@@ -0,0 +1,293 @@
+'''Subpixel shift kernels for the helical merge.
+
+Helical projections only need to be shifted along the vertical axis, by a
+fractional number of rows that differs from projection to projection.  The
+integer part of the shift is handled by where the projection is added into
+the output volume, so the kernels here only ever see shifts in (-1, 1).
+
+Kernels:
+
+* ``fft2``: the original 2-D FFT phase ramp.  This is the reference.
+* ``fft``: 1-D FFT along the vertical axis only.
+* ``cubic``: cubic B-spline interpolation along the vertical axis.
+* ``linear``: linear interpolation along the vertical axis.
+* ``integer``: round to the nearest whole row.
+
+All kernels work on projections that are zero padded by *pad* rows at the
+top and bottom and return arrays of the padded shape.  Projections whose
+shift is below *tolerance* are passed through untouched.
+
+A merge shifts hundreds of chunks of the same shape, so the padded buffers,
+the frequency grid and the phase ramps live in a ShiftWorkspace that is
+created once per run.  FFT plans are cached by the FFT libraries themselves
+(pocketfft in scipy.fft, the cuFFT plan cache in CuPy) and are reused
+because the workspace always hands them arrays of the same shape.
+'''
+from collections import OrderedDict
+
+import numpy as np
+
+from merge_helical.backend import get_backend
+
+__all__ = ['SHIFT_METHODS', 'RAMP_QUANTUM', 'ShiftWorkspace', 'apply_shift', 'shift_accuracy']
+
+# Fractional shifts are rounded to this many rows before looking up phase ramps
+RAMP_QUANTUM = 1e-4
+
+
+def _shift_fft2(ws, tmp, shifts, out):
+    '''Shift with a phase ramp on the full 2-D FFT of each projection.'''
+    s = ws.phase_ramps(shifts, tmp.shape[1])[:, :, None]
+    return ws.backend.irfft2(s*ws.backend.rfft2(tmp), s=tmp.shape[1:])
+
+
+def _shift_fft(ws, tmp, shifts, out):
+    '''Shift with a phase ramp on the 1-D FFT along the vertical axis.'''
+    s = ws.phase_ramps(shifts, tmp.shape[1])[:, :, None]
+    return ws.backend.irfft(s*ws.backend.rfft(tmp, axis=1), n=tmp.shape[1], axis=1)
+
+
+def _add_displaced(out, src, sel, offset, weight):
+    '''Add *weight* times the rows of *src* moved down by *offset* rows to *out*.
+
+    Only the projections in *sel* are touched.  Rows moved in from outside
+    the array are zero.
+    '''
+    nz = src.shape[1]
+    if abs(offset) >= nz:
+        return
+    if offset >= 0:
+        out[sel, offset:] += weight * src[sel, :nz-offset]
+    else:
+        out[sel, :nz+offset] += weight * src[sel, -offset:]
+
+
+def _groups(shifts, backend):
+    '''Split projections into groups with the same integer part of the shift.
+
+    Yields the integer offset, the projection selection, and the fractional
+    part of the shift of each projection in the group.  Contiguous groups,
+    the usual case, are selected with a slice to avoid fancy-index copies.
+    '''
+    offsets = np.floor(shifts).astype(int)
+    for k in np.unique(offsets):
+        idx = np.flatnonzero(offsets == k)
+        frac = (shifts[idx] - k).astype('float32')
+        if idx[-1] - idx[0] + 1 == idx.size:
+            sel = slice(int(idx[0]), int(idx[-1]) + 1)
+        else:
+            sel = backend.asarray(idx, dtype='int64')
+        yield int(k), sel, frac
+
+
+def _shift_linear(ws, tmp, shifts, out):
+    '''Shift by linear interpolation along the vertical axis.'''
+    out[...] = 0
+    for k, sel, t in _groups(shifts, ws.backend):
+        t = ws.backend.asarray(t)[:, None, None]
+        _add_displaced(out, tmp, sel, k, 1 - t)
+        _add_displaced(out, tmp, sel, k + 1, t)
+    return out
+
+
+def _spline_prefilter(tmp, coeffs):
+    '''Cubic B-spline coefficients along the vertical axis, mirror boundaries.
+
+    Same result as ndimage.spline_filter1d(tmp, 3, axis=1), but done with
+    the causal/anticausal recursion in float32, which is much faster than
+    the float64 ndimage code for tall projections.
+    '''
+    z = np.sqrt(3) - 2
+    coeffs[...] = tmp
+    nz = coeffs.shape[1]
+    if nz < 2:
+        return coeffs
+    # Causal initialization, truncated where z**k drops below float32 precision
+    for k in range(1, min(nz, 16)):
+        coeffs[:, 0] += z**k * tmp[:, k]
+    for k in range(1, nz):
+        coeffs[:, k] += z * coeffs[:, k-1]
+    coeffs[:, nz-1] = (z / (z*z - 1)) * (coeffs[:, nz-1] + z * coeffs[:, nz-2])
+    for k in range(nz-2, -1, -1):
+        coeffs[:, k] = z * (coeffs[:, k+1] - coeffs[:, k])
+    coeffs *= 6
+    return coeffs
+
+
+def _shift_cubic(ws, tmp, shifts, out):
+    '''Shift by cubic B-spline interpolation along the vertical axis.'''
+    coeffs = _spline_prefilter(tmp, ws.buffer('coeffs', tmp.shape))
+    out[...] = 0
+    for k, sel, t in _groups(shifts, ws.backend):
+        t = ws.backend.asarray(t)[:, None, None]
+        q = 1 - t
+        _add_displaced(out, coeffs, sel, k + 2, t**3 / 6)
+        _add_displaced(out, coeffs, sel, k + 1, 2/3 - q**2 + q**3 / 2)
+        _add_displaced(out, coeffs, sel, k, 2/3 - t**2 + t**3 / 2)
+        _add_displaced(out, coeffs, sel, k - 1, q**3 / 6)
+    return out
+
+
+def _shift_integer(ws, tmp, shifts, out):
+    '''Shift by whole rows.  *shifts* must already be rounded.'''
+    out[...] = 0
+    for k, sel, t in _groups(shifts, ws.backend):
+        _add_displaced(out, tmp, sel, k, 1)
+    return out
+
+
+SHIFT_METHODS = {
+    'fft2': _shift_fft2,
+    'fft': _shift_fft,
+    'cubic': _shift_cubic,
+    'linear': _shift_linear,
+    'integer': _shift_integer,
+    }
+
+
+class ShiftWorkspace:
+    '''Reusable state for shifting chunks of projections of one merge.
+
+    Holds the zero-padded input buffer, the output and scratch buffers of
+    the interpolation kernels, the frequency grid of the FFT kernels and an
+    LRU cache of phase ramps keyed by the quantized fractional shift.
+    Helical scans repeat the same pattern of fractional shifts every
+    rotation, so most ramps are computed once per run.
+
+    Arrays returned by *apply* are views into the workspace and are only
+    valid until the next call.
+    '''
+    def __init__(self, shape, pad=1, method='fft2', backend=None, tolerance=0.0, cache_size=4096):
+        '''
+        Parameters
+        ----------
+        shape : tuple
+            Largest chunk that will be shifted, (ntheta, nz, n).
+        pad, method, backend, tolerance
+            As in *apply_shift*.
+        cache_size : int
+            Maximum number of phase ramps kept in the cache.
+        '''
+        if method not in SHIFT_METHODS:
+            raise ValueError('Unknown shift method: {:s}. Valid options are {}'
+                             .format(method, list(SHIFT_METHODS)))
+        self.backend = backend if backend is not None else get_backend('numpy')
+        self.method = method
+        self.pad = pad
+        self.tolerance = tolerance
+        self.cache_size = cache_size
+        self.ramp_hits = 0
+        self.ramp_misses = 0
+        [ntheta, nz, n] = shape
+        self._buffers = {}
+        self.buffer('padded', (ntheta, nz+2*pad, n))
+        self._freqs = {}
+        self._ramps = OrderedDict()
+
+    def buffer(self, name, shape):
+        '''A float32 work buffer of at least *shape*, allocated on first use.'''
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape[0] < shape[0] or buf.shape[1:] != tuple(shape[1:]):
+            buf = self.backend.xp.empty(shape, dtype='float32')
+            self._buffers[name] = buf
+        return buf[:shape[0]]
+
+    def freq(self, nz):
+        '''Frequency grid of the FFT kernel for *nz* padded rows.'''
+        freq = self._freqs.get(nz)
+        if freq is None:
+            fftfreq = self.backend.xp.fft.fftfreq if self.method == 'fft2' else self.backend.xp.fft.rfftfreq
+            freq = fftfreq(nz).astype('float32')
+            self._freqs[nz] = freq
+        return freq
+
+    def ramp(self, shift, nz):
+        '''Phase ramp for a shift of *shift* rows over *nz* padded rows, from the LRU cache.'''
+        key = (nz, int(round(float(shift) / RAMP_QUANTUM)))
+        ramp = self._ramps.get(key)
+        if ramp is not None:
+            self.ramp_hits += 1
+            self._ramps.move_to_end(key)
+            return ramp
+        self.ramp_misses += 1
+        xp = self.backend.xp
+        ramp = xp.exp(-2*np.pi*1j * (self.freq(nz) * np.float32(key[1] * RAMP_QUANTUM))).astype('complex64')
+        self._ramps[key] = ramp
+        if len(self._ramps) > self.cache_size:
+            self._ramps.popitem(last=False)
+        return ramp
+
+    def phase_ramps(self, shifts, nz):
+        '''Stack of phase ramps for *shifts* over *nz* padded rows, (ntheta, nfreq).'''
+        return self.backend.xp.stack([self.ramp(s, nz) for s in shifts])
+
+    def apply(self, data, shifts):
+        '''Shift *data*, (ntheta, nz, n), by *shifts* rows.
+
+        Returns the padded, shifted projections on the backend device.
+        '''
+        shifts = np.asarray(shifts, dtype='float32')
+        [ntheta, nz, n] = data.shape
+        pad = self.pad
+        tmp = self.buffer('padded', (ntheta, nz+2*pad, n))
+        tmp[:, :pad] = 0
+        tmp[:, pad:nz+pad] = self.backend.asarray(data)
+        tmp[:, nz+pad:] = 0
+        kernel = SHIFT_METHODS[self.method]
+        if self.method == 'integer':
+            shifts = np.rint(shifts)
+            moving = shifts != 0
+        else:
+            moving = np.abs(shifts) >= self.tolerance
+        if moving.all():
+            return kernel(self, tmp, shifts, self.buffer('out', tmp.shape))
+        if moving.any():
+            idx = self.backend.asarray(np.flatnonzero(moving), dtype='int64')
+            sub = tmp[idx]
+            tmp[idx] = kernel(self, sub, shifts[moving], self.backend.xp.empty_like(sub))
+        return tmp
+
+
+def apply_shift(data, shifts, pad=1, method='fft2', backend=None, tolerance=0.0):
+    """Apply subpixel shifts to the projections along the vertical axis.
+
+    Convenience wrapper that builds a one-off ShiftWorkspace.  Use a
+    workspace directly when shifting many chunks.
+
+    Parameters
+    ----------
+    data : ndarray
+        3D projection data, (ntheta, nz, n).
+    shifts : ndarray
+        Shift of each projection in rows.  Positive shifts move the image down.
+    pad : int
+        Number of zero rows added at the top and bottom.
+    method : str
+        One of the keys of SHIFT_METHODS.
+    backend : array backend from merge_helical.backend
+    tolerance : float
+        Projections with abs(shift) below this many rows are not shifted.
+
+    Returns
+    -------
+    ndarray
+        Shifted projections, (ntheta, nz+2*pad, n), on the backend device.
+    """
+    ws = ShiftWorkspace(data.shape, pad, method, backend, tolerance)
+    return ws.apply(data, shifts)
+
+
+def shift_accuracy(data, shifts, pad=1, method='fft2', backend=None, tolerance=0.0):
+    '''Compare a shift kernel with the 2-D FFT reference.
+
+    Returns the maximum and RMS differences, both relative to the largest
+    absolute value of the reference.
+    '''
+    if backend is None:
+        backend = get_backend('numpy')
+    xp = backend.xp
+    reference = apply_shift(data, shifts, pad, 'fft2', backend)
+    result = apply_shift(data, shifts, pad, method, backend, tolerance)
+    scale = float(xp.abs(reference).max()) or 1.0
+    diff = xp.abs(result - reference)
+    return float(diff.max()) / scale, float(xp.sqrt(xp.mean(diff**2))) / scale
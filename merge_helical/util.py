@@ -1,3 +1,6 @@
+import os
+import concurrent.futures
+
 import numpy as np
 
 from merge_helical import log
@@ -63,6 +66,26 @@ def restricted_float(x):
     return x
     
 
+def run_blocks(shape, kernel, threads, block):
+    '''Call kernel(p, r0, r1) on blocks of image rows of a (nproj, nrows, ncols) chunk.
+
+    Blocks are small enough to stay in the CPU cache and are spread over
+    a pool of threads, one per core if *threads* is 0.  NumPy releases
+    the GIL in the ufuncs, so the threads run in parallel.
+    '''
+    [nproj, nrows, ncols] = shape
+    block_rows = max(1, block // ncols)
+    blocks = [(p, r0, min(r0 + block_rows, nrows)) for p in range(nproj) for r0 in range(0, nrows, block_rows)]
+    threads = threads if threads > 0 else os.cpu_count()
+    if threads == 1 or len(blocks) == 1:
+        for b in blocks:
+            kernel(*b)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            # list() re-raises any exception from the threads
+            list(executor.map(lambda b: kernel(*b), blocks))
+
+
 def guess_center(first_projection, last_projection):
     """
     Compute the tomographic rotation center based on cross-correlation technique.
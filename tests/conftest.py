@@ -0,0 +1,44 @@
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pytest
+
+
+def make_scan(path, ntheta=100, ny=24, nx=16, pixels_per_360=30.0, step=3.6, seed=0):
+    '''Write a small synthetic helical scan in the DXchange layout.'''
+    rng = np.random.default_rng(seed)
+    with h5py.File(path, 'w') as f:
+        f['/process/acquisition/scan_type'] = np.array([b'Helical'])
+        f['/process/acquisition/pixels_y_per_360_deg'] = np.array([pixels_per_360])
+        f['/process/acquisition/flip_stitch'] = np.array([b'No'])
+        f['/measurement/instrument/detector/exposure_time'] = np.array([0.1])
+        f['/exchange/theta'] = np.arange(ntheta) * step
+        f['/exchange/data'] = rng.integers(200, 900, (ntheta, ny, nx)).astype('uint16')
+        f['/exchange/data_white'] = rng.integers(950, 1050, (5, ny, nx)).astype('uint16')
+        f['/exchange/data_dark'] = rng.integers(0, 20, (3, ny, nx)).astype('uint16')
+    return Path(path)
+
+
+def merged(path):
+    '''The merged data written for scan *path*.'''
+    with h5py.File(path.parent / (path.stem + '_merged.h5'), 'r') as f:
+        return f['/exchange/data'][...]
+
+
+@pytest.fixture
+def merge_params():
+    '''Build default merge parameters for a scan, with overrides.'''
+    for module in ('tomopy', 'tomopy_cli', 'dxchange', 'dxfile'):
+        pytest.importorskip(module)
+    from merge_helical import config
+
+    def build(path, **overrides):
+        params = config.Params(sections=config.ALL_PARAMS).get_defaults()
+        params.file_name = Path(path)
+        params.backend = 'numpy'
+        params.scratch_dir = str(Path(path).parent)
+        for name, value in overrides.items():
+            setattr(params, name, value)
+        return params
+    return build
@@ -0,0 +1,209 @@
+import os
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+import pytest
+
+from merge_helical import accumulate
+
+
+def accumulator_params(tmp_path, **overrides):
+    params = SimpleNamespace(accumulator='memory', accumulator_max_memory=8.0, checkpoint_angles=0,
+                             scratch_dir=str(tmp_path), scratch_max_size=0.0)
+    for name, value in overrides.items():
+        setattr(params, name, value)
+    return params
+
+
+def scan(ntheta=70, nrows=6, ny_out=20, n=5, seed=0):
+    '''Random projections with increasing first output rows, as in a helical scan.'''
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal((ntheta, nrows, n)).astype('float32')
+    rows = np.linspace(0, ny_out - nrows, ntheta).astype(int)
+    return data, rows
+
+
+def direct_sum(data, rows, ntheta_out, ny_out):
+    out = np.zeros((ntheta_out, ny_out, data.shape[2]), dtype='float32')
+    for i in range(data.shape[0]):
+        out[i % ntheta_out, rows[i]:rows[i] + data.shape[1]] += data[i]
+    return out
+
+
+def merge_windows(accumulator, window, data, rows, dset, ptheta):
+    '''Accumulate *data* into *dset* window by window, as _merge_serial does.'''
+    ntheta_out = dset.shape[0]
+    for start, stop in accumulate.plan_windows(ntheta_out, window):
+        accumulator.reset(start, stop)
+        for st, end in accumulate.window_chunks(data.shape[0], ntheta_out, start, stop, ptheta):
+            accumulator.add(np.arange(st, end) % ntheta_out, rows[st:end], data[st:end])
+        accumulator.flush(dset)
+
+
+@pytest.fixture
+def dset(tmp_path):
+    with h5py.File(tmp_path / 'out.h5', 'w') as f:
+        yield f.create_dataset('/exchange/data', (25, 20, 5), dtype='float32', chunks=(4, 20, 5))
+
+
+@pytest.mark.parametrize('ntheta,ntheta_out,ptheta', [(70, 25, 8), (70, 25, 100), (50, 25, 7), (13, 25, 4)])
+@pytest.mark.parametrize('window', [1, 4, 10, 25])
+def test_window_chunks_cover_each_projection_once(ntheta, ntheta_out, ptheta, window):
+    seen = []
+    for start, stop in accumulate.plan_windows(ntheta_out, window):
+        for st, end in accumulate.window_chunks(ntheta, ntheta_out, start, stop, ptheta):
+            assert 0 < end - st <= ptheta
+            assert all(start <= i % ntheta_out < stop for i in range(st, end))
+            seen.extend(range(st, end))
+    assert sorted(seen) == list(range(ntheta))
+
+
+def test_plan_windows():
+    assert accumulate.plan_windows(10, 4) == [(0, 4), (4, 8), (8, 10)]
+    assert accumulate.plan_windows(10, 10) == [(0, 10)]
+
+
+def test_window_size(tmp_path, dset):
+    bytes_per_angle = 20 * 5 * 4
+    params = accumulator_params(tmp_path, accumulator_max_memory=9 * bytes_per_angle / 2**30)
+    # Aligned down to the 4 angle chunks of the dataset
+    assert accumulate.window_size(params, dset) == 8
+    params.accumulator_max_memory = 1.0
+    assert accumulate.window_size(params, dset) == 25
+    params.checkpoint_angles = 10
+    assert accumulate.window_size(params, dset) == 8
+    params.accumulator_max_memory = 1e-9
+    assert accumulate.window_size(params, dset) == 1
+    assert accumulate.window_size(params, dset, memory=False) == 8
+
+
+def test_memory_accumulator_repeated_angles_and_clipped_rows():
+    data, rows = scan(ntheta=60)
+    rows = rows - 3
+    acc = accumulate.MemoryAccumulator(25, 20, 5)
+    acc.reset(0, 25)
+    # One chunk that wraps around all output angles, and rows above the top
+    acc.add(np.arange(60) % 25, rows, data)
+    expected = np.zeros((25, 26, 5), dtype='float32')
+    for i in range(60):
+        expected[i % 25, rows[i] + 3:rows[i] + 9] += data[i]
+    np.testing.assert_allclose(acc.buffer, expected[:, 3:23], rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize('window', [1, 4, 8, 25])
+def test_memory_windows_match_direct_sum(tmp_path, dset, window):
+    data, rows = scan()
+    acc = accumulate.MemoryAccumulator(window, 20, 5)
+    merge_windows(acc, window, data, rows, dset, 8)
+    np.testing.assert_allclose(dset[...], direct_sum(data, rows, 25, 20), rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize('window', [4, 25])
+def test_memmap_windows_match_memory(tmp_path, dset, window):
+    data, rows = scan()
+    merge_windows(accumulate.MemoryAccumulator(window, 20, 5), window, data, rows, dset, 8)
+    expected = dset[...]
+    dset[...] = 0
+    acc = accumulate.MemmapAccumulator(window, 20, 5, str(tmp_path), 3)
+    assert os.path.exists(acc.path)
+    merge_windows(acc, window, data, rows, dset, 8)
+    acc.close()
+    assert not os.path.exists(acc.path)
+    np.testing.assert_array_equal(dset[...], expected)
+
+
+def test_memmap_close_can_keep_scratch_file(tmp_path):
+    acc = accumulate.MemmapAccumulator(4, 3, 2, str(tmp_path), 4)
+    acc.reset(0, 4)
+    acc.add(np.arange(4), np.zeros(4, dtype=int), np.ones((4, 3, 2), dtype='float32'))
+    acc.close(remove=False)
+    kept = np.memmap(acc.path, dtype='float32', mode='r', shape=(4, 3, 2))
+    np.testing.assert_array_equal(kept, 1)
+
+
+def test_direct_accumulator_matches_direct_sum(dset):
+    data, rows = scan()
+    rows[:3] -= 2
+    acc = accumulate.DirectAccumulator(dset)
+    acc.reset(0, 25)
+    for st in range(0, 70, 8):
+        acc.add(np.arange(st, min(st + 8, 70)) % 25, rows[st:st + 8], data[st:st + 8])
+    expected = np.zeros((25, 22, 5), dtype='float32')
+    for i in range(70):
+        expected[i % 25, rows[i] + 2:rows[i] + 8] += data[i]
+    np.testing.assert_allclose(dset[...], expected[:, 2:], rtol=1e-6, atol=1e-6)
+
+
+def test_make_accumulator(tmp_path, dset):
+    acc, window = accumulate.make_accumulator(accumulator_params(tmp_path), dset)
+    assert isinstance(acc, accumulate.MemoryAccumulator) and window == 25
+    acc, window = accumulate.make_accumulator(accumulator_params(tmp_path, accumulator='hdf5'), dset)
+    assert isinstance(acc, accumulate.DirectAccumulator) and window == 25
+    # The memmap window is capped by checkpoint-angles, not by the memory budget
+    params = accumulator_params(tmp_path, accumulator='memmap', checkpoint_angles=8, accumulator_max_memory=1e-9)
+    acc, window = accumulate.make_accumulator(params, dset)
+    assert isinstance(acc, accumulate.MemmapAccumulator) and window == 8
+    assert acc.buffer.shape == (8, 20, 5)
+    acc.close()
+    # Over the scratch cap it falls back to memory
+    params = accumulator_params(tmp_path, accumulator='memmap', scratch_max_size=1e-9)
+    acc, window = accumulate.make_accumulator(params, dset)
+    assert type(acc) is accumulate.MemoryAccumulator
+
+
+def test_reduce_partials(tmp_path, dset):
+    data, rows = scan()
+    paths = []
+    for part, (lo, hi) in enumerate([(0, 30), (30, 70)]):
+        row_lo = int(rows[lo:hi].min())
+        nrows = int(rows[lo:hi].max()) + 6 - row_lo
+        acc = accumulate.MemmapAccumulator(25, nrows, 5, str(tmp_path), 25)
+        acc.reset(0, 25)
+        acc.add(np.arange(lo, hi) % 25, rows[lo:hi] - row_lo, data[lo:hi])
+        acc.close(remove=False)
+        paths.append((acc.path, row_lo, nrows))
+    accumulate.reduce_partials(paths, dset, 7)
+    np.testing.assert_allclose(dset[...], direct_sum(data, rows, 25, 20), rtol=1e-6, atol=1e-6)
+
+
+def test_growable_accumulator(tmp_path, dset):
+    data, rows = scan()
+    # Rows relative to projection 30, so the first ones are negative
+    relative = rows - rows[30]
+    acc = accumulate.GrowableAccumulator(25, 5)
+    for st in list(range(30, 70, 8)) + list(range(0, 30, 8)):
+        end = min(st + 8, 70 if st >= 30 else 30)
+        acc.add(np.arange(st, end) % 25, relative[st:end], data[st:end])
+    assert acc.row0 <= relative.min()
+    acc.flush(dset, int(rows[30]), 4)
+    np.testing.assert_allclose(dset[...], direct_sum(data, rows, 25, 20), rtol=1e-6, atol=1e-6)
+    # Rows outside the dataset are dropped
+    dset[...] = 0
+    acc.flush(dset, int(rows[30]) - 5, 4)
+    np.testing.assert_allclose(dset[:, :15], direct_sum(data, rows, 25, 20)[:, 5:], rtol=1e-6, atol=1e-6)
+    np.testing.assert_array_equal(dset[:, 15:], 0)
+
+
+def test_growable_accumulator_rows(tmp_path, dset):
+    data, rows = scan()
+    acc = accumulate.GrowableAccumulator(25, 5, rows=(4, 13))
+    for st in range(0, 70, 8):
+        acc.add(np.arange(st, min(st + 8, 70)) % 25, rows[st:st+8], data[st:st+8])
+    # Only the rows that are kept are in memory
+    assert acc.row0 >= 4 and acc.row0 + acc.buffer.shape[1] <= 13
+    acc.flush(dset, 0, 4)
+    expected = direct_sum(data, rows, 25, 20)
+    np.testing.assert_allclose(dset[:, 4:13], expected[:, 4:13], rtol=1e-6, atol=1e-6)
+    np.testing.assert_array_equal(dset[:, :4], 0)
+    np.testing.assert_array_equal(dset[:, 13:], 0)
+
+
+def test_growable_accumulator_memory_cap(dset):
+    data, rows = scan()
+    acc = accumulate.GrowableAccumulator(25, 5, max_bytes=25 * 5 * 4 * 12)
+    acc.add(np.arange(0, 8) % 25, rows[:8], data[:8])
+    assert acc.buffer.nbytes <= 25 * 5 * 4 * 12
+    with pytest.raises(RuntimeError):
+        for st in range(8, 70, 8):
+            acc.add(np.arange(st, min(st + 8, 70)) % 25, rows[st:st+8], data[st:st+8])
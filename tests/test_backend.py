@@ -0,0 +1,24 @@
+import sys
+
+import numpy as np
+import pytest
+
+from merge_helical import backend
+
+
+def test_auto_falls_back_to_numpy_without_cupy(monkeypatch):
+    # A None entry in sys.modules makes the import fail
+    monkeypatch.setitem(sys.modules, 'cupy', None)
+    assert type(backend.get_backend('auto')) is backend.NumpyBackend
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        backend.get_backend('opencl')
+
+
+def test_numpy_backend_ffts():
+    be = backend.get_backend('numpy', workers=2)
+    data = np.random.default_rng(0).standard_normal((3, 8, 6)).astype('float32')
+    np.testing.assert_allclose(be.irfft(be.rfft(data, axis=1), n=8, axis=1), data, atol=1e-5)
+    np.testing.assert_allclose(be.irfft2(be.rfft2(data), s=data.shape[1:]), data, atol=1e-5)
@@ -0,0 +1,214 @@
+import os
+
+import numpy as np
+import pytest
+import scipy.integrate
+
+from conftest import make_scan
+
+for module in ('tomopy', 'tomopy_cli'):
+    pytest.importorskip(module)
+
+from merge_helical import beamhardening
+
+
+@pytest.fixture
+def softener_params(tmp_path, merge_params):
+    '''Merge parameters with the beam hardening correction on and a private cache.'''
+    def build(**overrides):
+        overrides = dict(dict(beam_hardening_method='standard', beam_hardening_cache_dir=str(tmp_path / 'cache'),
+                              filter_1_material='Al', filter_1_thickness=500.0), **overrides)
+        return merge_params(make_scan(tmp_path / 'scan.h5'), **overrides)
+    return build
+
+
+def test_calibration_cache(softener_params, monkeypatch):
+    first = beamhardening.BeamSoftener(softener_params())
+    trans = np.linspace(0.01, 1, 101)
+
+    def recalibrate(self):
+        raise AssertionError('calibration not loaded from the cache')
+    monkeypatch.setattr(beamhardening.BeamSoftener, 'ffind_calibration', recalibrate)
+    cached = beamhardening.BeamSoftener(softener_params())
+    np.testing.assert_array_equal(cached.centerline_spline(trans), first.centerline_spline(trans))
+    np.testing.assert_array_equal(cached.angular_spline(trans), first.angular_spline(trans))
+    # Another calibration is not in the cache
+    with pytest.raises(AssertionError):
+        beamhardening.BeamSoftener(softener_params(filter_1_thickness=750.0))
+
+
+def test_get_softener_reuses_softener(softener_params):
+    params = softener_params()
+    softener = beamhardening.get_softener(params)
+    assert beamhardening.get_softener(softener_params()) is softener
+    assert beamhardening.get_softener(softener_params(filter_1_thickness=750.0)) is not softener
+
+
+def test_calibration_cache_follows_data_files(softener_params, tmp_path, monkeypatch):
+    import shutil
+    data_path = tmp_path / 'data'
+    shutil.copytree(beamhardening.data_path, data_path)
+    monkeypatch.setattr(beamhardening, 'data_path', data_path)
+    beamhardening.BeamSoftener(softener_params())
+    calibrations = []
+    find_calibration = beamhardening.BeamSoftener.ffind_calibration
+
+    def counted(self):
+        calibrations.append(self)
+        find_calibration(self)
+    monkeypatch.setattr(beamhardening.BeamSoftener, 'ffind_calibration', counted)
+    beamhardening.BeamSoftener(softener_params())
+    assert not calibrations
+    # A changed spectrum file invalidates the calibration
+    spectrum = data_path / 'Psi_00urad.dat'
+    stat = spectrum.stat()
+    os.utime(spectrum, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    beamhardening.BeamSoftener(softener_params())
+    assert len(calibrations) == 1
+
+
+def test_lut_matches_spline(softener_params):
+    softener = beamhardening.BeamSoftener(softener_params(beam_hardening_engine='lut'))
+    lut = softener.lut
+    assert lut is not None
+    spline = softener.centerline_spline
+    assert lut.fvalidate(spline) <= beamhardening.LUT_TOLERANCE
+    trans_min, trans_max = softener.centerline_points[0][[0, -1]]
+    rng = np.random.default_rng(0)
+    trans = np.concatenate((rng.uniform(trans_min, trans_max, 100000),
+                            np.geomspace(trans_min, trans_max, 10000))).astype(np.float32)
+    scale = np.abs(lut.table).max()
+    assert np.abs(lut(trans) - spline(trans)).max() / scale <= beamhardening.LUT_TOLERANCE
+    # Clamped outside the table like the spline, NaN passed through
+    outside = np.array([trans_min / 2, trans_max * 2, np.nan], dtype=np.float32)
+    result = lut(outside)
+    np.testing.assert_allclose(result[:2], spline(outside[:2]), rtol=0, atol=beamhardening.LUT_TOLERANCE * scale)
+    assert np.isnan(result[2])
+
+
+def loop_effective_transmission(softener, spectrum):
+    '''Effective transmission computed one sample thickness at a time.'''
+    def detected(incident):
+        absorbed = softener.scintillator_material.fcompute_absorbed_spectrum(softener.scintillator_thickness,
+                                                                             incident)
+        return scipy.integrate.simpson(absorbed.spectral_power, x=absorbed.energies)
+    trans = [detected(softener.sample_material.fcompute_transmitted_spectrum(thickness, spectrum))
+             for thickness in beamhardening.SAMPLE_THICKNESSES]
+    return np.array(trans) / detected(spectrum)
+
+
+def test_vectorized_calibration_matches_loop(softener_params):
+    softener = beamhardening.BeamSoftener(softener_params(beam_hardening_cache_dir='none'))
+    softener.fread_source_data()
+    spectra = [beamhardening.fapply_filters(softener.filters, softener.spectra_dict[angle])
+               for angle in sorted(softener.spectra_dict)]
+    trans = softener.fcompute_effective_transmission(spectra[0].energies,
+                                                     np.stack([s.spectral_power for s in spectra]))
+    for spectrum, angle_trans in zip(spectra, trans):
+        np.testing.assert_allclose(angle_trans, loop_effective_transmission(softener, spectrum), rtol=1e-10)
+    usable_trans, usable_thicknesses = softener.ffind_calibration_one_angle(spectra[0])
+    np.testing.assert_allclose(softener.centerline_points[0], usable_trans, rtol=1e-12)
+    np.testing.assert_array_equal(softener.centerline_points[1], usable_thicknesses)
+
+
+def test_table_cache(tmp_path, monkeypatch):
+    source = tmp_path / 'table.dat'
+    source.write_text('# energy value\n1 2\n3 4\n')
+    cache_dir = tmp_path / 'cache'
+    np.testing.assert_array_equal(beamhardening.fload_table(source, cache_dir), [[1, 2], [3, 4]])
+    assert (cache_dir / 'tables' / 'table.dat.npz').exists()
+    genfromtxt = np.genfromtxt
+    parsed = []
+    monkeypatch.setattr(np, 'genfromtxt', lambda *args, **kwargs: parsed.append(args) or genfromtxt(*args, **kwargs))
+    np.testing.assert_array_equal(beamhardening.fload_table(source, cache_dir), [[1, 2], [3, 4]])
+    assert not parsed
+    # Same size, new modification time
+    source.write_text('# energy value\n5 6\n7 8\n')
+    stat = source.stat()
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    np.testing.assert_array_equal(beamhardening.fload_table(source, cache_dir), [[5, 6], [7, 8]])
+    assert len(parsed) == 1
+
+
+def test_materials_load_on_lookup(tmp_path, monkeypatch):
+    loaded = []
+    monkeypatch.setattr(beamhardening, 'get_material', lambda name, density, cache_dir=None: loaded.append(name))
+    materials = beamhardening.LazyMaterials(tmp_path)
+    materials.densities.update(Fe=7.87, Al=2.7)
+    assert 'Fe' in materials and len(materials) > 1
+    assert not loaded
+    materials['Fe']
+    assert loaded == ['Fe']
+
+
+def test_spectrum_value_type():
+    spectrum = beamhardening.Spectrum(np.linspace(1, 100, 51), np.linspace(2, 3, 51))
+    assert not hasattr(spectrum, '__dict__')
+    copy = spectrum.copy()
+    assert copy.energies is spectrum.energies
+    copy.spectral_power *= 2
+    np.testing.assert_array_equal(spectrum.spectral_power, np.linspace(2, 3, 51))
+    assert spectrum.fintegrated_power() == pytest.approx(
+                scipy.integrate.simpson(spectrum.spectral_power, x=spectrum.energies), rel=1e-12)
+    with pytest.raises(ValueError):
+        beamhardening.Spectrum(np.arange(3.), np.arange(4.))
+
+
+def test_material_memoization(tmp_path):
+    iron = beamhardening.get_material('Fe', 7.87, tmp_path)
+    assert beamhardening.get_material('Fe', 7.87, tmp_path) is iron
+    assert beamhardening.get_material('Fe', 7.0, tmp_path) is not iron
+    energies = np.linspace(10, 100, 91)
+    coefficients = iron.finterpolate_attenuation(energies)
+    assert iron.finterpolate_attenuation(energies.copy()) is coefficients
+    assert not coefficients.flags.writeable
+    np.testing.assert_allclose(coefficients,
+                               np.exp(iron.attenuation_interpolation_function(np.log(energies))), rtol=1e-12)
+    assert iron.finterpolate_absorption(energies) is not coefficients
+    spectrum = beamhardening.Spectrum(energies, np.ones(91))
+    out = iron.fcompute_transmitted_spectrum(100.0, spectrum, out=spectrum)
+    assert out is spectrum
+    np.testing.assert_allclose(spectrum.spectral_power, np.exp(-coefficients * 100.0 / 1e4 * 7.87))
+
+
+@pytest.mark.parametrize('engine', ['spline', 'lut'])
+def test_fcorrect_chunk(softener_params, engine):
+    softener = beamhardening.BeamSoftener(softener_params(beam_hardening_engine=engine))
+    rng = np.random.default_rng(0)
+    trans = rng.uniform(0.05, 1, (6, 12, 40)).astype(np.float32)
+    rows = (5, 17)
+    # Reference: whole detector images through the splines, rows 5:17 of them
+    full = np.ones((6, 17, 40), dtype=np.float32)
+    full[:, 5:] = trans
+    expected = np.stack([softener.fcorrect_as_pathlength(image) for image in full])[:, 5:]
+    serial = softener.fcorrect_chunk(trans.copy(), rows, threads=1)
+    scale = np.abs(expected).max()
+    assert np.abs(serial - expected).max() / scale <= 2 * beamhardening.LUT_TOLERANCE
+    threaded = softener.fcorrect_chunk(trans.copy(), rows, threads=4, block=64)
+    np.testing.assert_array_equal(threaded, serial)
+    single = softener.fcorrect_chunk(trans[2].copy(), rows, threads=4, block=64)
+    np.testing.assert_array_equal(single, serial[2])
+
+
+def test_fcalibrate_batch_matches_softener(softener_params, tmp_path):
+    filter_sets = [{'Al': 500.0}, {'Al': 750.0, 'Cu': 20.0}]
+    scintillators = [('LuAG_Ce', 100.0), ('LYSO_Ce', 50.0)]
+    samples = ['Fe', 'Al']
+    batch = beamhardening.fcalibrate_batch(filter_sets, scintillators, samples, tmp_path / 'cache')
+    nangles = batch['angles_urad'].size
+    assert batch['effective_transmission'].shape == (2, 2, 2, nangles, beamhardening.SAMPLE_THICKNESSES.size)
+    assert batch['angular_correction'].shape == (2, 2, 2, nangles)
+    for f, s, m in [(0, 0, 0), (1, 1, 1), (1, 0, 1)]:
+        filters = dict(filter_1_material='Al', filter_1_thickness=filter_sets[f]['Al'])
+        if 'Cu' in filter_sets[f]:
+            filters.update(filter_2_material='Cu', filter_2_thickness=filter_sets[f]['Cu'])
+        softener = beamhardening.BeamSoftener(softener_params(
+                        scintillator_material=scintillators[s][0], scintillator_thickness=scintillators[s][1],
+                        sample_material=samples[m], **filters))
+        softener.fread_source_data()
+        spectra = [beamhardening.fapply_filters(softener.filters, softener.spectra_dict[angle])
+                   for angle in batch['angles_urad']]
+        trans = softener.fcompute_effective_transmission(spectra[0].energies,
+                                                         np.stack([sp.spectral_power for sp in spectra]))
+        np.testing.assert_allclose(batch['effective_transmission'][f, s, m], trans, rtol=1e-10)
+        np.testing.assert_allclose(batch['angular_correction'][f, s, m], softener.angular_points[1], rtol=1e-8)
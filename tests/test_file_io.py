@@ -0,0 +1,79 @@
+import shutil
+
+import h5py
+import numpy as np
+import pytest
+
+from conftest import make_scan
+
+for module in ('tomopy', 'tomopy_cli', 'dxchange', 'dxfile'):
+    pytest.importorskip(module)
+
+from merge_helical import config, file_io
+
+
+def test_read_references(tmp_path, merge_params, monkeypatch):
+    file_io.clear_reference_cache()
+    path = make_scan(tmp_path / 'scan.h5')
+    # A few rows of the stacks at a time
+    params = merge_params(path, reference_block_size=5 * 4 * 16 * 2 / 2**20)
+    flat, dark = file_io.read_references(params, (3, 10))
+    with h5py.File(path, 'r') as f:
+        expected = [np.median(f['/exchange/' + name][...], axis=0).astype('uint16')[None]
+                    for name in ('data_white', 'data_dark')]
+    for reference, median in zip((flat, dark), expected):
+        assert reference.dtype == np.uint16
+        np.testing.assert_array_equal(reference, median[:, 3:10])
+    # The medians are kept, for this file and for a copy of it, and callers get copies
+    flat[...] = 0
+
+    def median_reference(dset, block_bytes):
+        raise AssertionError('median computed again')
+    monkeypatch.setattr(file_io, '_median_reference', median_reference)
+    shutil.copy(path, tmp_path / 'copy.h5')
+    for name in (path, tmp_path / 'copy.h5'):
+        for reference, median in zip(file_io.read_references(merge_params(name), (0, 24)), expected):
+            np.testing.assert_array_equal(reference, median)
+
+
+@pytest.fixture
+def scan_file(tmp_path):
+    path = make_scan(tmp_path / 'scan.h5')
+    with h5py.File(path, 'r+') as f:
+        f['/measurement/instrument/detector/exposure_time'].attrs['units'] = np.bytes_('s')
+        f['/measurement/instrument/name'] = np.array([ord(c) for c in '7-BM-B'] + [0, 0], dtype='uint8')[None]
+        f['/process/acquisition/big'] = np.arange(70000.)
+        # Not visited by the walk
+        f['/measurement/exposure'] = h5py.SoftLink('/measurement/instrument/detector/exposure_time')
+    return path
+
+
+def test_snapshot_matches_file(scan_file):
+    snapshot = file_io.MetadataSnapshot(scan_file)
+    with h5py.File(scan_file, 'r') as f:
+        names = []
+        f.visit(names.append)
+        names += ['measurement/exposure']
+        for name in names:
+            obj = f[name]
+            assert name in snapshot
+            assert dict(obj.attrs) == snapshot.attributes(name)
+            if isinstance(obj, h5py.Dataset):
+                assert snapshot.shape(name) == obj.shape
+                np.testing.assert_array_equal(snapshot[name], obj[()])
+    assert '/measurement/nothing' not in snapshot
+    with pytest.raises(KeyError):
+        snapshot['/measurement/nothing']
+
+
+@pytest.mark.parametrize('path,kwargs', [
+    ('/measurement/instrument/detector/exposure_time', {}),
+    ('/measurement/exposure', {}),
+    ('/measurement/instrument/detector/exposure_time', dict(attr='units')),
+    ('/measurement/exposure', dict(attr='units')),
+    ('/measurement/instrument/name', dict(char_array=True)),
+    ('/measurement/nothing', {}),
+    ])
+def test_snapshot_param(scan_file, path, kwargs):
+    snapshot = file_io.MetadataSnapshot(scan_file)
+    assert snapshot.param(path, **kwargs) == config.param_from_dxchange(scan_file, path, **kwargs)
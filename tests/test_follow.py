@@ -0,0 +1,113 @@
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from conftest import make_scan, merged
+
+# Appends the projections of a finished scan to a new file in SWMR mode,
+# as an acquisition does, and fills in the end date when it is done.  The
+# flat and dark images are written at the start, at the end, or one at
+# the start and the rest at the end.
+WRITER = r'''
+import sys, time
+import h5py
+import numpy as np
+source, target, chunk, pause, refs = sys.argv[1], sys.argv[2], int(sys.argv[3]), float(sys.argv[4]), sys.argv[5]
+growing = ('exchange/data', 'exchange/theta') + (('exchange/data_white', 'exchange/data_dark') if refs != 'start' else ())
+with h5py.File(source, 'r') as f:
+    data = f['/exchange/data'][...]
+    theta = f['/exchange/theta'][...]
+    references = {name: f[name][...] for name in ('exchange/data_white', 'exchange/data_dark')}
+    copied = {}
+    f.visititems(lambda name, obj: copied.update({name: obj[...]})
+                 if isinstance(obj, h5py.Dataset) and name not in growing else None)
+with h5py.File(target, 'w', libver='latest') as f:
+    for name, value in copied.items():
+        f[name] = value
+    f.create_dataset('/process/acquisition/end_date', data=np.array([b''], dtype='S32'))
+    first = {'start': 0, 'last': 0, 'partial': 1}[refs]
+    if refs != 'start':
+        for name, value in references.items():
+            f.create_dataset(name, data=value[:first], maxshape=(None,) + value.shape[1:],
+                             chunks=(1,) + value.shape[1:])
+    dset = f.create_dataset('/exchange/data', (0,) + data.shape[1:], maxshape=(None,) + data.shape[1:],
+                            dtype=data.dtype, chunks=(1,) + data.shape[1:])
+    tset = f.create_dataset('/exchange/theta', (0,), maxshape=(None,), dtype=theta.dtype)
+    f.swmr_mode = True
+    print('ready', flush=True)
+    for st in range(0, len(data), chunk):
+        end = min(st + chunk, len(data))
+        dset.resize(end, axis=0)
+        dset[st:end] = data[st:end]
+        dset.flush()
+        tset.resize(end, axis=0)
+        tset[st:end] = theta[st:end]
+        tset.flush()
+        time.sleep(pause)
+    if refs != 'start':
+        for name, value in references.items():
+            f[name].resize(len(value), axis=0)
+            f[name][first:] = value[first:]
+            f[name].flush()
+    f['/process/acquisition/end_date'][0] = b'2026-10-17'
+    f['/process/acquisition/end_date'].flush()
+'''
+
+
+@pytest.mark.parametrize('pixels_per_360', [30.0, -30.0])
+@pytest.mark.parametrize('overrides', [dict(), dict(shift_method='cubic', pipeline_workers=2),
+                                       dict(z_start=5, z_end=30, sinogram_output='dataset'),
+                                       dict(shift_method='cubic', z_start=12)])
+def test_follow_matches_merge_of_finished_scan(tmp_path, merge_params, pixels_per_360, overrides):
+    follow_and_compare(tmp_path, merge_params, pixels_per_360, overrides, 'start')
+
+
+@pytest.mark.parametrize('refs', ['last', 'partial'])
+def test_follow_with_late_references(tmp_path, merge_params, refs):
+    follow_and_compare(tmp_path, merge_params, 30.0, dict(), refs)
+
+
+def follow_and_compare(tmp_path, merge_params, pixels_per_360, overrides, refs):
+    from merge_helical import merge_helical
+    source = make_scan(tmp_path / 'scan.h5', ntheta=130, pixels_per_360=pixels_per_360)
+    merge_helical.merge_helical(merge_params(source, **overrides))
+    expected = merged(source)
+
+    target = tmp_path / 'live.h5'
+    writer = subprocess.Popen([sys.executable, '-c', WRITER, str(source), str(target), '7', '0.05', refs],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        assert writer.stdout.readline().strip() == 'ready'
+        merge_helical.merge_helical(merge_params(target, follow=True, follow_interval=0.02, follow_timeout=60,
+                                                 proj_chunk_size=8, **overrides))
+    finally:
+        writer.wait(60)
+    assert writer.returncode == 0
+    np.testing.assert_array_equal(merged(target), expected)
+
+
+def test_follow_times_out_without_marker(tmp_path, merge_params):
+    from merge_helical import merge_helical
+    path = make_scan(tmp_path / 'scan.h5')
+    merge_helical.merge_helical(merge_params(path))
+    expected = merged(path)
+    merge_helical.merge_helical(merge_params(path, follow=True, follow_interval=0.01, follow_timeout=0.1))
+    np.testing.assert_array_equal(merged(path), expected)
+
+
+@pytest.mark.parametrize('overrides', [dict(x_auto=True), dict(accumulator='memmap'), dict(accumulator='hdf5')])
+def test_follow_rejects_options(tmp_path, merge_params, overrides):
+    from merge_helical import merge_helical
+    path = make_scan(tmp_path / 'scan.h5')
+    with pytest.raises(ValueError):
+        merge_helical.merge_helical(merge_params(path, follow=True, **overrides))
+
+
+def test_follow_memory_cap(tmp_path, merge_params):
+    from merge_helical import merge_helical
+    path = make_scan(tmp_path / 'scan.h5')
+    with pytest.raises(RuntimeError):
+        merge_helical.merge_helical(merge_params(path, follow=True, follow_interval=0.01, follow_timeout=0.1,
+                                                 accumulator_max_memory=1e-5))
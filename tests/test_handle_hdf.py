@@ -0,0 +1,69 @@
+import h5py
+import numpy as np
+import pytest
+
+from merge_helical import handle_hdf
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'source.h5'
+    rng = np.random.default_rng(0)
+    with h5py.File(path, 'w') as f:
+        exchange = f.create_group('exchange')
+        exchange.attrs['description'] = np.bytes_('raw data')
+        exchange['data'] = rng.integers(0, 100, (4, 5, 6)).astype('uint16')
+        exchange['theta'] = np.arange(4.)
+        exchange['theta'].attrs['units'] = np.bytes_('deg')
+        sub = exchange.create_group('extra/deeper')
+        sub.attrs['level'] = 2
+        sub['values'] = rng.standard_normal(50)
+        sub['values'].attrs['scale'] = 1.5
+        f['/measurement/large'] = rng.standard_normal((40, 30))
+        f['/measurement/large'].attrs['units'] = np.bytes_('mm')
+        f['/measurement'].attrs['note'] = np.bytes_('kept whole')
+    return path
+
+
+def tree(f):
+    '''Every object of *f* with its attributes and, for datasets, its data.'''
+    items = {}
+
+    def visit(name, obj):
+        data = obj[()] if isinstance(obj, h5py.Dataset) else None
+        items[name] = (dict(obj.attrs), data)
+    f.visititems(visit)
+    return items
+
+
+def assert_same_tree(expected, actual):
+    assert sorted(expected) == sorted(actual)
+    for name, (attrs, data) in expected.items():
+        assert attrs.keys() == actual[name][0].keys()
+        for key, value in attrs.items():
+            np.testing.assert_array_equal(actual[name][0][key], value)
+        if data is not None:
+            np.testing.assert_array_equal(actual[name][1], data)
+
+
+@pytest.mark.parametrize('compression,stream_bytes', [(None, handle_hdf.STREAM_BYTES), ('gzip', 1024)])
+def test_copy_h5_split_group(tmp_path, source, compression, stream_bytes):
+    with h5py.File(source, 'r') as fin, h5py.File(tmp_path / 'out.h5', 'w') as fout:
+        report = handle_hdf.copy_h5(fin, fout, ['data'], compression=compression, stream_bytes=stream_bytes)
+        expected = {name: item for name, item in tree(fin).items() if name != 'exchange/data'}
+        assert_same_tree(expected, tree(fout))
+        if compression:
+            assert fout['/measurement/large'].compression == compression
+            assert report['streamed_bytes'] == fin['/measurement/large'].nbytes
+        else:
+            assert report['streamed_bytes'] == 0
+
+
+def test_copy_h5_copies_group_with_unreadable_attributes_whole(tmp_path, source, monkeypatch):
+    # Pretend h5py cannot read the attributes of /exchange, as for some vendor files
+    compatible = handle_hdf.h5py_compatible_attributes
+    monkeypatch.setattr(handle_hdf, 'h5py_compatible_attributes',
+                        lambda obj: obj.name != '/exchange' and compatible(obj))
+    with h5py.File(source, 'r') as fin, h5py.File(tmp_path / 'out.h5', 'w') as fout:
+        handle_hdf.copy_h5(fin, fout, ['data'])
+        assert_same_tree(tree(fin), tree(fout))
@@ -0,0 +1,60 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+
+from merge_helical.journal import MergeJournal, merge_signature
+
+
+def journal_params(tmp_path, **overrides):
+    raw = tmp_path / 'scan.h5'
+    if not raw.exists():
+        raw.write_bytes(b'raw data')
+    params = SimpleNamespace(file_name=raw, shift_method='fft', final_shifts=np.arange(4.0),
+                             pipeline_workers=1, resume=False)
+    for name, value in overrides.items():
+        setattr(params, name, value)
+    return params
+
+
+def test_signature_follows_output_changing_params(tmp_path):
+    signature = merge_signature(journal_params(tmp_path))
+    assert merge_signature(journal_params(tmp_path)) == signature
+    # Runtime options do not change the merged data
+    assert merge_signature(journal_params(tmp_path, pipeline_workers=8, resume=True)) == signature
+    assert merge_signature(journal_params(tmp_path, shift_method='cubic')) != signature
+    assert merge_signature(journal_params(tmp_path, final_shifts=np.arange(5.0))) != signature
+    assert merge_signature(journal_params(tmp_path), 'extra') != signature
+
+
+def test_signature_follows_input_file(tmp_path):
+    params = journal_params(tmp_path)
+    signature = merge_signature(params)
+    params.file_name.write_bytes(b'other raw data')
+    assert merge_signature(params) != signature
+
+
+def test_commit_load_and_remove(tmp_path):
+    path = tmp_path / 'scan_merged.journal'
+    journal = MergeJournal(path, 'abc')
+    assert not journal.load()
+    journal.commit('windows', 0)
+    journal.commit('windows', 3)
+    journal.commit('partials', 1, ['/tmp/part.acc', 10, 20])
+    assert not os.path.exists(str(path) + '.tmp')
+
+    resumed = MergeJournal(path, 'abc')
+    assert resumed.load()
+    assert set(resumed.committed('windows')) == {'0', '3'}
+    assert resumed.committed('partials') == {'1': ['/tmp/part.acc', 10, 20]}
+    assert resumed.committed('reduce') == {}
+
+    other = MergeJournal(path, 'def')
+    assert not other.load()
+    assert other.committed('windows') == {}
+    assert set(other.stale()['windows']) == {'0', '3'}
+
+    resumed.remove()
+    assert not path.exists()
+    assert resumed.committed('windows') == {}
+    assert other.stale() == {}
@@ -0,0 +1,131 @@
+import threading
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from conftest import make_scan, merged
+
+
+def run_merge(params):
+    from merge_helical import merge_helical
+    merge_helical.merge_helical(params)
+    return merged(params.file_name)
+
+
+@pytest.mark.parametrize('workers,depth', [(2, 1), (4, 2), (8, 1)])
+def test_workers_match_serial_merge_with_slow_worker(tmp_path, merge_params, monkeypatch, workers, depth):
+    from merge_helical import prep
+    path = make_scan(tmp_path / 'scan.h5', ntheta=200)
+    reference = run_merge(merge_params(path, pipeline_depth=0, proj_chunk_size=4, shift_method='fft2'))
+
+    # Stall the first chunk in the middle of its preprocessing, while the
+    # other workers run ahead, so a reused read buffer would corrupt it
+    original = prep.all
+    calls = []
+    lock = threading.Lock()
+
+    def slow_all(proj, *args, **kwargs):
+        with lock:
+            calls.append(None)
+            first = len(calls) == 1
+        if first:
+            time.sleep(0.5)
+        return original(proj, *args, **kwargs)
+
+    monkeypatch.setattr(prep, 'all', slow_all)
+    out = run_merge(merge_params(path, pipeline_depth=depth, pipeline_workers=workers, proj_chunk_size=4,
+                                 shift_method='fft2'))
+    assert np.array_equal(out, reference)
+
+
+def reference_merge(path, pad=1):
+    '''Straightforward merge of a scan: flat correction, minus log and a 2D FFT shift per projection.'''
+    with h5py.File(path, 'r') as f:
+        proj = f['/exchange/data'][...].astype('float32')
+        flat = np.median(f['/exchange/data_white'][...], axis=0).astype('uint16').astype('float32')
+        dark = np.median(f['/exchange/data_dark'][...], axis=0).astype('uint16').astype('float32')
+        theta = f['/exchange/theta'][...]
+        pixels_per_360 = f['/process/acquisition/pixels_y_per_360_deg'][0]
+    ntheta, ny, nx = proj.shape
+    data = -np.log(np.minimum((proj - dark) / (flat - dark), 1.0))
+    theta_max = theta[theta - theta[0] <= 180][-1]
+    ntheta_out = np.argmin(np.abs(theta - theta_max)) + 1
+    shifts = (theta - theta[0]) / 360 * pixels_per_360
+    ny_out = ny + 2 * pad + int(np.ceil(abs(shifts[-1])))
+    out = np.zeros((ntheta_out, ny_out, nx))
+    y = np.fft.fftfreq(ny + 2 * pad)[:, None]
+    for i in range(ntheta):
+        padded = np.zeros((ny + 2 * pad, nx))
+        padded[pad:ny + pad] = data[i]
+        ishift = np.int32(shifts[i])
+        shifted = np.fft.irfft2(np.exp(-2j * np.pi * y * (shifts[i] - ishift)) * np.fft.rfft2(padded),
+                                s=padded.shape)
+        row = ishift if shifts[1] > shifts[0] else ny_out - 1 + ishift - ny - 2 * pad
+        out[i % ntheta_out, row:row + ny + 2 * pad] += shifted
+    return out
+
+
+@pytest.mark.parametrize('pixels_per_360', [30.0, -30.0])
+def test_fft2_merge_matches_reference(tmp_path, merge_params, pixels_per_360):
+    path = make_scan(tmp_path / 'scan.h5', pixels_per_360=pixels_per_360)
+    out = run_merge(merge_params(path))
+    expected = reference_merge(path)
+    assert out.shape == expected.shape
+    np.testing.assert_allclose(out, expected, rtol=0, atol=1e-5 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize('pixels_per_360', [30.0, -30.0])
+@pytest.mark.parametrize('overrides', [
+    dict(accumulator='hdf5'),
+    dict(accumulator='memmap'),
+    dict(accumulator='memmap', checkpoint_angles=8),
+    dict(accumulator_max_memory=1e-5),
+    dict(checkpoint_angles=5),
+    dict(output_compression='gzip', output_chunks='4,8,8'),
+    dict(pipeline_depth=0),
+    dict(pipeline_workers=3),
+    dict(preprocessing_engine='staged'),
+])
+def test_merge_modes_match_default(tmp_path, merge_params, pixels_per_360, overrides):
+    path = make_scan(tmp_path / 'scan.h5', pixels_per_360=pixels_per_360)
+    expected = run_merge(merge_params(path))
+    out = run_merge(merge_params(path, **overrides))
+    np.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.parametrize('overrides', [dict(nprocs=2), dict(nprocs=3, accumulator_max_memory=1e-5)])
+def test_process_parallel_merge_matches_serial(tmp_path, merge_params, overrides):
+    path = make_scan(tmp_path / 'scan.h5')
+    expected = run_merge(merge_params(path))
+    out = run_merge(merge_params(path, **overrides))
+    # The partial outputs are summed in a different order
+    np.testing.assert_allclose(out, expected, rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize('shift_method', ['fft', 'fft2', 'cubic', 'linear'])
+@pytest.mark.parametrize('z_range', [(0, 20), (17, 40), (30, 56)])
+def test_vertical_range_matches_full_merge(tmp_path, merge_params, shift_method, z_range):
+    path = make_scan(tmp_path / 'scan.h5')
+    expected = run_merge(merge_params(path, shift_method=shift_method))
+    out = run_merge(merge_params(path, shift_method=shift_method, z_start=z_range[0], z_end=z_range[1]))
+    np.testing.assert_array_equal(out, expected[:, z_range[0]:z_range[1]])
+
+
+# fft2 mixes the columns through the Nyquist row, so a crop is not exact with it
+@pytest.mark.parametrize('shift_method', ['fft', 'cubic', 'linear'])
+def test_column_range_matches_full_merge(tmp_path, merge_params, shift_method):
+    path = make_scan(tmp_path / 'scan.h5')
+    expected = run_merge(merge_params(path, shift_method=shift_method))
+    out = run_merge(merge_params(path, shift_method=shift_method, x_start=3, x_end=11))
+    np.testing.assert_array_equal(out, expected[:, :, 3:11])
+
+
+@pytest.mark.parametrize('sinogram_output', ['dataset', 'file'])
+def test_sinogram_output(tmp_path, merge_params, sinogram_output):
+    path = make_scan(tmp_path / 'scan.h5')
+    run_merge(merge_params(path, sinogram_output=sinogram_output, sinogram_block_size=0.001))
+    with h5py.File(tmp_path / 'scan_merged.h5', 'r') as f:
+        np.testing.assert_array_equal(f['/exchange/data_sinogram'][...],
+                                      f['/exchange/data'][...].transpose(1, 0, 2))
@@ -0,0 +1,53 @@
+import threading
+import time
+
+import pytest
+
+from merge_helical import pipeline
+
+
+@pytest.mark.parametrize('depth,workers', [(0, 1), (1, 1), (2, 1), (2, 4), (1, 8)])
+def test_results_written_in_order(depth, workers):
+    written = []
+    pipeline.run_pipeline(list(range(50)), lambda t: t, lambda t, x, w: x * 2,
+                          lambda t, r: written.append((t, r)), depth, workers)
+    assert written == [(t, 2 * t) for t in range(50)]
+
+
+@pytest.mark.parametrize('depth,workers', [(1, 2), (2, 4), (3, 8)])
+def test_stalled_worker_bounds_chunks_in_flight(depth, workers):
+    lock = threading.Lock()
+    state = {'open': 0, 'most': 0}
+
+    def read(task):
+        with lock:
+            state['open'] += 1
+            state['most'] = max(state['most'], state['open'])
+        return task
+
+    def compute(task, item, worker):
+        # The first chunk is slow, so the other workers finish out of order
+        if task == 0:
+            time.sleep(0.5)
+        return item
+
+    def write(task, result):
+        with lock:
+            state['open'] -= 1
+
+    pipeline.run_pipeline(list(range(100)), read, compute, write, depth, workers)
+    assert state['open'] == 0
+    assert state['most'] <= pipeline.in_flight(depth, workers)
+
+
+def test_error_stops_pipeline():
+    def compute(task, item, worker):
+        if task == 7:
+            raise OSError('boom')
+        return item
+
+    written = []
+    with pytest.raises(OSError, match='boom'):
+        pipeline.run_pipeline(list(range(100)), lambda t: t, compute, lambda t, r: written.append(t), 2, 3)
+    assert written == list(range(len(written)))
+    assert 7 not in written
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('overrides', [
+    dict(),
+    dict(minus_log=False, normalization_cutoff=1.2),
+    dict(bright_exp_ratio=2.0, fix_nan_and_inf=True, sinogram_max_value=3.0),
+    dict(bright_exp_ratio=1.37, normalization_cutoff=1.3),
+    dict(bright_exp_ratio=np.float64(0.1) / np.float64(0.073), minus_log=False),
+    dict(bright_exp_ratio=np.float64(0.1) / np.float64(0.073), fix_nan_and_inf=True),
+    dict(flat_correction_method='none', fix_nan_and_inf=True),
+])
+def test_fused_matches_staged(tmp_path, merge_params, overrides):
+    from merge_helical import prep
+    rng = np.random.default_rng(2)
+    proj = rng.integers(0, 1100, (6, 40, 64)).astype('uint16')
+    flat = rng.integers(950, 1050, (5, 40, 64)).astype('uint16')
+    dark = rng.integers(0, 20, (3, 40, 64)).astype('uint16')
+    overrides.setdefault('bright_exp_ratio', 1)
+    staged = prep.all(proj.copy(), flat.copy(), dark.copy(),
+                      merge_params(tmp_path / 'scan.h5', preprocessing_engine='staged', **overrides), (0, 40))
+    fused = prep.all(proj.copy(), flat.copy(), dark.copy(),
+                     merge_params(tmp_path / 'scan.h5', preprocessing_engine='fused', **overrides), (0, 40))
+    assert fused.dtype == np.float32
+    np.testing.assert_array_equal(fused, staged)
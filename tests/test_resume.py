@@ -0,0 +1,67 @@
+import json
+
+import numpy as np
+import pytest
+
+from conftest import make_scan, merged
+
+
+def journal_path(path):
+    return path.parent / (path.stem + '_merged.journal')
+
+
+def crash_after(monkeypatch, nchunks):
+    '''Make the merge fail on chunk *nchunks*, and count the chunks computed.'''
+    from merge_helical import merge_helical
+    original = merge_helical.ChunkProcessor.compute
+    count = [0]
+
+    def compute(self, task, chunk, worker=0):
+        count[0] += 1
+        if count[0] == nchunks:
+            raise OSError('interrupted')
+        return original(self, task, chunk, worker)
+    monkeypatch.setattr(merge_helical.ChunkProcessor, 'compute', compute)
+    return count
+
+
+@pytest.mark.parametrize('overrides', [dict(), dict(accumulator='memmap'), dict(pipeline_depth=0),
+                                       dict(pipeline_workers=3), dict(sinogram_output='dataset')])
+def test_resume_skips_committed_windows(tmp_path, merge_params, monkeypatch, overrides):
+    from merge_helical import merge_helical
+    path = make_scan(tmp_path / 'scan.h5', ntheta=300)
+    settings = dict(checkpoint_angles=8, **overrides)
+    count = crash_after(monkeypatch, -1)
+    merge_helical.merge_helical(merge_params(path, **settings))
+    reference = merged(path)
+    chunks = count[0]
+
+    crash_after(monkeypatch, 20)
+    with pytest.raises(OSError, match='interrupted'):
+        merge_helical.merge_helical(merge_params(path, **settings))
+    committed = json.loads(journal_path(path).read_text())['commits']['windows']
+    assert committed
+
+    count = crash_after(monkeypatch, -1)
+    merge_helical.merge_helical(merge_params(path, resume=True, **settings))
+    assert np.array_equal(merged(path), reference)
+    assert 0 < count[0] < chunks
+    assert not journal_path(path).exists()
+
+
+def test_journal_of_other_merge_is_ignored(tmp_path, merge_params, monkeypatch):
+    from merge_helical import merge_helical
+    path = make_scan(tmp_path / 'scan.h5', ntheta=300)
+    count = crash_after(monkeypatch, -1)
+    merge_helical.merge_helical(merge_params(path, checkpoint_angles=8, shift_method='cubic'))
+    reference = merged(path)
+    chunks = count[0]
+
+    crash_after(monkeypatch, 20)
+    with pytest.raises(OSError, match='interrupted'):
+        merge_helical.merge_helical(merge_params(path, checkpoint_angles=8))
+    count = crash_after(monkeypatch, -1)
+    merge_helical.merge_helical(merge_params(path, checkpoint_angles=8, shift_method='cubic', resume=True))
+    assert np.array_equal(merged(path), reference)
+    # Everything is merged again, nothing is taken from the other merge
+    assert count[0] == chunks
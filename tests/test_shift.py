@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from merge_helical import shift
+
+
+def smooth_projections(ntheta=6, nz=40, n=8):
+    '''Projections of smooth blobs, well inside the rows, so that all kernels agree closely.'''
+    z = np.arange(nz)[None, :, None]
+    centers = np.linspace(14, 26, ntheta)[:, None, None]
+    widths = np.linspace(3, 5, n)[None, None, :]
+    return np.exp(-((z - centers) / widths)**2).astype('float32')
+
+
+def test_default_method_is_fft2():
+    data = smooth_projections()
+    shifts = np.linspace(0, 0.9, 6)
+    np.testing.assert_array_equal(shift.apply_shift(data, shifts), shift.apply_shift(data, shifts, method='fft2'))
+
+
+@pytest.mark.parametrize('method,bound', [('fft', 1e-5), ('cubic', 1e-2), ('linear', 5e-2)])
+def test_kernels_close_to_fft2(method, bound):
+    max_err, rms_err = shift.shift_accuracy(smooth_projections(), np.linspace(0, 0.9, 6), method=method)
+    assert rms_err <= max_err <= bound
+
+
+def test_integer_shift():
+    data = smooth_projections()
+    shifts = np.array([0, 1, 2, -1, 0.4, 1.6])
+    out = shift.apply_shift(data, shifts, pad=2, method='integer')
+    for proj, s, result in zip(data, np.rint(shifts).astype(int), out):
+        expected = np.zeros((44, 8), dtype='float32')
+        expected[2 + s:42 + s] = proj
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_tolerance_leaves_small_shifts():
+    data = smooth_projections(ntheta=2)
+    out = shift.apply_shift(data, [0.001, 0.5], method='cubic', tolerance=0.01)
+    np.testing.assert_array_equal(out[0, 1:-1], data[0])
+    assert not np.array_equal(out[1, 1:-1], data[1])
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        shift.apply_shift(smooth_projections(), np.zeros(6), method='sinc')
+
+
+@pytest.mark.parametrize('method', ['fft2', 'fft', 'cubic', 'linear', 'integer'])
+def test_workspace_matches_apply_shift(method):
+    data = smooth_projections(ntheta=6)
+    shifts = np.array([0.1, 0.35, 0.6, 0.1, 0.35, 0.6])
+    ws = shift.ShiftWorkspace(data.shape, 1, method)
+    # A full chunk, a shorter last chunk, and the full chunk again
+    for chunk in (slice(0, 6), slice(0, 4), slice(0, 6)):
+        expected = shift.apply_shift(data[chunk], shifts[chunk], 1, method)
+        np.testing.assert_array_equal(ws.apply(data[chunk], shifts[chunk]), expected)
+    if method.startswith('fft'):
+        # Each fractional shift needs one phase ramp
+        assert ws.ramp_misses == 3
+        assert ws.ramp_hits == 13